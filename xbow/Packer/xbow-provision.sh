@@ -7,8 +7,6 @@ sudo add-apt-repository "deb [arch=amd64] https://download.docker.com/linux/ubun
 sudo apt update
 sudo apt install -y docker-ce
 sudo usermod -aG docker ${USER}
-# Install Task Spooler
-sudo apt-get install -y task-spooler
 # Install Xbowflow and Pinda
 sudo pip3 install xbowflow==0.1.13rc3
 sudo pip3 install pinda
@@ -116,6 +116,9 @@ setup_args = {
                 'scripts/xbow-portal',
                 'scripts/xbow-check',
                 'scripts/xbow-fetch',
+                'scripts/xbow-cost',
+                'scripts/xbow-autoscale',
+                'scripts/xbow-bake',
                 'scripts/xbow-login'],
 
     'install_requires': ['boto3',
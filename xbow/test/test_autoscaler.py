@@ -0,0 +1,249 @@
+import unittest
+import json
+
+from xbow.autoscaler import (ScalingPolicy, Autoscaler, XbowCluster,
+                             workers_to_add, group_by_host, retired_hosts,
+                             watch_idle)
+
+class SimulatedCluster(object):
+    """
+    A cluster of worker nodes running fixed-length tasks, each node running
+    nprocs single-threaded dask workers, with nodes taking a while to boot.
+    """
+    def __init__(self, n_workers=1, boot_time=60.0, nprocs=1):
+        self.now = 0.0
+        self.boot_time = boot_time
+        self.nprocs = nprocs
+        self.queue = []
+        self.workers = {}
+        self.booting = []
+        self.n_launched = 0
+        self.worker_seconds = 0.0
+        self.killed_busy = 0
+        for i in range(n_workers):
+            self._add_worker()
+
+    def _add_worker(self):
+        for p in range(self.nprocs):
+            self.workers['tcp://w{}:{}'.format(self.n_launched, 4000 + p)] = None
+        self.n_launched += 1
+
+    def hosts(self):
+        return set([w.split('://')[1].split(':')[0] for w in self.workers])
+
+    def submit(self, n_tasks, duration):
+        self.queue += [duration] * n_tasks
+
+    def advance(self, dt):
+        self.now += dt
+        self.worker_seconds += dt * (len(self.hosts()) + len(self.booting))
+        for ready in [b for b in self.booting if b <= self.now]:
+            self.booting.remove(ready)
+            self._add_worker()
+        for w in sorted(self.workers):
+            if self.workers[w] is not None and self.workers[w] <= self.now:
+                self.workers[w] = None
+            if self.workers[w] is None and len(self.queue) > 0:
+                self.workers[w] = self.now + self.queue.pop(0)
+
+    def state(self):
+        processing = len([w for w in self.workers.values() if w is not None])
+        workers = dict([(w, {'host': w.split('://')[1].split(':')[0],
+                             'nthreads': 1,
+                             'processing': int(self.workers[w] is not None)})
+                        for w in self.workers])
+        return {'queued': len(self.queue), 'processing': processing,
+                'mean_duration': 100.0, 'workers': group_by_host(workers),
+                'pending': len(self.booting)}
+
+    def grow(self, n):
+        self.booting += [self.now + self.boot_time] * n
+
+    def retire(self, hosts):
+        for w in list(self.workers):
+            if w.split('://')[1].split(':')[0] in hosts:
+                if self.workers[w] is not None:
+                    self.killed_busy += 1
+                del self.workers[w]
+
+class IdleCluster(SimulatedCluster):
+    """
+    A simulated cluster whose job queue last ran a job at time 0.
+    """
+    def __init__(self, *args, **kwargs):
+        SimulatedCluster.__init__(self, *args, **kwargs)
+        self.released = False
+
+    def exists(self):
+        return not self.released
+
+    def release_if_idle(self, keep_warm):
+        if self.released:
+            return None
+        if self.now < keep_warm:
+            return keep_warm - self.now
+        self.released = True
+        self.workers = {}
+        return 0
+
+class SchedulerInstance(object):
+    """
+    Stands in for the scheduler node, answering the queue state snippet
+    and xflow-queue commands.
+    """
+    def __init__(self, state, queued_jobs):
+        self.state = state
+        self.queued_jobs = queued_jobs
+
+    def exec_command(self, command):
+        self.exit_status = 0
+        if command.startswith('xflow-queue status'):
+            self.output = json.dumps(self.queued_jobs)
+        else:
+            self.output = json.dumps(self.state)
+
+class TestAutoscaler(unittest.TestCase):
+
+    def simulate(self, policy, nprocs=1):
+        cluster = SimulatedCluster(nprocs=nprocs)
+        scaler = Autoscaler(policy, cluster, clock=lambda: cluster.now)
+        sizes = []
+        cluster.submit(40, 100.0)
+        for i in range(200):
+            if i == 100:
+                cluster.submit(10, 100.0)
+            scaler.step()
+            cluster.advance(30.0)
+            sizes.append(len(cluster.hosts()) + len(cluster.booting))
+        return cluster, sizes
+
+    def test_burst(self):
+        policy = ScalingPolicy(min_workers=1, max_workers=20, target_time=300,
+                               idle_timeout=120)
+        cluster, sizes = self.simulate(policy)
+        self.assertEqual(max(sizes), 14)
+        self.assertEqual(len(cluster.queue), 0)
+        self.assertEqual(sizes[-1], 1)
+        # everything finished well before a single worker could have done it
+        fixed = SimulatedCluster()
+        fixed.submit(40, 100.0)
+        for i in range(100):
+            fixed.advance(30.0)
+        self.assertTrue(len(fixed.queue) > 0)
+
+    def test_burst_with_several_processes_per_node(self):
+        policy = ScalingPolicy(min_workers=1, max_workers=20, target_time=300,
+                               idle_timeout=120)
+        cluster, sizes = self.simulate(policy, nprocs=2)
+        # each node runs two tasks at once, so half as many are needed
+        self.assertEqual(max(sizes), 7)
+        self.assertEqual(len(cluster.queue), 0)
+        self.assertEqual(sizes[-1], 1)
+        self.assertEqual(cluster.killed_busy, 0)
+
+    def test_group_by_host(self):
+        workers = {'tcp://10.0.0.1:4000': {'host': '10.0.0.1', 'nthreads': 2, 'processing': 1},
+                   'tcp://10.0.0.1:4001': {'host': '10.0.0.1', 'nthreads': 2, 'processing': 0},
+                   'tcp://10.0.0.2:4000': {'host': '10.0.0.2', 'nthreads': 2, 'processing': 0}}
+        self.assertEqual(group_by_host(workers),
+                         {'10.0.0.1': {'nprocs': 2, 'nthreads': 4, 'processing': 1,
+                                       'cores': 4, 'used_cores': 1},
+                          '10.0.0.2': {'nprocs': 1, 'nthreads': 2, 'processing': 0,
+                                       'cores': 2, 'used_cores': 0}})
+        by_host = {'10.0.0.1': ['tcp://10.0.0.1:4000', 'tcp://10.0.0.1:4001'],
+                   '10.0.0.2': ['tcp://10.0.0.2:4000']}
+        # only nodes all of whose workers were retired are terminated
+        self.assertEqual(retired_hosts(by_host, ['tcp://10.0.0.1:4000',
+                                                 'tcp://10.0.0.2:4000']),
+                         ['10.0.0.2'])
+
+    def test_limits(self):
+        policy = ScalingPolicy(min_workers=2, max_workers=20, price=0.5,
+                               budget=2.0, target_time=300)
+        cluster, sizes = self.simulate(policy)
+        self.assertEqual(max(sizes), 4)
+        self.assertEqual(sizes[-1], 2)
+        self.assertEqual(len(cluster.queue), 0)
+
+    def test_hold_while_queued(self):
+        policy = ScalingPolicy(min_workers=0, max_workers=2, idle_timeout=0)
+        state = {'queued': 5, 'processing': 1, 'mean_duration': None,
+                 'workers': {'a': {'processing': 1, 'idle': 0},
+                             'b': {'processing': 0, 'idle': 500}}}
+        self.assertEqual(policy.decide(state), ('hold', None))
+        state['queued'] = 0
+        self.assertEqual(policy.decide(state), ('shrink', ['b']))
+
+    def test_workers_to_add(self):
+        state = {'queued': 0, 'processing': 3, 'pending': 0,
+                 'workers': {'a': {'nthreads': 2, 'processing': 2},
+                             'b': {'nthreads': 2, 'processing': 1}}}
+        # one thread free: a new job starts at once on the running pool
+        self.assertEqual(workers_to_add(state, 1, 10), 0)
+        self.assertEqual(workers_to_add(state, 6, 10), 3)
+        self.assertEqual(workers_to_add(state, 6, 3), 1)
+        # a worker still booting counts as room
+        state['pending'] = 1
+        self.assertEqual(workers_to_add(state, 3, 10), 0)
+        state['queued'] = 4
+        self.assertEqual(workers_to_add(state, 1, 10), 1)
+
+    def test_workers_to_add_counts_cores(self):
+        # each node has 4 threads and cores; one runs a job that claimed
+        # them all, the other a job that claimed one
+        state = {'queued': 0, 'processing': 2, 'pending': 0,
+                 'workers': {'a': {'nthreads': 4, 'processing': 1,
+                                   'cores': 4, 'used_cores': 4},
+                             'b': {'nthreads': 4, 'processing': 1,
+                                   'cores': 4, 'used_cores': 1}}}
+        self.assertEqual(workers_to_add(state, 3, 10), 0)
+        self.assertEqual(workers_to_add(state, 4, 10), 1)
+        # a job that takes a whole worker cannot share one
+        self.assertEqual(workers_to_add(state, 1, 10, job_cores=None), 1)
+        self.assertEqual(workers_to_add(state, 1, 10, job_cores=2), 0)
+        state['queued'] = 2
+        state['queued_cores'] = [[None, 1], [2, 1]]
+        self.assertEqual(workers_to_add(state, 0, 10), 1)
+        self.assertEqual(workers_to_add(state, 1, 10, job_cores=2), 2)
+        # the policy sizes the pool by cores too: 11 claimed or wanted
+        policy = ScalingPolicy(max_workers=10)
+        self.assertEqual(policy.target(dict(state, mean_duration=None)), 3)
+
+    def test_state_includes_job_queue(self):
+        state = {'queued': 1, 'processing': 1, 'mean_duration': None,
+                 'queued_cores': [[1, 1]],
+                 'workers': {'tcp://10.0.0.1:4000': {'host': '10.0.0.1', 'nthreads': 2,
+                                                     'processing': 1, 'cores': 2,
+                                                     'used_cores': 1}}}
+        ci = SchedulerInstance(state, [{'id': 3, 'state': 'queued', 'cores': 1},
+                                       {'id': 4, 'state': 'queued', 'cores': 1}])
+        cluster = XbowCluster(ci, 'pool', region='us-east-1')
+        cluster._spot_requests = lambda: [{}]
+        state = cluster.state()
+        # jobs the job queue holds back are waiting as much as dask's tasks
+        self.assertEqual(state['queued'], 3)
+        self.assertEqual(state['pending'], 0)
+        self.assertEqual(workers_to_add(state, 0, 10), 1)
+
+    def test_keep_warm(self):
+        cluster = IdleCluster(n_workers=2)
+        policy = ScalingPolicy(min_workers=0, max_workers=4, idle_timeout=1000)
+        scaler = Autoscaler(policy, cluster, clock=lambda: cluster.now,
+                            keep_warm=300)
+        decisions = []
+        for i in range(20):
+            decisions.append(scaler.step())
+            cluster.advance(30.0)
+        # the pool is deleted once, after 300 s, though its workers would
+        # not have been retired for 1000 s
+        self.assertEqual([d[0] for d in decisions].count('release'), 1)
+        self.assertEqual(decisions.index(('release', None)), 10)
+        cluster = IdleCluster(n_workers=2)
+        cluster.now = 300.0
+        released = []
+        self.assertTrue(watch_idle(cluster, 300, interval=0, log=released.append))
+        self.assertEqual(released, [('release', None)])
+        self.assertFalse(watch_idle(cluster, 300, interval=0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+from xbow import images
+
+REGION = 'eu-west-1'
+
+@unittest.skipIf(mock_aws is None, 'needs moto')
+class TestImages(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.script = os.path.join(self.tmpdir, 'provision.txt')
+        with open(self.script, 'w') as f:
+            f.write('# worker software\napt install -y gromacs\n\n[scheduler]\napt install -y nginx\n[workers]\nsudo pip3 install pinda\n')
+        self.mock = mock_aws()
+        self.mock.start()
+        self.ec2 = boto3.client('ec2', region_name=REGION)
+        self.ec2.create_key_pair(KeyName='workers')
+        instance = boto3.resource('ec2', region_name=REGION).create_instances(
+            ImageId=self.ec2.describe_images(Owners=['amazon'])['Images'][0]['ImageId'],
+            InstanceType='t2.micro', MinCount=1, MaxCount=1)[0]
+        self.base = self.ec2.create_image(InstanceId=instance.id, Name='xbow-packer-1')['ImageId']
+        self.ec2.create_tags(Resources=[self.base], Tags=[{'Key': 'username', 'Value': 'ubuntu'}])
+
+    def tearDown(self):
+        self.mock.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_commands(self):
+        self.assertEqual(images.provisioning_commands(self.script),
+                         ['sudo apt install -y gromacs', 'sudo pip3 install pinda'])
+
+    def test_bake(self):
+        self.assertEqual(images.choose_image(self.base, self.script, region=REGION), self.base)
+        provisioned = []
+        image_id = images.bake_image(self.script, self.base, 't2.micro', 'workers',
+                                     region=REGION, provision=provisioned.append)
+        self.assertEqual(len(provisioned), 1)
+        image = boto3.resource('ec2', region_name=REGION).Image(image_id)
+        tags = dict([(t['Key'], t['Value']) for t in image.tags])
+        self.assertEqual(tags[images.HASH_TAG], images.script_hash(self.script))
+        self.assertEqual(tags[images.BASE_TAG], self.base)
+        self.assertEqual(tags['username'], 'ubuntu')
+        # the instance it was baked on is gone
+        provisioned[0].reload()
+        self.assertTrue(provisioned[0].state['Name'] in ['shutting-down', 'terminated'])
+
+        self.assertEqual(images.choose_image(self.base, self.script, region=REGION), image_id)
+        self.assertTrue(images.is_baked(image_id, self.script, region=REGION))
+        # a changed script needs a new bake
+        with open(self.script, 'a') as f:
+            f.write('apt install -y amber\n')
+        self.assertEqual(images.choose_image(self.base, self.script, region=REGION), self.base)
+        self.assertFalse(images.is_baked(image_id, self.script, region=REGION))
+
+if __name__ == '__main__':
+    unittest.main()
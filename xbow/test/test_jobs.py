@@ -0,0 +1,95 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+
+from xbow import jobs
+from xbow import staging
+from .test_staging import LocalInstance
+
+class QueueInstance(object):
+    """
+    Stands in for the scheduler, answering xflow-queue commands.
+    """
+    def __init__(self, output):
+        self.output = output
+        self.commands = []
+
+    def exec_command(self, command):
+        self.commands.append(command)
+        self.exit_status = 0
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, jobs.JOB_IDS_FILE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_jobs_file(self):
+        self.assertEqual(jobs.load_jobs(self.filename), [])
+        jobs.add_job({'jobid': 'a', 'queue_id': 1, 'command': 'run a'}, self.filename)
+        jobs.add_job({'jobid': 'b', 'queue_id': 2, 'command': 'run b'}, self.filename)
+        job_list = jobs.load_jobs(self.filename)
+        self.assertEqual([j['queue_id'] for j in job_list], [1, 2])
+        jobs.save_jobs(job_list[1:], self.filename)
+        self.assertEqual(jobs.load_jobs(self.filename)[0]['jobid'], 'b')
+        jobs.save_jobs([], self.filename)
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_old_format(self):
+        with open(self.filename, 'w') as f:
+            f.write('jobid: 1234\ntsp_id: 2\n')
+        self.assertEqual(jobs.load_jobs(self.filename),
+                         [{'jobid': '1234', 'queue_id': None, 'command': None}])
+
+    def test_array(self):
+        local = os.path.join(self.tmpdir, 'local')
+        for point in ['t300', 't310', 'sweep/t320']:
+            os.makedirs(os.path.join(local, point))
+            with open(os.path.join(local, point, 'params.mdp'), 'w') as f:
+                f.write(point)
+        with open(os.path.join(local, 't310', 'topol.top'), 'w') as f:
+            f.write('own topology')
+        for name in ['topol.top', 'start.gro']:
+            with open(os.path.join(local, name), 'w') as f:
+                f.write(name)
+        points = jobs.find_points('t3*', local) + jobs.find_points('sweep/*', local)
+        self.assertEqual(points, ['t300', 't310', 'sweep/t320'])
+        shared = jobs.shared_inputs(points, local)
+        self.assertEqual(shared, ['start.gro', 'topol.top'])
+
+        ci = LocalInstance()
+        remote = os.path.join(self.tmpdir, 'remote')
+        staging.upload_tree(ci, remote, root=local, exclude=['start.gro'])
+        jobs.link_shared_inputs(ci, remote, points, shared)
+        with open(os.path.join(remote, 'sweep', 't320', 'topol.top')) as f:
+            self.assertEqual(f.read(), 'topol.top')
+        with open(os.path.join(remote, 't310', 'topol.top')) as f:
+            self.assertEqual(f.read(), 'own topology')
+        self.assertFalse(os.path.lexists(os.path.join(remote, 't300', 'start.gro')))
+        # the links are not inputs, or outputs, of the points
+        inputs = staging.record_inputs(ci, remote)
+        self.assertFalse('t300/topol.top' in inputs)
+
+        job = {'jobid': 'x', 'queue_ids': [4, 5, 6], 'points': points,
+               'command': 'run'}
+        statuses = {4: {'state': 'finished'}, 5: {'state': 'failed'},
+                    6: {'state': 'running'}}
+        self.assertEqual(jobs.label(job), '4-6')
+        self.assertEqual(jobs.summary(job, statuses),
+                         (False, '1 finished, 1 failed, 1 running'))
+        statuses[6]['state'] = 'finished'
+        self.assertTrue(jobs.summary(job, statuses)[0])
+
+    def test_queued_jobs(self):
+        ci = QueueInstance(json.dumps([{'id': 3, 'state': 'queued'},
+                                       {'id': 5, 'state': 'queued'}]))
+        self.assertEqual([job['id'] for job in jobs.queued_jobs(ci)], [3, 5])
+        self.assertEqual(ci.commands, ['xflow-queue status --json --state queued'])
+
+if __name__ == '__main__':
+    unittest.main()
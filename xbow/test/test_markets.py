@@ -0,0 +1,77 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from xbow.metering import SpotPriceHistory
+from xbow.markets import rank_markets, worker_zones, only_market
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+                    'spot_price_history.json')
+# the end of the recorded price data
+NOW = 1569888000.0 + 86400.0
+
+class TestMarketSelection(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(self.tmpdir, 'history.json')
+        shutil.copy(DATA, filename)
+        self.history = SpotPriceHistory(filename, region='eu-west-1')
+        self.zones = ['eu-west-1a', 'eu-west-1b']
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_rank_by_vcpus(self):
+        vcpus = {'c5.xlarge': 4, 'c5.2xlarge': 8, 'p2.xlarge': 4}
+        markets = rank_markets(self.history, ['c5.xlarge', 'c5.2xlarge', 'p2.xlarge'],
+                               self.zones, vcpus, now=NOW)
+        best = markets[0]
+        self.assertEqual(best['instance_type'], 'c5.2xlarge')
+        self.assertEqual(best['availability_zone'], 'eu-west-1a')
+        # no price data for p2.xlarge in eu-west-1b
+        self.assertEqual(len(markets), 5)
+        scores = [m['score'] for m in markets]
+        self.assertEqual(scores, sorted(scores))
+
+    def test_rank_by_throughput(self):
+        # the GPU instance is much faster for this workload
+        nsday = {'c5.xlarge': 10.0, 'c5.2xlarge': 19.0, 'p2.xlarge': 60.0}
+        markets = rank_markets(self.history, ['c5.xlarge', 'c5.2xlarge', 'p2.xlarge'],
+                               self.zones, nsday, now=NOW)
+        self.assertEqual(markets[0]['instance_type'], 'p2.xlarge')
+
+    def test_spikes_and_price_cap(self):
+        vcpus = {'c5.xlarge': 4}
+        markets = rank_markets(self.history, ['c5.xlarge'], self.zones, vcpus,
+                               now=NOW)
+        # eu-west-1b is cheaper now, and on average
+        self.assertEqual(markets[0]['availability_zone'], 'eu-west-1b')
+        markets = rank_markets(self.history, ['c5.xlarge'], self.zones, vcpus,
+                               now=NOW, max_price=0.07)
+        self.assertEqual(len(markets), 1)
+        self.assertEqual(markets[0]['availability_zone'], 'eu-west-1b')
+
+class Scheduler(object):
+    placement = {'AvailabilityZone': 'eu-west-1c'}
+
+class TestWorkerZones(unittest.TestCase):
+
+    def test_worker_zones(self):
+        self.assertEqual(worker_zones(scheduler=Scheduler()), ['eu-west-1c'])
+        self.assertEqual(worker_zones(['eu-west-1a', 'eu-west-1b'], Scheduler()),
+                         ['eu-west-1a', 'eu-west-1b'])
+        self.assertEqual(worker_zones('eu-west-1a', Scheduler()), ['eu-west-1a'])
+        self.assertIsNone(worker_zones())
+
+    def test_only_market(self):
+        # no choice to make, so no need for prices
+        self.assertEqual(only_market('c5.xlarge', worker_zones(scheduler=Scheduler())),
+                         ('c5.xlarge', 'eu-west-1c'))
+        self.assertEqual(only_market(['c5.xlarge']), ('c5.xlarge', None))
+        self.assertIsNone(only_market(['c5.xlarge', 'm5.xlarge'], ['eu-west-1c']))
+        self.assertIsNone(only_market('c5.xlarge', ['eu-west-1a', 'eu-west-1b']))
+
+if __name__ == '__main__':
+    unittest.main()
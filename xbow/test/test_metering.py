@@ -0,0 +1,92 @@
+import unittest
+import datetime
+import os
+import tempfile
+import shutil
+
+from xbow.metering import PriceSeries, SpotPriceHistory, cost_report
+
+class FakeEC2Client(object):
+    """
+    Serves spot price history from a list of (instance type, zone, time,
+    price) tuples, and records the queries made.
+    """
+    def __init__(self, prices):
+        self.prices = prices
+        self.queries = []
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, InstanceTypes, StartTime, EndTime, Filters):
+        self.queries.append((StartTime.timestamp(), EndTime.timestamp()))
+        zones = Filters[1]['Values']
+        history = []
+        for it, az, t, p in self.prices:
+            if it in InstanceTypes and az in zones and t <= EndTime.timestamp():
+                history.append({'InstanceType': it, 'AvailabilityZone': az,
+                                'SpotPrice': p,
+                                'Timestamp': datetime.datetime.fromtimestamp(t, datetime.timezone.utc)})
+        return [{'SpotPriceHistory': history}]
+
+class TestCostAccounting(unittest.TestCase):
+
+    def setUp(self):
+        # $0.36/hour for the first hour, then $0.72/hour
+        self.prices = PriceSeries([(0, '0.36'), (3600, '0.72')])
+
+    def test_price_series(self):
+        self.assertAlmostEqual(self.prices.price_at(1800), 0.36)
+        self.assertAlmostEqual(self.prices.price_at(7200), 0.72)
+        self.assertAlmostEqual(self.prices.cost(0, 3600), 0.36)
+        self.assertAlmostEqual(self.prices.cost(1800, 5400), 0.18 + 0.36)
+        t0 = datetime.datetime(1970, 1, 1, 1, tzinfo=datetime.timezone.utc)
+        self.assertAlmostEqual(self.prices.cost(t0, 5400), 0.36)
+
+    def test_cost_report(self):
+        records = [{'kernel': 'md', 'host': 'h1', 'cores': 2,
+                    'start': 0.0, 'end': 3600.0},
+                   {'kernel': 'analyse', 'host': 'h1', 'cores': 1,
+                    'start': 3600.0, 'end': 5400.0}]
+        report = cost_report(records, self.prices, slots=2)
+        self.assertEqual(report['dominant'], 'md')
+        self.assertAlmostEqual(report['kernels']['md']['cost'], 0.36)
+        self.assertAlmostEqual(report['kernels']['analyse']['cost'], 0.18)
+        self.assertAlmostEqual(report['paid_cost'], 0.72)
+        self.assertAlmostEqual(report['idle_cost'], 0.18)
+        self.assertFalse(report['hosts']['h1']['flagged'])
+        report = cost_report(records, {'h1': self.prices}, slots=2, end=9000)
+        self.assertAlmostEqual(report['idle_cost'], 1.44 - 0.54)
+        self.assertTrue(report['hosts']['h1']['flagged'])
+
+class TestSpotPriceHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'history.json')
+        self.ec2 = FakeEC2Client([('m4.large', 'eu-west-1a', 0, '0.36'),
+                                  ('m4.large', 'eu-west-1a', 3600, '0.72'),
+                                  ('c5.large', 'eu-west-1b', 0, '0.1')])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_incremental_update(self):
+        history = SpotPriceHistory(self.filename, region='eu-west-1')
+        history._ec2_client = self.ec2
+        history.update(['m4.large', 'c5.large'], ['eu-west-1a', 'eu-west-1b'],
+                       0, 1800)
+        self.assertEqual(len(self.ec2.queries), 1)
+        self.assertAlmostEqual(history.cost('m4.large', 'eu-west-1a', 0, 1800), 0.18)
+        self.assertAlmostEqual(history.cost('c5.large', 'eu-west-1b', 0, 1800), 0.05)
+        self.assertEqual(len(self.ec2.queries), 1)
+        self.assertAlmostEqual(history.cost('m4.large', 'eu-west-1a', 0, 5400), 0.72)
+        self.assertEqual(self.ec2.queries[-1], (1800, 5400))
+
+        history = SpotPriceHistory(self.filename, region='eu-west-1')
+        history._ec2_client = self.ec2
+        self.assertAlmostEqual(history.cost('m4.large', 'eu-west-1a', 1800, 5400), 0.54)
+        self.assertEqual(len(self.ec2.queries), 2)
+
+if __name__ == '__main__':
+    unittest.main()
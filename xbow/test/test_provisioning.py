@@ -0,0 +1,60 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from xbow import provisioning
+from .test_staging import LocalInstance
+
+class TestProvisioning(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.script = os.path.join(self.tmpdir, 'provision.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_script(self, lines):
+        with open(self.script, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return provisioning.shell_script(self.script)
+
+    def connect(self, instance):
+        if instance == 'unreachable':
+            raise RuntimeError('Error - problem with connection to instance')
+        return LocalInstance()
+
+    def test_provision(self):
+        marker = os.path.join(self.tmpdir, 'done')
+        script = self.write_script(['# set up', 'echo "it\'s working"',
+                                    '', 'touch {}'.format(marker)])
+        lines = []
+        nodes = {'i-1': ('scheduler', 'node'), 'i-2': ('worker-0', 'node'),
+                 'i-3': ('worker-1', 'unreachable')}
+        results = provisioning.provision_nodes(nodes, script, self.connect,
+                                               log=lambda label, line: lines.append((label, line)))
+        self.assertEqual(results['i-1']['status'], 'ok')
+        self.assertEqual(results['i-2']['status'], 'ok')
+        self.assertEqual(results['i-3']['status'], 'failed')
+        self.assertEqual(results['i-3']['label'], 'worker-1')
+        self.assertTrue(os.path.exists(marker))
+        self.assertTrue(('worker-0', "it's working") in lines)
+        self.assertTrue(('scheduler', '# set up') in lines)
+
+        filename = os.path.join(self.tmpdir, 'state.json')
+        provisioning.save_state({'hash': 'x', 'nodes': results}, filename)
+        state = provisioning.load_state(filename)
+        self.assertEqual(provisioning.failed_nodes(state), ['i-3'])
+
+    def test_failure(self):
+        script = self.write_script(['echo one', 'false', 'echo never'])
+        result = provisioning.provision_node(LocalInstance(), script)
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual(result['exit_status'], 1)
+        self.assertEqual(result['failed_command'], 'sudo false')
+        self.assertTrue('one' in result['output'])
+        self.assertFalse('never' in result['output'])
+
+if __name__ == '__main__':
+    unittest.main()
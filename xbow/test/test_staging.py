@@ -0,0 +1,194 @@
+import unittest
+import os
+import shutil
+import tempfile
+import subprocess
+
+from xbow import staging
+
+class LocalChannel(object):
+    """
+    Stands in for a paramiko Channel, running commands on this machine.
+    """
+    def exec_command(self, command):
+        self.process = subprocess.Popen(command, shell=True,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+
+    def makefile(self, mode):
+        if 'w' in mode:
+            return self.process.stdin
+        return self.process.stdout
+
+    def makefile_stderr(self, mode):
+        return self.process.stderr
+
+    def shutdown_write(self):
+        if not self.process.stdin.closed:
+            self.process.stdin.close()
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+class LocalFile(object):
+    """
+    Stands in for a paramiko SFTPFile, recording where reads started.
+    """
+    def __init__(self, path, mode, sftp):
+        self.f = open(path, mode)
+        self.sftp = sftp
+
+    def seek(self, offset):
+        self.sftp.offsets.append(offset)
+        self.f.seek(offset)
+
+    def prefetch(self, size):
+        pass
+
+    def read(self, size):
+        return self.f.read(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+class LocalSFTP(object):
+    def __init__(self):
+        self.offsets = []
+
+    def open(self, path, mode):
+        return LocalFile(path, mode, self)
+
+    def close(self):
+        pass
+
+class LocalTransport(object):
+    def open_session(self):
+        return LocalChannel()
+
+class LocalInstance(object):
+    """
+    Stands in for a ConnectedInstance, running commands on this machine.
+    """
+    def __init__(self):
+        self.transport = LocalTransport()
+        self.sftp = LocalSFTP()
+
+    def open_sftp(self):
+        return self.sftp
+
+    def exec_command(self, command):
+        try:
+            output = subprocess.check_output(command, shell=True,
+                                             stderr=subprocess.STDOUT)
+            self.exit_status = 0
+        except subprocess.CalledProcessError as e:
+            output = e.output
+            self.exit_status = e.returncode
+        self.output = output.decode('utf-8')
+
+class TestStaging(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.local = os.path.join(self.tmpdir, 'local')
+        self.remote = os.path.join(self.tmpdir, 'remote', 'job')
+        os.makedirs(os.path.join(self.local, 'inputs'))
+        for i in range(50):
+            with open(os.path.join(self.local, 'inputs', 'x{}.txt'.format(i)), 'w') as f:
+                f.write('data {}\n'.format(i) * i)
+        for name in ['run.sh', 'notes.log', '-odd name', '.xbow_ids.yml']:
+            with open(os.path.join(self.local, name), 'w') as f:
+                f.write(name)
+        self.ci = LocalInstance()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_select(self):
+        paths = ['a.txt', 'b.log', 'sub/c.txt', '.xbow_ids.yml']
+        self.assertEqual(staging.select(paths), ['a.txt', 'b.log', 'sub/c.txt'])
+        self.assertEqual(staging.select(paths, include=['*.txt']),
+                         ['a.txt', 'sub/c.txt'])
+        self.assertEqual(staging.select(paths, exclude=['sub/*', '*.log']),
+                         ['a.txt'])
+
+    def test_round_trip(self):
+        reports = []
+        progress = lambda *args: reports.append(args)
+        sent = staging.upload_tree(self.ci, self.remote, root=self.local,
+                                   exclude=['*.log'], progress=progress)
+        self.assertEqual(len(sent), 52)
+        self.assertEqual(reports[-1][0], reports[-1][1])
+        self.assertEqual(reports[-1][2], reports[-1][3])
+        remote = staging.remote_files(self.ci, self.remote)
+        self.assertEqual(sorted(remote), sorted(sent))
+        self.assertFalse('notes.log' in remote)
+        self.assertFalse('.xbow_ids.yml' in remote)
+
+        back = os.path.join(self.tmpdir, 'back')
+        received = staging.download_tree(self.ci, self.remote, root=back,
+                                         include=['inputs/*', '-odd name'])
+        self.assertEqual(len(received), 51)
+        for path in received:
+            with open(os.path.join(self.local, path)) as f1:
+                with open(os.path.join(back, path)) as f2:
+                    self.assertEqual(f1.read(), f2.read())
+
+    def test_fetch_outputs(self):
+        staging.upload_tree(self.ci, self.remote, root=self.local)
+        inputs = staging.record_inputs(self.ci, self.remote)
+        self.assertEqual(len(inputs), 53)
+        self.assertEqual(staging.remote_changes(self.ci, self.remote), {})
+        # the job writes some outputs and modifies an input
+        with open(os.path.join(self.remote, 'inputs', 'x3.txt'), 'a') as f:
+            f.write('more\n')
+        with open(os.path.join(self.remote, 'small.out'), 'w') as f:
+            f.write('result\n')
+        big = os.urandom(3 * 2**20)
+        with open(os.path.join(self.remote, 'big.out'), 'wb') as f:
+            f.write(big)
+        changes = staging.remote_changes(self.ci, self.remote)
+        self.assertEqual(sorted(changes), ['big.out', 'inputs/x3.txt', 'small.out'])
+
+        # an earlier fetch of big.out was interrupted
+        with open(os.path.join(self.local, 'big.out.xbow-part'), 'wb') as f:
+            f.write(big[:2**20])
+        fetched = staging.fetch_outputs(self.ci, self.remote, changes,
+                                        root=self.local, resume_size=2**20)
+        self.assertEqual(sorted(fetched), sorted(changes))
+        self.assertEqual(self.ci.sftp.offsets, [2**20])
+        with open(os.path.join(self.local, 'big.out'), 'rb') as f:
+            self.assertEqual(f.read(), big)
+        self.assertFalse(os.path.exists(os.path.join(self.local, 'big.out.xbow-part')))
+        with open(os.path.join(self.local, 'inputs', 'x3.txt')) as f:
+            self.assertTrue(f.read().endswith('more\n'))
+        # nothing more to do
+        self.assertEqual(staging.fetch_outputs(self.ci, self.remote, changes,
+                                               root=self.local), [])
+
+    def test_corrupt_partial_download(self):
+        data = os.urandom(1000)
+        with open(os.path.join(self.tmpdir, 'remote.dat'), 'wb') as f:
+            f.write(data)
+        local = os.path.join(self.tmpdir, 'local.dat')
+        with open(local + '.xbow-part', 'wb') as f:
+            f.write(b'rubbish')
+        md5 = staging.file_hash(os.path.join(self.tmpdir, 'remote.dat'))
+        staging._resume_download(self.ci.sftp, os.path.join(self.tmpdir, 'remote.dat'),
+                                 local, 1000, md5)
+        self.assertEqual(self.ci.sftp.offsets, [7, 0])
+        with open(local, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_remote_failure(self):
+        with open(os.path.join(self.tmpdir, 'remote'), 'w') as f:
+            f.write('not a directory')
+        with self.assertRaises(RuntimeError):
+            staging.upload_tree(self.ci, self.remote, root=self.local)
+
+if __name__ == '__main__':
+    unittest.main()
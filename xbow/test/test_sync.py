@@ -0,0 +1,142 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from xbow import sync
+from .test_staging import LocalInstance
+
+def write(path, text):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(text)
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+class TestPlan(unittest.TestCase):
+
+    def entry(self, h, mtime=0.0):
+        return {'size': 1, 'mtime': mtime, 'hash': h}
+
+    def test_three_way(self):
+        base = {'same': self.entry('a'), 'local_edit': self.entry('a'),
+                'remote_edit': self.entry('a'), 'local_del': self.entry('a'),
+                'both': self.entry('a')}
+        local = {'same': self.entry('a'), 'local_edit': self.entry('b'),
+                 'remote_edit': self.entry('a'), 'both': self.entry('b', 2.0),
+                 'new_local': self.entry('c')}
+        remote = {'same': self.entry('a'), 'local_edit': self.entry('a'),
+                  'remote_edit': self.entry('b'), 'local_del': self.entry('a'),
+                  'both': self.entry('c', 1.0)}
+        actions = sync.plan(local, remote, base)
+        self.assertEqual(actions['upload'], ['local_edit', 'new_local'])
+        self.assertEqual(actions['download'], ['remote_edit'])
+        self.assertEqual(actions['delete_remote'], ['local_del'])
+        self.assertEqual(actions['conflicts'], ['both'])
+        self.assertEqual(actions['base']['both'], base['both'])
+        actions = sync.plan(local, remote, base, prefer='newer')
+        self.assertTrue('both' in actions['upload'])
+        actions = sync.plan(local, remote, base, prefer='remote',
+                            direction='download')
+        self.assertEqual(actions['upload'], [])
+        self.assertEqual(actions['download'], ['both', 'remote_edit'])
+
+    def test_remote_deletions(self):
+        base = {'kept': self.entry('a'), 'other': self.entry('a')}
+        local = {'kept': self.entry('a'), 'other': self.entry('a')}
+        remote = {'other': self.entry('a')}
+        actions = sync.plan(local, remote, base, delete_local=False)
+        self.assertEqual(actions['delete_local'], [])
+        self.assertEqual(actions['kept_local'], ['kept'])
+        self.assertEqual(actions['base']['kept'], base['kept'])
+        actions = sync.plan(local, remote, base)
+        self.assertEqual(actions['delete_local'], ['kept'])
+
+    def test_empty_remote(self):
+        # an empty remote is not taken as everything having been deleted
+        base = {'a': self.entry('a'), 'b': self.entry('b')}
+        local = {'a': self.entry('a'), 'b': self.entry('b')}
+        actions = sync.plan(local, {}, base)
+        self.assertEqual(actions['delete_local'], [])
+        self.assertEqual(actions['upload'], ['a', 'b'])
+        self.assertEqual(len(actions['warnings']), 1)
+
+class TestSync(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.local = os.path.join(self.tmpdir, 'local')
+        self.remote = os.path.join(self.tmpdir, 'remote')
+        for i in range(20):
+            write(os.path.join(self.local, 'data', 'f{}.txt'.format(i)), str(i))
+        write(os.path.join(self.local, 'run.sh'), 'echo hello')
+        self.ci = LocalInstance()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sync(self):
+        actions = sync.sync(self.ci, self.remote, root=self.local)
+        self.assertEqual(len(actions['upload']), 21)
+        self.assertEqual(read(os.path.join(self.remote, 'run.sh')), 'echo hello')
+
+        # nothing has changed
+        actions = sync.sync(self.ci, self.remote, root=self.local)
+        self.assertEqual(actions['upload'] + actions['download'], [])
+
+        # changes on both sides, and a conflict
+        write(os.path.join(self.local, 'run.sh'), 'echo goodbye')
+        os.remove(os.path.join(self.local, 'data', 'f0.txt'))
+        write(os.path.join(self.remote, 'output.log'), 'done')
+        write(os.path.join(self.local, 'data', 'f1.txt'), 'local')
+        write(os.path.join(self.remote, 'data', 'f1.txt'), 'remote')
+        actions = sync.sync(self.ci, self.remote, root=self.local)
+        self.assertEqual(actions['upload'], ['run.sh'])
+        self.assertEqual(actions['download'], ['output.log'])
+        self.assertEqual(actions['delete_remote'], ['data/f0.txt'])
+        self.assertEqual(actions['conflicts'], ['data/f1.txt'])
+        self.assertEqual(read(os.path.join(self.remote, 'run.sh')), 'echo goodbye')
+        self.assertEqual(read(os.path.join(self.local, 'output.log')), 'done')
+        self.assertFalse(os.path.exists(os.path.join(self.remote, 'data', 'f0.txt')))
+
+        # the conflict is still there until it is settled
+        actions = sync.sync(self.ci, self.remote, root=self.local)
+        self.assertEqual(actions['conflicts'], ['data/f1.txt'])
+        actions = sync.sync(self.ci, self.remote, root=self.local,
+                            prefer='remote')
+        self.assertEqual(actions['download'], ['data/f1.txt'])
+        self.assertEqual(read(os.path.join(self.local, 'data', 'f1.txt')), 'remote')
+        actions = sync.sync(self.ci, self.remote, root=self.local)
+        self.assertEqual(actions['upload'] + actions['download']
+                         + actions['conflicts'], [])
+
+    def test_remote_deletions(self):
+        sync.sync(self.ci, self.remote, root=self.local)
+        os.remove(os.path.join(self.remote, 'run.sh'))
+        actions = sync.sync(self.ci, self.remote, root=self.local)
+        self.assertEqual(actions['kept_local'], ['run.sh'])
+        self.assertTrue(os.path.exists(os.path.join(self.local, 'run.sh')))
+
+        # the plan is reported before anything is deleted
+        reported = []
+        def report(actions):
+            reported.append(os.path.exists(os.path.join(self.local, 'run.sh')))
+        actions = sync.sync(self.ci, self.remote, root=self.local,
+                            delete=True, report=report)
+        self.assertEqual(actions['delete_local'], ['run.sh'])
+        self.assertEqual(reported, [True])
+        self.assertFalse(os.path.exists(os.path.join(self.local, 'run.sh')))
+
+    def test_empty_remote(self):
+        sync.sync(self.ci, self.remote, root=self.local)
+        shutil.rmtree(self.remote)
+        actions = sync.sync(self.ci, self.remote, root=self.local, delete=True)
+        self.assertEqual(actions['delete_local'], [])
+        self.assertEqual(len(actions['upload']), 21)
+        self.assertEqual(read(os.path.join(self.remote, 'run.sh')), 'echo hello')
+
+if __name__ == '__main__':
+    unittest.main()
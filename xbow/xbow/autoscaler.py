@@ -0,0 +1,543 @@
+from __future__ import print_function
+
+import base64
+import json
+import math
+import time
+import boto3
+
+from . import pools
+from . import jobs
+from .instances import terminate_cluster
+
+# how long the worker pool is kept after the last job ends, by default
+KEEP_WARM = 900
+
+# Run with python3 on the scheduler node (which has dask but not xbow),
+# prints the state of the dask queue as JSON, with each dask worker process
+# (there are worker_nprocs on each worker node). Tasks claim the "cores"
+# resource the workers advertise (one core if they do not say), and the
+# cores the queued tasks need are listed as [cores, number of tasks].
+QUEUE_STATE_SNIPPET = '''
+import json
+from dask.distributed import Client
+
+def cores(ts):
+    return (ts.resource_restrictions or {}).get('cores', 1)
+
+def queue_state(dask_scheduler=None):
+    durations = []
+    queued = 0
+    queued_cores = {}
+    processing = 0
+    for ts in dask_scheduler.tasks.values():
+        if ts.state in ['waiting', 'queued', 'no-worker']:
+            queued += 1
+            queued_cores[cores(ts)] = queued_cores.get(cores(ts), 0) + 1
+        elif ts.state == 'processing':
+            processing += 1
+        else:
+            continue
+        if ts.prefix.duration_average > 0:
+            durations.append(ts.prefix.duration_average)
+    workers = {}
+    for address, ws in dask_scheduler.workers.items():
+        # a worker is sent more tasks than it has cores for, which wait there
+        size = ws.resources.get('cores', ws.nthreads)
+        used = 0
+        running = 0
+        for ts in ws.processing:
+            if used + cores(ts) > size:
+                queued += 1
+                queued_cores[cores(ts)] = queued_cores.get(cores(ts), 0) + 1
+                processing -= 1
+            else:
+                used += cores(ts)
+                running += 1
+        workers[address] = {'host': ws.host, 'nthreads': ws.nthreads,
+                            'processing': running, 'cores': size,
+                            'used_cores': used}
+    mean_duration = None
+    if len(durations) > 0:
+        mean_duration = sum(durations) / len(durations)
+    return {'queued': queued, 'processing': processing,
+            'queued_cores': [[c, n] for c, n in queued_cores.items()],
+            'mean_duration': mean_duration, 'workers': workers}
+
+client = Client('localhost:8786', timeout=10)
+print(json.dumps(client.run_on_scheduler(queue_state)))
+client.close()
+'''
+
+# Retires the dask workers on the given worker nodes, skipping any node
+# where a worker is busy, and prints the addresses of all the workers on
+# each node and those retired, as JSON.
+RETIRE_SNIPPET = '''
+import json
+from dask.distributed import Client
+
+def idle_workers(hosts, dask_scheduler=None):
+    by_host = {{}}
+    busy = set()
+    for address, ws in dask_scheduler.workers.items():
+        if ws.host in hosts:
+            by_host.setdefault(ws.host, []).append(address)
+            if len(ws.processing) > 0:
+                busy.add(ws.host)
+    return by_host, [a for h in by_host if not h in busy for a in by_host[h]]
+
+client = Client('localhost:8786', timeout=10)
+by_host, idle = client.run_on_scheduler(idle_workers, {hosts})
+retired = []
+if len(idle) > 0:
+    retired = list(client.retire_workers(workers=idle, close_workers=True))
+print(json.dumps({{'workers': by_host, 'retired': retired}}))
+client.close()
+'''
+
+def group_by_host(workers):
+    """
+    Combine the dask worker processes on each worker node.
+
+    Args:
+        workers (dict): for each dask worker, keyed by address, a dict with
+            keys 'host', 'nthreads', 'processing' and (optionally) 'cores'
+            and 'used_cores'
+
+    Returns:
+        dict: for each worker node, keyed by host, a dict with keys
+            'nprocs', 'nthreads', 'processing', 'cores' and 'used_cores',
+            summed over its processes. A worker that does not advertise
+            its cores has one per thread, and each task uses one.
+    """
+    hosts = {}
+    for w in workers.values():
+        host = hosts.setdefault(w['host'], {'nprocs': 0, 'nthreads': 0,
+                                            'processing': 0, 'cores': 0,
+                                            'used_cores': 0})
+        host['nprocs'] += 1
+        host['nthreads'] += w['nthreads']
+        host['processing'] += w['processing']
+        host['cores'] += w.get('cores', w['nthreads'])
+        host['used_cores'] += w.get('used_cores', w['processing'])
+    return hosts
+
+def retired_hosts(workers, retired):
+    """
+    The worker nodes all of whose dask workers were retired.
+
+    Args:
+        workers (dict): the addresses of the dask workers on each node,
+            keyed by host
+        retired (list): the addresses of the workers retired
+
+    Returns:
+        list: the hosts, sorted
+    """
+    retired = set(retired)
+    return sorted([host for host, addresses in workers.items()
+                   if len(addresses) > 0 and set(addresses) <= retired])
+
+def worker_cores(state, threads_per_worker=1):
+    """
+    The cores of a typical worker (worker node) of a cluster: the mean over
+    those that have joined, else threads_per_worker.
+    """
+    cores = [w.get('cores', w.get('nthreads', threads_per_worker))
+             for w in state['workers'].values()]
+    if len(cores) == 0:
+        return threads_per_worker
+    return max(sum(cores) // len(cores), 1)
+
+def queued_cores(state):
+    """
+    The cores each queued task or job needs, as a list of (cores, number)
+    pairs, where None stands for all of a worker's. Without a breakdown in
+    the state, each queued task needs one core.
+    """
+    if not 'queued_cores' in state:
+        return [(1, state['queued'])]
+    return [(c, n) for c, n in state['queued_cores']]
+
+def workers_to_add(state, n_jobs, max_workers, threads_per_worker=1,
+                   job_cores=1):
+    """
+    How many workers (worker nodes) to add to a running pool so that what
+    is queued, and n_jobs more jobs, can start straight away, given the
+    jobs it is busy with already.
+
+    A job only starts on a worker with as many of its cores free as it
+    claims (see the xbowflow jobqueue module), so the queued jobs are
+    packed, largest first, into the free cores of each worker, then those
+    of the workers still booting, then those of new workers.
+
+    Args:
+        state (dict): the state of the cluster (see ScalingPolicy.decide())
+        n_jobs (int): the number of jobs about to be queued
+        max_workers (int): never grow beyond this many workers
+        threads_per_worker (int): cores each new worker has, until some
+            workers have joined and can be asked
+        job_cores (int, optional): the cores each of the n_jobs needs, or
+            None for all of a worker's
+
+    Returns:
+        int: the number of workers to add (0 if there is room already)
+    """
+    workers = state['workers']
+    pending = state.get('pending', 0)
+    size = worker_cores(state, threads_per_worker)
+    # [free cores, cores] of each worker
+    slots = [[w.get('cores', w.get('nthreads', threads_per_worker))
+              - w.get('used_cores', w.get('processing', 0)),
+              w.get('cores', w.get('nthreads', threads_per_worker))]
+             for w in workers.values()]
+    slots += [[size, size] for i in range(pending)]
+    demand = queued_cores(state) + [(job_cores, n_jobs)]
+    demand.sort(key=lambda d: -size if d[0] is None else -d[0])
+    n = 0
+    for cores, number in demand:
+        for i in range(number):
+            for slot in slots:
+                need = slot[1] if cores is None else min(cores, slot[1])
+                if slot[0] >= need and (cores is not None or slot[0] == slot[1]):
+                    slot[0] -= need
+                    break
+            else:
+                need = size if cores is None else min(cores, size)
+                slots.append([size - need, size])
+                n += 1
+    return max(min(n, max_workers - len(workers) - pending), 0)
+
+class ScalingPolicy(object):
+    """
+    Decides how many workers (worker nodes, each of which may run several
+    dask worker processes) a cluster should have.
+
+    The policy is pure: it looks only at the state it is given, so it can
+    be tested against a simulated cluster.
+    """
+    def __init__(self, min_workers=0, max_workers=10, threads_per_worker=1,
+                 target_time=600.0, idle_timeout=300.0, price=None,
+                 budget=None):
+        """
+        Args:
+            min_workers (int): never shrink below this many workers
+            max_workers (int): never grow beyond this many workers
+            threads_per_worker (int): cores each new worker has, until some
+                workers have joined and can be asked
+            target_time (float): aim to clear the queue in this many
+                seconds. Until any tasks have finished, each task is assumed
+                to take this long.
+            idle_timeout (float): retire workers that have been idle for
+                this many seconds
+            price (float, optional): the cost of a worker per hour
+            budget (float, optional): the most to spend on workers per hour
+                (requires price)
+        """
+        if min_workers > max_workers:
+            raise ValueError('Error - min_workers is greater than max_workers')
+        if budget is not None and price is None:
+            raise ValueError('Error - a budget needs a price')
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.threads_per_worker = threads_per_worker
+        self.target_time = target_time
+        self.idle_timeout = idle_timeout
+        self.price = price
+        self.budget = budget
+
+    def limit(self):
+        """
+        The largest number of workers allowed.
+        """
+        limit = self.max_workers
+        if self.budget is not None and float(self.price) > 0:
+            limit = min(limit, int(math.floor(self.budget / float(self.price))))
+        return max(limit, self.min_workers)
+
+    def target(self, state):
+        """
+        The number of workers needed to clear the queue in the target time.
+        """
+        size = worker_cores(state, self.threads_per_worker)
+        n_cores = sum([(size if c is None else min(c, size)) * n
+                       for c, n in queued_cores(state)])
+        n_cores += sum([w.get('used_cores', w['processing'])
+                        for w in state['workers'].values()])
+        duration = state.get('mean_duration')
+        if duration is None:
+            duration = self.target_time
+        # each task holds its cores for duration seconds, but cannot be split
+        cores = int(math.ceil(n_cores * min(duration / self.target_time, 1.0)))
+        workers = int(math.ceil(float(cores) / size))
+        return min(max(workers, self.min_workers), self.limit())
+
+    def decide(self, state):
+        """
+        Decide what to do.
+
+        Args:
+            state (dict): the state of the cluster, with keys:
+                'queued': tasks waiting to run
+                'queued_cores' (optional): the cores they need, as a list
+                    of [cores, number of tasks], where None is all of a
+                    worker's (see queued_cores())
+                'processing': tasks running
+                'mean_duration': mean task duration in seconds, or None
+                'workers': a dict for each worker node, keyed by host,
+                    with keys 'nthreads' (threads across all its dask
+                    workers), 'processing' (tasks it is running), 'idle'
+                    (seconds it has been idle) and, optionally, 'cores'
+                    (the cores its workers advertise) and 'used_cores'
+                    (those its tasks have claimed)
+                'pending': workers that have been launched but have not
+                    joined the cluster yet
+
+        Returns:
+            tuple: ('grow', number of workers to add),
+                ('shrink', list of hosts of workers to retire), or
+                ('hold', None)
+        """
+        workers = state['workers']
+        n_workers = len(workers) + state.get('pending', 0)
+        target = self.target(state)
+        if target > n_workers:
+            return ('grow', target - n_workers)
+        if state['queued'] > 0 or n_workers <= target:
+            return ('hold', None)
+        idle = [w for w in workers if workers[w]['processing'] == 0
+                and workers[w]['idle'] >= self.idle_timeout]
+        idle.sort(key=lambda w: -workers[w]['idle'])
+        retire = idle[:n_workers - target]
+        if len(retire) == 0:
+            return ('hold', None)
+        return ('shrink', retire)
+
+class Autoscaler(object):
+    """
+    Periodically applies a ScalingPolicy to a cluster.
+    """
+    def __init__(self, policy, cluster, interval=30.0, clock=time.time,
+                 keep_warm=None):
+        """
+        Args:
+            policy (ScalingPolicy): the policy
+            cluster: an object with methods state(), which returns the
+                cluster state (as for ScalingPolicy.decide(), but without
+                the 'idle' times), grow(n) and retire(hosts), and, if
+                keep_warm is given, release_if_idle(keep_warm). XbowCluster
+                provides these for an xbow cluster.
+            interval (float): seconds between checks
+            clock (function): returns the current time
+            keep_warm (float, optional): delete the whole pool once the job
+                queue has been idle this many seconds
+        """
+        self.policy = policy
+        self.cluster = cluster
+        self.interval = interval
+        self.clock = clock
+        self.keep_warm = keep_warm
+        self.busy_at = {}
+
+    def step(self):
+        """
+        Check the cluster, and grow or shrink it if required.
+
+        Returns:
+            tuple: the decision made (see ScalingPolicy.decide()), or
+                ('release', None) if the pool has been deleted
+        """
+        if (self.keep_warm is not None
+                and self.cluster.release_if_idle(self.keep_warm) == 0):
+            self.busy_at = {}
+            return ('release', None)
+        state = self.cluster.state()
+        now = self.clock()
+        for w in list(self.busy_at):
+            if not w in state['workers']:
+                del self.busy_at[w]
+        for w, info in state['workers'].items():
+            if info['processing'] > 0 or not w in self.busy_at:
+                self.busy_at[w] = now
+            info['idle'] = now - self.busy_at[w]
+        decision = self.policy.decide(state)
+        if decision[0] == 'grow':
+            self.cluster.grow(decision[1])
+        elif decision[0] == 'shrink':
+            self.cluster.retire(decision[1])
+            for w in decision[1]:
+                self.busy_at.pop(w, None)
+        return decision
+
+    def run(self, log=None):
+        """
+        Run until interrupted, or until the pool has been deleted.
+
+        Args:
+            log (function, optional): called with each decision that is not
+                'hold'
+        """
+        try:
+            while True:
+                decision = self.step()
+                if log is not None and decision[0] != 'hold':
+                    log(decision)
+                if decision[0] == 'release':
+                    return
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
+
+def watch_idle(cluster, keep_warm=KEEP_WARM, interval=60.0, log=None):
+    """
+    Wait for the job queue to be idle for keep_warm seconds, then delete
+    the worker pool. This is what keeps an idle pool from running up costs
+    when no xbow command is run after its last job ends.
+
+    Args:
+        cluster (XbowCluster): the cluster
+        keep_warm (float): seconds to keep the pool after the last job
+        interval (float): seconds between checks
+        log (function, optional): called with ('release', None) when the
+            pool is deleted
+
+    Returns:
+        bool: whether the pool was deleted (rather than found gone)
+    """
+    while cluster.exists():
+        if cluster.release_if_idle(keep_warm) == 0:
+            if log is not None:
+                log(('release', None))
+            return True
+        time.sleep(interval)
+    return False
+
+class XbowCluster(object):
+    """
+    The scheduler and worker pool of an xbow cluster, as seen by an
+    Autoscaler.
+    """
+    def __init__(self, scheduler, pool_name, region=None):
+        """
+        Args:
+            scheduler (ConnectedInstance): the scheduler node
+            pool_name (str): the name of the worker pool
+            region (str, optional): The EC2 region
+        """
+        if region is None:
+            region = boto3.session.Session().region_name
+        self.scheduler = scheduler
+        self.pool_name = pool_name
+        self.region = region
+        self.ec2_client = boto3.client('ec2', region_name=region)
+
+    def _run_python(self, snippet):
+        self.scheduler.exec_command("python3 - <<'EOF'\n{}\nEOF".format(snippet))
+        if self.scheduler.exit_status != 0:
+            raise RuntimeError('Error - command on scheduler failed: {}'.format(self.scheduler.output))
+        return json.loads(self.scheduler.output.strip().split('\n')[-1])
+
+    def _spot_requests(self):
+        dsir = self.ec2_client.describe_spot_instance_requests
+        response = dsir(Filters=[{'Name': 'launch-group', 'Values': [self.pool_name]},
+                                 {'Name': 'state', 'Values': ['open', 'active']}])
+        return response['SpotInstanceRequests']
+
+    def exists(self):
+        """
+        Whether the worker pool is running (or being launched).
+        """
+        return len(self._spot_requests()) > 0
+
+    def release_if_idle(self, keep_warm):
+        """
+        Terminate the worker pool if the job queue has been idle for at
+        least keep_warm seconds.
+
+        Returns:
+            float: the seconds left before the pool can be released, 0 if
+                it has been, or None if the queue is busy or there is no
+                pool
+        """
+        if not self.exists():
+            return None
+        idle = jobs.queue_idle_time(self.scheduler)
+        if idle is None or idle == 0:
+            return None
+        if idle < keep_warm:
+            return keep_warm - idle
+        try:
+            terminate_cluster(self.pool_name, region=self.region)
+        except ValueError:
+            # the spot requests are cancelled, but no instance was running
+            pass
+        return 0
+
+    def state(self):
+        """
+        The state of the dask queue and the worker pool, with the dask
+        workers on each worker node combined (see group_by_host()), so that
+        workers are counted in instances. The jobs the job queue is holding
+        back (see the xbowflow jobqueue module), which are not on the dask
+        queue yet, count as queued too.
+        """
+        state = self._run_python(QUEUE_STATE_SNIPPET)
+        # a job that does not say how many cores it needs takes a whole worker
+        for job in jobs.queued_jobs(self.scheduler):
+            state['queued'] += 1
+            state['queued_cores'].append([job.get('cores'), 1])
+        state['workers'] = group_by_host(state['workers'])
+        state['pending'] = max(len(self._spot_requests()) - len(state['workers']), 0)
+        return state
+
+    def grow(self, n):
+        """
+        Add n workers to the pool, launched the same way as the existing
+        ones.
+        """
+        requests = self._spot_requests()
+        if len(requests) == 0:
+            raise RuntimeError('Error - no worker pool {} to grow'.format(self.pool_name))
+        request = requests[-1]
+        spec = request['LaunchSpecification']
+        user_data = base64.b64decode(spec.get('UserData', '')).decode('utf-8')
+        pools.create_spot_pool(self.pool_name, count=n,
+                               price=request['SpotPrice'],
+                               image_id=spec['ImageId'],
+                               region=self.region,
+                               instance_type=spec['InstanceType'],
+                               user_data=user_data,
+                               ec2_security_groups=[g['GroupName'] for g in spec['SecurityGroups']],
+                               availability_zone=spec['Placement']['AvailabilityZone'],
+                               append=True, wait=False)
+
+    def retire(self, hosts):
+        """
+        Drain the dask workers on the given worker nodes (hosts) of data,
+        shut them down, and terminate the instances. A node where any
+        worker has become busy again is left alone.
+        """
+        result = self._run_python(RETIRE_SNIPPET.format(hosts=repr(list(hosts))))
+        ips = set(retired_hosts(result['workers'], result['retired']))
+        ids = [r['InstanceId'] for r in self._spot_requests() if 'InstanceId' in r]
+        if len(ids) == 0 or len(ips) == 0:
+            return
+        response = self.ec2_client.describe_instances(InstanceIds=ids)
+        instance_ids = [i['InstanceId'] for r in response['Reservations']
+                        for i in r['Instances']
+                        if i.get('PrivateIpAddress') in ips]
+        if len(instance_ids) > 0:
+            terminate_cluster(self.pool_name, region=self.region,
+                              instance_ids=instance_ids)
+
+def release_idle_workers(ci, cfg):
+    """
+    Keep the worker pool warm for worker_keep_warm seconds (default 900)
+    after the last job ends, so new jobs start straight away, then delete it.
+    """
+    cluster = XbowCluster(ci, cfg['worker_pool_name'], region=cfg['region'])
+    left = cluster.release_if_idle(cfg.get('worker_keep_warm', KEEP_WARM))
+    if left == 0:
+        print('No jobs for a while: the worker pool has been deleted.')
+    elif left is not None:
+        print('The worker pool is kept warm for another {:.0f} minutes.'.format(left / 60.0))
@@ -0,0 +1,167 @@
+'''
+images.py: bake provisioned worker images.
+
+Rather than provisioning every worker as it boots, an image can be baked
+once: an instance is launched from the base image, provisioned, and saved
+as a new image, tagged with a hash of the contents of the provisioning
+script and the id of the base image. create_spot_pool() then launches from
+the baked image when there is one for the same script and base, so workers
+are ready as soon as they have booted, and xbow-provision skips them.
+'''
+from __future__ import print_function
+import hashlib
+import time
+import uuid
+import boto3
+
+HASH_TAG = 'xbow-provision-hash'
+BASE_TAG = 'xbow-base-image'
+
+def script_hash(filename):
+    '''
+    The hash of the contents of a provisioning script.
+    '''
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def provisioning_commands(filename):
+    '''
+    The commands in a provisioning script that are for workers, each run as
+    root, ignoring blank lines and comments. Lines after a "[scheduler]"
+    line are for the scheduler only, up to a "[workers]" or "[all]" line
+    (as for xbow-create_cluster).
+    '''
+    commands = []
+    for_worker = True
+    with open(filename, 'r') as f:
+        for line in f:
+            command = line.strip()
+            if command == '' or command[0] == '#':
+                continue
+            if command[0] == '[':
+                for_worker = not '[scheduler]' in command
+                continue
+            if not for_worker:
+                continue
+            if command.split()[0] != 'sudo':
+                command = 'sudo ' + command
+            commands.append(command)
+    return commands
+
+def find_baked_image(provision_hash, base_image_id, region=None):
+    '''
+    Find the newest image baked from a base image with a provisioning
+    script.
+
+    Args:
+        provision_hash (str): the hash of the script (see script_hash())
+        base_image_id (str): the image it was baked from
+        region (str, optional): The EC2 region
+
+    Returns:
+        str: the image id, or None if there is no such image
+    '''
+    client = boto3.client('ec2', region_name=region)
+    filters = [{'Name': 'tag:{}'.format(HASH_TAG), 'Values': [provision_hash]},
+               {'Name': 'tag:{}'.format(BASE_TAG), 'Values': [base_image_id]},
+               {'Name': 'state', 'Values': ['available']}]
+    images = client.describe_images(Owners=['self'], Filters=filters)['Images']
+    if len(images) == 0:
+        return None
+    images.sort(key=lambda image: image['CreationDate'])
+    return images[-1]['ImageId']
+
+def choose_image(image_id, provisioning_script=None, region=None):
+    '''
+    The image to launch workers from: the one baked from image_id with the
+    provisioning script, if there is one, else image_id itself.
+    '''
+    if provisioning_script is None:
+        return image_id
+    baked = find_baked_image(script_hash(provisioning_script), image_id,
+                             region=region)
+    if baked is None:
+        print('Warning: no image baked with {}; use xbow-bake to make one'.format(provisioning_script))
+        return image_id
+    return baked
+
+def is_baked(image_id, provisioning_script, region=None):
+    '''
+    Whether an image was baked with the given provisioning script.
+    '''
+    image = boto3.resource('ec2', region_name=region).Image(image_id)
+    tags = dict([(tag['Key'], tag['Value']) for tag in (image.tags or [])])
+    return tags.get(HASH_TAG) == script_hash(provisioning_script)
+
+def bake_image(provisioning_script, base_image_id, instance_type, key_name,
+               region=None, ec2_security_groups=None, provision=None,
+               name=None):
+    '''
+    Bake an image: launch an instance from the base image, provision it,
+    save it as a new image, and terminate the instance.
+
+    Args:
+        provisioning_script (str): the provisioning script
+        base_image_id (str): the image to start from
+        instance_type (str): the instance type to provision on
+        key_name (str): the key pair to launch the instance with
+        region (str, optional): The EC2 region
+        ec2_security_groups (list, optional): security groups for the
+            instance, which must allow ssh
+        provision (function, optional): called with the instance (a boto3
+            Instance, running) to provision it. By default each command in
+            the script is run over ssh, stopping at the first that fails.
+        name (str, optional): the name of the image
+
+    Returns:
+        str: the id of the new image
+    '''
+    if region is None:
+        region = boto3.session.Session().region_name
+    if region is None:
+        raise ValueError('Error - no region identified')
+    if provision is None:
+        provision = lambda instance: _run_script(instance, provisioning_script)
+    provision_hash = script_hash(provisioning_script)
+    ec2_resource = boto3.resource('ec2', region_name=region)
+    base = ec2_resource.Image(base_image_id)
+    tags = dict([(tag['Key'], tag['Value']) for tag in (base.tags or [])])
+    options = {}
+    if ec2_security_groups is not None:
+        options['SecurityGroups'] = ec2_security_groups
+    instance = ec2_resource.create_instances(ImageId=base_image_id,
+                                             InstanceType=instance_type,
+                                             KeyName=key_name,
+                                             ClientToken=str(uuid.uuid4()),
+                                             MaxCount=1, MinCount=1,
+                                             **options)[0]
+    try:
+        instance.wait_until_running()
+        instance.reload()
+        instance.create_tags(Tags=[{'Key': 'Name', 'Value': 'xbow-bake'},
+                                   {'Key': 'username', 'Value': tags.get('username', 'ubuntu')}])
+        provision(instance)
+        if name is None:
+            name = 'xbow-baked-{}-{}'.format(provision_hash[:12],
+                                             time.strftime('%Y%m%d%H%M%S'))
+        image = instance.create_image(Name=name,
+                                      Description='{} provisioned with script {}'.format(base_image_id, provision_hash))
+        tags.update({HASH_TAG: provision_hash, BASE_TAG: base_image_id,
+                     'Name': name})
+        image.create_tags(Tags=[{'Key': k, 'Value': v} for k, v in sorted(tags.items())])
+        waiter = ec2_resource.meta.client.get_waiter('image_available')
+        waiter.wait(ImageIds=[image.id])
+    finally:
+        instance.terminate()
+    return image.id
+
+def _run_script(instance, provisioning_script):
+    from .instances import ConnectedInstance
+    ci = ConnectedInstance(instance)
+    for command in provisioning_commands(provisioning_script):
+        print(command + ' : ', end='')
+        ci.exec_command(command)
+        if ci.exit_status != 0:
+            print('FAILED')
+            raise RuntimeError('Error - provisioning failed: {}'.format(ci.output))
+        print('OK')
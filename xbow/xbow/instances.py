@@ -195,7 +195,16 @@ class ConnectedInstance(object):
         sftp = paramiko.SFTPClient.from_transport(self.transport)
         sftp.get(remotefile, localfile)
         sftp.close()
-        
+
+    def open_sftp(self):
+        """
+        Open an SFTP session with the instance, for several transfers.
+
+        Returns:
+            paramiko.SFTPClient: the session; close it when done.
+        """
+        return paramiko.SFTPClient.from_transport(self.transport)
+
     def terminate(self):
         self.instance.terminate()
         
@@ -267,9 +276,15 @@ def create(name, image_id, instance_type, region=None,
                         )
     return instance
 
-def terminate_cluster(name, region=None):
+def terminate_cluster(name, region=None, instance_ids=None):
     """
     Terminates the cluster given by the name specified in settings.yml
+
+    Args:
+        name (str): the name of the cluster (or worker pool)
+        region (str, optional): The EC2 region
+        instance_ids (list, optional): terminate just these instances (and
+            cancel their spot requests), rather than the whole cluster
     """
     client = boto3.client('ec2', region_name=region)
     resource = boto3.resource('ec2', region_name=region)
@@ -278,16 +293,20 @@ def terminate_cluster(name, region=None):
     response = dsir(Filters=[{'Name': 'launch-group', 'Values': [name]}])
     spot_instance_request_ids = [s['SpotInstanceRequestId'] 
                                  for s in response['SpotInstanceRequests']
+                                 if instance_ids is None
+                                 or s.get('InstanceId') in instance_ids
                                 ]
 
-    if len(spot_instance_request_ids) > 1:
-        print('cancelling all spot requests')
+    if len(spot_instance_request_ids) > 0:
+        print('cancelling spot requests')
         csir =  client.cancel_spot_instance_requests
         csir(SpotInstanceRequestIds=spot_instance_request_ids, DryRun=False)
 
     filters = [{'Name': 'key-name', 'Values': [name]}, 
                {'Name': 'instance-state-name', 'Values': ['running']}
               ]
+    if instance_ids is not None:
+        filters.append({'Name': 'instance-id', 'Values': list(instance_ids)})
     instances = list(resource.instances.filter(Filters=filters))
 
     if len(instances) == 0:
@@ -0,0 +1,291 @@
+'''
+jobs.py: the jobs submitted from a local directory.
+
+Each xbow-submit from a directory adds a job to .xbow_ids.yml there: the
+name of its directory on the shared file system ('jobid') and its id in
+the job queue on the scheduler ('queue_id'), which is managed by the
+xflow-queue command of xbowflow.
+
+A job array (a parameter sweep) is one entry with a list of ids
+('queue_ids') and the names of its points ('points'): each point is a
+subdirectory holding what is particular to it, and the inputs shared by all
+of them are staged once, in the directory above, and linked into each
+point on the cluster.
+'''
+import glob
+import json
+import os
+import yaml
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+JOB_IDS_FILE = '.xbow_ids.yml'
+ARRAY_OUTPUT_FILE = 'xbow.out'
+ENDED = ['finished', 'failed', 'cancelled']
+
+def load_jobs(filename=JOB_IDS_FILE):
+    '''
+    Get the jobs submitted from this directory.
+
+    Returns:
+        list: a dict for each job, with keys 'jobid', 'queue_id' and
+            'command'
+    '''
+    try:
+        with open(filename, 'r') as f:
+            data = yaml.safe_load(f)
+    except IOError:
+        return []
+    if data is None:
+        return []
+    if 'jobid' in data:
+        # written by an older xbow, with one job per directory
+        return [{'jobid': str(data['jobid']), 'queue_id': None,
+                 'command': None}]
+    return data.get('jobs', [])
+
+def save_jobs(jobs, filename=JOB_IDS_FILE):
+    '''
+    Save the list of jobs submitted from this directory (or, if there are
+    none left, remove the file).
+    '''
+    if len(jobs) == 0:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return
+    with open(filename, 'w') as f:
+        yaml.safe_dump({'jobs': jobs}, f, default_flow_style=False)
+
+def add_job(job, filename=JOB_IDS_FILE):
+    '''
+    Add a job to the list of jobs submitted from this directory.
+    '''
+    jobs = load_jobs(filename)
+    jobs.append(job)
+    save_jobs(jobs, filename)
+
+def queue_ids(job):
+    '''
+    The ids in the queue of a job, or of each point of a job array.
+    '''
+    if 'queue_ids' in job:
+        return job['queue_ids']
+    return [job['queue_id']]
+
+def label(job):
+    '''
+    How a job is referred to: its id in the queue, or the range of ids of a
+    job array.
+    '''
+    ids = queue_ids(job)
+    if not 'queue_ids' in job:
+        return str(ids[0])
+    return '{}-{}'.format(ids[0], ids[-1])
+
+def summary(job, statuses):
+    '''
+    Summarise the state of a job, or of all the points of a job array.
+
+    Args:
+        job (dict): the job, as returned by load_jobs()
+        statuses (dict): as returned by job_status()
+
+    Returns:
+        tuple: whether the job (or every point) has ended, and a
+            description such as 'running' or '40 finished, 2 failed, 8 queued'
+    '''
+    states = [statuses.get(i, {}).get('state', 'unknown') for i in queue_ids(job)]
+    ended = all([state in ENDED for state in states])
+    if not 'queue_ids' in job:
+        return ended, states[0]
+    counts = []
+    for state in ['finished', 'failed', 'cancelled', 'running', 'queued', 'unknown']:
+        if states.count(state) > 0:
+            counts.append('{} {}'.format(states.count(state), state))
+    return ended, ', '.join(counts)
+
+def show_output(job, statuses, root='.'):
+    '''
+    Report the output of a job that has ended. For a job array, the output
+    of each point is saved in its local directory (as xbow.out) instead,
+    and the points that failed are listed.
+    '''
+    if not 'queue_ids' in job:
+        status = statuses[job['queue_id']]
+        print('\nOutput from remote command:')
+        print(status['output'])
+        print('Exit status: {}'.format(status['returncode']))
+        return
+    failed = []
+    for point, queue_id in zip(job['points'], job['queue_ids']):
+        status = statuses.get(queue_id)
+        if status is None:
+            continue
+        directory = os.path.join(root, point)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, ARRAY_OUTPUT_FILE), 'w') as f:
+            f.write(status['output'] or '')
+        if status['state'] != 'finished':
+            failed.append((point, status))
+    print('\nOutput from each point saved as {}'.format(os.path.join('<point>', ARRAY_OUTPUT_FILE)))
+    for point, status in failed:
+        print('    {}: {} (exit status {})'.format(point, status['state'], status['returncode']))
+
+def find_points(pattern, root='.'):
+    '''
+    Find the points of a job array: the subdirectories that match a glob
+    pattern.
+
+    Returns:
+        list: their paths relative to root, sorted
+    '''
+    points = [os.path.relpath(path, root)
+              for path in glob.glob(os.path.join(root, pattern))
+              if os.path.isdir(path)]
+    return sorted(points)
+
+def shared_inputs(points, root='.'):
+    '''
+    The entries in a directory that are not, and do not contain, any of the
+    points of a job array: the inputs the points share.
+    '''
+    shared = []
+    for name in sorted(os.listdir(root)):
+        if name == JOB_IDS_FILE:
+            continue
+        if any([point == name or point.startswith(name + os.sep) for point in points]):
+            continue
+        shared.append(name)
+    return shared
+
+def link_shared_inputs(ci, remote_dir, points, shared):
+    '''
+    Link the shared inputs of a job array (those that were staged) into the
+    directory of each point, unless the point has its own, in one command.
+    '''
+    if len(points) == 0 or len(shared) == 0:
+        return
+    command = ('cd {} && for p in {}; do for s in {}; do '
+               '[ -e "$s" ] && [ ! -e "$p/$s" ] && ln -s "$PWD/$s" "$p/$s"; '
+               'done; done; true').format(quote(remote_dir),
+                                          ' '.join([quote(p) for p in points]),
+                                          ' '.join([quote(s) for s in shared]))
+    ci.exec_command(command)
+    if ci.exit_status != 0:
+        raise RuntimeError('Error - cannot link the shared inputs: {}'.format(ci.output))
+
+def submit_job(ci, directory, command, priority=0, max_running=None,
+               cores=None):
+    '''
+    Add a job to the queue on the scheduler.
+
+    Args:
+        ci (ConnectedInstance): the scheduler
+        directory (str): the directory on the scheduler to run the job in
+        command (str): the command
+        priority (int, optional): jobs with higher priority run first
+        max_running (int, optional): the most jobs to run at once, if the
+            queue's dispatcher needs to be started
+        cores (int, optional): the cores the job needs (by default, all of
+            a worker's)
+
+    Returns:
+        int: the job's id in the queue
+    '''
+    options = '--directory {} --priority {}'.format(quote(directory), int(priority))
+    if max_running is not None:
+        options += ' --max-running {}'.format(int(max_running))
+    if cores is not None:
+        options += ' --cores {}'.format(int(cores))
+    ci.exec_command('xflow-queue submit {} {}'.format(options, quote(command)))
+    if ci.exit_status != 0:
+        raise RuntimeError('Error - job submission failed: {}'.format(ci.output))
+    return int(ci.output.strip().split('\n')[-1])
+
+def submit_array(ci, directory, command, points, priority=0, max_running=None,
+                 cores=None):
+    '''
+    Add a job array to the queue on the scheduler, in one call.
+
+    Args:
+        ci (ConnectedInstance): the scheduler
+        directory (str): the directory on the scheduler the points are
+            subdirectories of
+        command (str): the command to run in each; any "{point}" in it is
+            replaced by the name of the point
+        points (list): the names of the points
+        priority (int, optional): jobs with higher priority run first
+        max_running (int, optional): the most jobs to run at once, if the
+            queue's dispatcher needs to be started
+        cores (int, optional): the cores each point needs (by default, all
+            of a worker's)
+
+    Returns:
+        list: the id in the queue of each point
+    '''
+    options = '--array --directory {} --priority {}'.format(quote(directory), int(priority))
+    if max_running is not None:
+        options += ' --max-running {}'.format(int(max_running))
+    if cores is not None:
+        options += ' --cores {}'.format(int(cores))
+    ci.exec_command("printf '%s\\n' {} | xflow-queue submit {} {}".format(
+        ' '.join([quote(p) for p in points]), options, quote(command)))
+    if ci.exit_status != 0:
+        raise RuntimeError('Error - job submission failed: {}'.format(ci.output))
+    ids = [int(line) for line in ci.output.split('\n') if line.strip().isdigit()]
+    if len(ids) != len(points):
+        raise RuntimeError('Error - job submission failed: {}'.format(ci.output))
+    return ids
+
+def job_status(ci, queue_ids, output=False):
+    '''
+    Get the state of a number of jobs, in one query.
+
+    Args:
+        ci (ConnectedInstance): the scheduler
+        queue_ids (list): the ids of the jobs in the queue
+        output (bool, optional): include the output of jobs that have ended
+
+    Returns:
+        dict: the state of each job, keyed by id (see the xbowflow jobqueue
+            module). Jobs the queue does not know about are left out.
+    '''
+    queue_ids = [int(i) for i in queue_ids if i is not None]
+    if len(queue_ids) == 0:
+        return {}
+    command = 'xflow-queue status --json {}'.format(' '.join([str(i) for i in queue_ids]))
+    if output:
+        command += ' --output'
+    ci.exec_command(command)
+    if ci.exit_status != 0:
+        raise RuntimeError('Error - cannot get the job status: {}'.format(ci.output))
+    return dict([(job['id'], job) for job in json.loads(ci.output.strip().split('\n')[-1])])
+
+def queued_jobs(ci):
+    '''
+    The jobs in the queue on the scheduler that are waiting to be started
+    (and so are not yet tasks on the dask cluster).
+
+    Returns:
+        list: the state of each (see job_status())
+    '''
+    ci.exec_command('xflow-queue status --json --state queued')
+    if ci.exit_status != 0:
+        raise RuntimeError('Error - cannot query the job queue: {}'.format(ci.output))
+    return json.loads(ci.output.strip().split('\n')[-1])
+
+def queue_idle_time(ci):
+    '''
+    How long the job queue on the scheduler has been idle.
+
+    Returns:
+        float: 0 if any job is queued or running, else the seconds since the
+            last job ended, or None if no job has ended yet
+    '''
+    ci.exec_command('xflow-queue idle')
+    if ci.exit_status != 0:
+        raise RuntimeError('Error - cannot query the job queue: {}'.format(ci.output))
+    return json.loads(ci.output.strip().split('\n')[-1])
@@ -0,0 +1,172 @@
+import boto3
+import time
+
+from .metering import SpotPriceHistory
+
+def instance_vcpus(instance_types, region=None):
+    """
+    Get the number of vCPUs of each of a list of instance types.
+
+    Args:
+        instance_types (list): EC2 instance types
+        region (str, optional): The EC2 region
+
+    Returns:
+        dict: vCPUs, keyed by instance type
+    """
+    ec2_client = boto3.client('ec2', region_name=region)
+    response = ec2_client.describe_instance_types(InstanceTypes=list(instance_types))
+    return dict([(t['InstanceType'], t['VCpuInfo']['DefaultVCpus'])
+                 for t in response['InstanceTypes']])
+
+def availability_zones(region=None):
+    """
+    Get the names of the availability zones in a region.
+    """
+    ec2_client = boto3.client('ec2', region_name=region)
+    response = ec2_client.describe_availability_zones(Filters=[{'Name': 'state', 'Values': ['available']}])
+    return [z['ZoneName'] for z in response['AvailabilityZones']]
+
+def worker_zones(setting=None, scheduler=None, region=None):
+    """
+    Get the candidate availability zones for workers.
+
+    Args:
+        setting (list or str, optional): the 'worker_zones' setting: a list
+            of zones, or 'all' for every zone in the region
+        scheduler (boto3 Instance, optional): the scheduler. If there is no
+            setting, workers are kept in its zone, so that traffic between
+            them, the scheduler and the shared file system stays in one
+            zone.
+        region (str, optional): The EC2 region
+
+    Returns:
+        list: the zones, or None if there is neither a setting nor a
+            scheduler
+    """
+    if setting == 'all':
+        return availability_zones(region)
+    if setting is not None:
+        if not isinstance(setting, list):
+            setting = [setting]
+        return setting
+    if scheduler is not None:
+        return [scheduler.placement['AvailabilityZone']]
+    return None
+
+def only_market(instance_types, zones=None):
+    """
+    The spot market to use when there is no choice to make: one instance
+    type, and one availability zone or none (when EC2 chooses the zone).
+    Ranking markets needs the spot price history, and permission to read
+    it, so choose_market() is only worth calling when there is a choice.
+
+    Args:
+        instance_types (str or list): candidate EC2 instance types
+        zones (list, optional): candidate availability zones
+
+    Returns:
+        tuple: (instance type, availability zone or None), or None if there
+            is a choice to make
+    """
+    if not isinstance(instance_types, list):
+        instance_types = [instance_types]
+    if len(instance_types) != 1:
+        return None
+    if zones is None:
+        return instance_types[0], None
+    if len(zones) == 1:
+        return instance_types[0], zones[0]
+    return None
+
+def rank_markets(history, instance_types, zones, capacity, window=86400,
+                 max_price=None, now=None):
+    """
+    Rank spot markets (instance type and availability zone combinations)
+    by price per unit of capacity.
+
+    Each market is scored on the higher of its current spot price and its
+    mean price over the window, so a market that is briefly cheap but
+    usually expensive is not favoured.
+
+    Args:
+        history (SpotPriceHistory): where to get spot prices from
+        instance_types (list): candidate EC2 instance types
+        zones (list): candidate availability zones
+        capacity (dict): the capacity of each instance type, e.g. its
+            vCPUs, or its benchmarked throughput (e.g. ns/day)
+        window (float, optional): the period, in seconds, to average the
+            price over
+        max_price (float, optional): leave out markets whose current price
+            is higher than this
+        now (float, optional): the time to rank the markets at (default
+            the current time)
+
+    Returns:
+        list: a dict for each market, best first, with keys
+            'instance_type', 'availability_zone', 'price' (current),
+            'mean_price', 'capacity' and 'score' (dollars per hour per unit
+            of capacity). Markets with no price data are left out.
+    """
+    if now is None:
+        now = time.time()
+    start = now - window
+    history.update(instance_types, zones, start, now)
+    markets = []
+    for instance_type in instance_types:
+        if not instance_type in capacity:
+            raise ValueError('Error - no capacity given for {}'.format(instance_type))
+        for zone in zones:
+            try:
+                series = history.series(instance_type, zone, start, now)
+            except ValueError:
+                continue
+            price = series.price_at(now)
+            mean_price = series.cost(start, now) * 3600.0 / window
+            if max_price is not None and price > float(max_price):
+                continue
+            markets.append({'instance_type': instance_type,
+                            'availability_zone': zone,
+                            'price': price,
+                            'mean_price': mean_price,
+                            'capacity': capacity[instance_type],
+                            'score': max(price, mean_price) / capacity[instance_type]})
+    markets.sort(key=lambda m: m['score'])
+    return markets
+
+def choose_market(instance_types, zones=None, throughput=None, max_price=None,
+                  region=None, history=None, window=86400):
+    """
+    Choose the spot market with the best capacity per dollar.
+
+    Args:
+        instance_types (str or list): candidate EC2 instance types
+        zones (list, optional): candidate availability zones. The default is
+            all those in the region.
+        throughput (dict, optional): benchmarked throughput of each
+            instance type (e.g. ns/day for your simulation). If not given,
+            instance types are compared on their vCPUs.
+        max_price (float, optional): the most to pay, per instance per hour
+        region (str, optional): The EC2 region
+        history (SpotPriceHistory, optional): where to get spot prices from
+        window (float, optional): the period, in seconds, to average the
+            price over
+
+    Returns:
+        tuple: (instance type, availability zone)
+    """
+    if not isinstance(instance_types, list):
+        instance_types = [instance_types]
+    if zones is None:
+        zones = availability_zones(region)
+    if throughput is None:
+        capacity = instance_vcpus(instance_types, region)
+    else:
+        capacity = throughput
+    if history is None:
+        history = SpotPriceHistory(region=region)
+    markets = rank_markets(history, instance_types, zones, capacity,
+                           window=window, max_price=max_price)
+    if len(markets) == 0:
+        raise ValueError('Error - no spot market for {} at or below the price {}'.format(instance_types, max_price))
+    return markets[0]['instance_type'], markets[0]['availability_zone']
@@ -1,12 +1,21 @@
 import boto3
+import bisect
 import datetime
+import json
+import os
+import tempfile
+import time
 import xbow
 
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+PRICE_HISTORY_FILE = os.path.join(xbow.XBOW_CONFIGDIR, 'spot_price_history.json')
+
 class SpotMeter(object):
     """
     APPROXIMATE cost meter for a spot instance.
     """
-    def __init__(self, instance_type, availability_zone, count = 1):
+    def __init__(self, instance_type, availability_zone, count = 1,
+                 region=None, history=None):
         """
         initialise the meter.
 
@@ -14,22 +23,19 @@ class SpotMeter(object):
             instance_type (str): The EC2 instance type
             availability_zone (str): The EC2 availability zone
             count (int): The number of instances - multiplier for all costs
+            region (str, optional): The EC2 region. If not specified the
+                value in the boto3 configuration file is used.
+            history (SpotPriceHistory, optional): where to get spot prices
+                from. By default, the store in the xbow configuration
+                directory is used.
         """
         self.instance_type = instance_type
         self.availability_zone = availability_zone
         self.count = count
-        self.ec2_resource = boto3.resource('ec2')
-        dph = self.ec2_resource.meta.client.describe_spot_price_history
-        data = dph(InstanceTypes=[instance_type],
-                   StartTime=datetime.datetime.now(),
-                   Filters=[{'Name': 'product-description',
-                             'Values':['Linux/UNIX']},
-                            {'Name': 'availability-zone',
-                             'Values': [availability_zone]}
-                           ]
-                  )
-
-        self.tz = data['SpotPriceHistory'][0]['Timestamp'].tzinfo
+        if history is None:
+            history = SpotPriceHistory(region=region)
+        self.history = history
+        self.tz = datetime.timezone.utc
         self.start_time = datetime.datetime.now(self.tz)
 
     def current_price(self):
@@ -41,19 +47,10 @@ class SpotMeter(object):
         Returns:
             price (float): The current spot price in US dollars per hour.
         """
-
-        dph = self.ec2_resource.meta.client.describe_spot_price_history
-        data = dph(InstanceTypes=[instance_type],
-                   StartTime=datetime.datetime.now(),
-                   Filters=[{'Name': 'product-description',
-                             'Values':['Linux/UNIX']},
-                            {'Name': 'availability-zone',
-                             'Values': [self.availability_zone]}
-                           ]
-                  )
-
-        spot_price = float(data['SpotPriceHistory'][0]['SpotPrice'])
-        return spot_price * self.count
+        now = time.time()
+        series = self.history.series(self.instance_type,
+                                     self.availability_zone, now, now)
+        return series.price_at(now) * self.count
 
     def total_cost(self):
         """
@@ -62,27 +59,11 @@ class SpotMeter(object):
         Returns:
             cost (float): The total cost in US dollars.
         """
-        dph = self.ec2_resource.meta.client.describe_spot_price_history
-        data = dph(InstanceTypes=[instance_type],
-                   EndTime=datetime.datetime.now(self.tz),
-                   StartTime=self.start_time,
-                   Filters=[{'Name': 'product-description',
-                             'Values':['Linux/UNIX']},
-                            {'Name': 'availability-zone',
-                             'Values': [self.availability_zone]}
-                           ]
-                  )
-        costsum = 0
-        then = datetime.datetime.now(self.tz)
-        for d in data['SpotPriceHistory']:
-            now = then
-            then = d['Timestamp']
-            if then < self.start_time:
-                then = self.start_time
-            period = (now - then).seconds / 3600.0
-            costsum += period * float(d['SpotPrice'])
-
-        return costsum * self.count
+        now = time.time()
+        series = self.history.series(self.instance_type,
+                                     self.availability_zone,
+                                     self.start_time, now)
+        return series.cost(self.start_time, now) * self.count
 
     def total_time(self):
         """
@@ -92,4 +73,329 @@ class SpotMeter(object):
             time (float): total time in hours.
         """
         period = datetime.datetime.now(self.tz) - self.start_time
-        return period.seconds / 3600.0
+        return period.total_seconds() / 3600.0
+
+def _epoch(t):
+    """
+    Convert a datetime (or a number of seconds since the epoch) to seconds
+    since the epoch.
+    """
+    if isinstance(t, datetime.datetime):
+        if t.tzinfo is None:
+            return time.mktime(t.timetuple()) + t.microsecond / 1e6
+        return (t - EPOCH).total_seconds()
+    return float(t)
+
+def _datetime(t):
+    """
+    Convert seconds since the epoch (or a datetime) to a UTC datetime.
+    """
+    return datetime.datetime.fromtimestamp(_epoch(t), datetime.timezone.utc)
+
+class PriceSeries(object):
+    """
+    The spot price of an instance type over time, as a step function.
+    """
+    def __init__(self, points):
+        """
+        Args:
+            points (list): (time, price) tuples. Times are datetimes or
+                seconds since the epoch, prices are in US dollars per hour.
+                Each price holds until the time of the next point.
+        """
+        points = sorted([(_epoch(t), float(p)) for t, p in points])
+        if len(points) == 0:
+            raise ValueError('Error - no spot price data')
+        self.times = [p[0] for p in points]
+        self.prices = [p[1] for p in points]
+        self.cumulative = [0.0]
+        for i in range(1, len(points)):
+            dt = self.times[i] - self.times[i - 1]
+            self.cumulative.append(self.cumulative[-1] + dt * self.prices[i - 1] / 3600.0)
+
+    def price_at(self, t):
+        """
+        The spot price (dollars per hour) at time t. Times before the
+        first point get the first price.
+        """
+        i = bisect.bisect_right(self.times, _epoch(t)) - 1
+        return self.prices[max(i, 0)]
+
+    def _integral(self, t):
+        """
+        Cost of one instance from the first point to time t.
+        """
+        i = bisect.bisect_right(self.times, t) - 1
+        if i < 0:
+            return (t - self.times[0]) * self.prices[0] / 3600.0
+        return self.cumulative[i] + (t - self.times[i]) * self.prices[i] / 3600.0
+
+    def cost(self, start, end):
+        """
+        The cost (in dollars) of running one instance from start to end.
+        """
+        return self._integral(_epoch(end)) - self._integral(_epoch(start))
+
+def _fetch_points(ec2_client, instance_types, availability_zones, start, end):
+    """
+    Get spot price history for several instance types and availability
+    zones from EC2, in one paginated query.
+
+    Returns:
+        dict: lists of (time, price) tuples, keyed by (instance type,
+            availability zone)
+    """
+    paginator = ec2_client.get_paginator('describe_spot_price_history')
+    points = {}
+    for page in paginator.paginate(InstanceTypes=list(instance_types),
+                                   StartTime=_datetime(start),
+                                   EndTime=_datetime(end),
+                                   Filters=[{'Name': 'product-description',
+                                             'Values':['Linux/UNIX']},
+                                            {'Name': 'availability-zone',
+                                             'Values': list(availability_zones)}
+                                           ]):
+        for d in page['SpotPriceHistory']:
+            key = (d['InstanceType'], d['AvailabilityZone'])
+            points.setdefault(key, []).append((_epoch(d['Timestamp']),
+                                               float(d['SpotPrice'])))
+    return points
+
+class SpotPriceHistory(object):
+    """
+    A local store of spot price history, that persists between runs.
+
+    Only the price points that are not already held are fetched from EC2,
+    so repeated queries (e.g. a SpotMeter's total_cost()) are cheap.
+    """
+    def __init__(self, filename=None, region=None, max_age=300):
+        """
+        Load the store.
+
+        Args:
+            filename (str, optional): the file the store is kept in. The
+                default is spot_price_history.json in the xbow
+                configuration directory.
+            region (str, optional): The EC2 region. If not specified the
+                value in the boto3 configuration file is used.
+            max_age (float, optional): how old (in seconds) the newest data
+                can be before the store fetches more.
+        """
+        if region is None:
+            region = boto3.session.Session().region_name
+        if region is None:
+            raise ValueError('Error - no region identified')
+        self.region = region
+        if filename is None:
+            filename = PRICE_HISTORY_FILE
+        self.filename = filename
+        self.max_age = max_age
+        self.data = {}
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                self.data = json.load(f)
+        self._series = {}
+        self._ec2_client = None
+
+    def _key(self, instance_type, availability_zone):
+        return '{}/{}/{}'.format(self.region, instance_type, availability_zone)
+
+    def update(self, instance_types, availability_zones, start=None, end=None):
+        """
+        Make sure the store holds prices for every combination of the given
+        instance types and availability zones, from start to end, fetching
+        only what is missing.
+
+        Args:
+            instance_types (list): EC2 instance types
+            availability_zones (list): EC2 availability zones
+            start (datetime or float, optional): default is end
+            end (datetime or float, optional): default is now
+        """
+        now = time.time()
+        if end is None:
+            end = now
+        end = min(_epoch(end), now)
+        if start is None:
+            start = end
+        start = min(_epoch(start), end)
+        keys = [(it, az) for it in instance_types for az in availability_zones]
+        t0 = None
+        t1 = None
+        for it, az in keys:
+            entry = self.data.get(self._key(it, az))
+            if entry is None:
+                gaps = [(start, end)]
+            else:
+                gaps = []
+                if start < entry['since']:
+                    gaps.append((start, entry['since']))
+                if end - entry['until'] > self.max_age:
+                    gaps.append((entry['until'], end))
+            for gap in gaps:
+                if t0 is None or gap[0] < t0:
+                    t0 = gap[0]
+                if t1 is None or gap[1] > t1:
+                    t1 = gap[1]
+        if t0 is None:
+            return
+        if self._ec2_client is None:
+            self._ec2_client = boto3.client('ec2', region_name=self.region)
+        points = _fetch_points(self._ec2_client, instance_types,
+                               availability_zones, t0, t1)
+        for it, az in keys:
+            key = self._key(it, az)
+            entry = self.data.get(key, {'points': [], 'since': t0, 'until': t1})
+            merged = set([tuple(p) for p in entry['points']])
+            merged.update(points.get((it, az), []))
+            entry['points'] = sorted(merged)
+            entry['since'] = min(entry['since'], t0)
+            entry['until'] = max(entry['until'], t1)
+            self.data[key] = entry
+            self._series.pop(key, None)
+        self.save()
+
+    def save(self):
+        """
+        Write the store to its file.
+        """
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp_path = tempfile.NamedTemporaryFile(dir=dirname, suffix='.json',
+                                               delete=False).name
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.rename(tmp_path, self.filename)
+
+    def series(self, instance_type, availability_zone, start=None, end=None):
+        """
+        The price series for an instance type in an availability zone,
+        updated to cover start to end (see update()).
+
+        Returns:
+            PriceSeries
+        """
+        self.update([instance_type], [availability_zone], start, end)
+        key = self._key(instance_type, availability_zone)
+        if not key in self._series:
+            self._series[key] = PriceSeries(self.data[key]['points'])
+        return self._series[key]
+
+    def cost(self, instance_type, availability_zone, start, end):
+        """
+        The cost (in dollars) of running one instance from start to end.
+        """
+        series = self.series(instance_type, availability_zone, start, end)
+        return series.cost(start, end)
+
+def cost_report(records, prices, slots=1, start=None, end=None,
+                idle_threshold=0.25):
+    """
+    Attribute the cost of a cluster to the tasks that ran on it.
+
+    Each task is charged for its duration, at the spot price of the instance
+    it ran on at the time it ran, in proportion to the share of the instance
+    it used (the cores it declared, out of the instance's slots). The rest
+    of what was paid for each instance is idle time.
+
+    Args:
+        records (list): TIMINGS records from xbowflow kernels
+        prices (PriceSeries or dict): the price series for the instances,
+            or a dict mapping worker host names to price series
+        slots (int): the number of tasks each instance can run at once
+            (e.g. its vCPUs)
+        start, end (datetime or float, optional): the period each instance
+            was paid for. By default, from the start of its first task to
+            the end of its last.
+        idle_threshold (float): flag hosts idle for more than this
+            fraction of the paid time
+
+    Returns:
+        dict: with keys:
+            'kernels': for each kernel, its 'count', 'seconds', 'cost' and
+                'fraction' of the total task cost
+            'hosts': for each host, its 'paid_cost', 'task_cost',
+                'idle_cost', 'idle_fraction' and 'flagged'
+            'task_cost', 'paid_cost', 'idle_cost': totals
+            'dominant': the kernel that cost most
+    """
+    def series(host):
+        if isinstance(prices, PriceSeries):
+            return prices
+        if not host in prices:
+            raise ValueError('Error - no price series for host {}'.format(host))
+        return prices[host]
+
+    kernels = {}
+    hosts = {}
+    for rec in records:
+        if rec is None:
+            continue
+        share = min(float(rec.get('cores', 1)) / slots, 1.0)
+        cost = series(rec['host']).cost(rec['start'], rec['end']) * share
+        k = kernels.setdefault(rec['kernel'], {'count': 0, 'seconds': 0.0,
+                                               'cost': 0.0})
+        k['count'] += 1
+        k['seconds'] += rec['end'] - rec['start']
+        k['cost'] += cost
+        h = hosts.setdefault(rec['host'], {'task_cost': 0.0,
+                                           'start': rec['start'],
+                                           'end': rec['end']})
+        h['task_cost'] += cost
+        h['start'] = min(h['start'], rec['start'])
+        h['end'] = max(h['end'], rec['end'])
+
+    task_cost = sum([k['cost'] for k in kernels.values()])
+    for name in kernels:
+        kernels[name]['fraction'] = 0.0
+        if task_cost > 0:
+            kernels[name]['fraction'] = kernels[name]['cost'] / task_cost
+    for host in hosts:
+        h = hosts[host]
+        paid_from = h.pop('start')
+        paid_to = h.pop('end')
+        if start is not None:
+            paid_from = _epoch(start)
+        if end is not None:
+            paid_to = _epoch(end)
+        h['paid_cost'] = series(host).cost(paid_from, paid_to)
+        h['idle_cost'] = max(h['paid_cost'] - h['task_cost'], 0.0)
+        h['idle_fraction'] = 0.0
+        if h['paid_cost'] > 0:
+            h['idle_fraction'] = h['idle_cost'] / h['paid_cost']
+        h['flagged'] = h['idle_fraction'] > idle_threshold
+
+    dominant = None
+    if len(kernels) > 0:
+        dominant = max(kernels, key=lambda k: kernels[k]['cost'])
+    return {'kernels': kernels,
+            'hosts': hosts,
+            'task_cost': task_cost,
+            'paid_cost': sum([h['paid_cost'] for h in hosts.values()]),
+            'idle_cost': sum([h['idle_cost'] for h in hosts.values()]),
+            'dominant': dominant}
+
+def format_cost_report(report):
+    """
+    Format a cost report (see cost_report()) as text.
+    """
+    lines = ['{:20s} {:>6s} {:>12s} {:>10s} {:>6s}'.format('Kernel', 'runs',
+             'task-hours', 'cost ($)', '%')]
+    kernels = report['kernels']
+    for name in sorted(kernels, key=lambda k: -kernels[k]['cost']):
+        k = kernels[name]
+        lines.append('{:20s} {:6d} {:12.3f} {:10.4f} {:6.1f}'.format(name,
+                     k['count'], k['seconds'] / 3600.0, k['cost'],
+                     k['fraction'] * 100))
+    lines.append('')
+    lines.append('Task cost:  ${:.4f}'.format(report['task_cost']))
+    lines.append('Paid cost:  ${:.4f}'.format(report['paid_cost']))
+    lines.append('Idle cost:  ${:.4f}'.format(report['idle_cost']))
+    if report['dominant'] is not None:
+        lines.append('Most costly kernel: {}'.format(report['dominant']))
+    for host in sorted(report['hosts']):
+        h = report['hosts'][host]
+        if h['flagged']:
+            lines.append('Warning: {} was idle for {:.0%} of the time paid for'.format(host, h['idle_fraction']))
+    return '\n'.join(lines)
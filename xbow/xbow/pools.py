@@ -7,12 +7,15 @@ import time
 import xbow
 
 from .metering import SpotMeter
+from .markets import choose_market, only_market
+from .images import choose_image
 from .instances import ConnectedInstance
 
 def create_spot_pool(name, count=1, price=1.0, image_id=None, region=None,
                      instance_type=None, user_data=None,
                      ec2_security_groups=None, username=None,
-                     append=False, wait=True):
+                     append=False, wait=True, availability_zone=None,
+                     zones=None, throughput=None, provisioning_script=None):
     """
     Creates an instance of a SpotInstancePool.
 
@@ -24,6 +27,8 @@ def create_spot_pool(name, count=1, price=1.0, image_id=None, region=None,
         image_id (str): The AMI to use.
         region (str, optional): The EC2 region to create instances in. If not
             specified the value in tbe boto3 configuration file is used.
+        instance_type (str or list): The instance type, or a list of
+            candidate instance types.
         security_groups (list): List of security groups for the instance.
         username (str, optional): The username to connect to the instance. If
             not supplied, an attempt will be name to find it from the tags
@@ -32,6 +37,25 @@ def create_spot_pool(name, count=1, price=1.0, image_id=None, region=None,
         append (bool, default False): Append these instances to an existing
             spot pool, if there is one.
         wait (bool, default True): Block until the pool is up and ready.
+        availability_zone (str, optional): The availability zone to launch
+            the instances in.
+        zones (list, optional): If availability_zone is not given, the
+            candidate availability zones: the instance type (from the
+            candidates) and availability zone with the best capacity per
+            dollar are chosen from these, using recent spot price history.
+            If neither is given, EC2 chooses the zone, unless there is a
+            list of instance types, which are then compared in every zone
+            in the region. With one instance type and one zone (or none),
+            the instances are requested directly, without looking at
+            prices. Workers in a different zone from the scheduler
+            and the shared file system cost cross-zone traffic, so callers
+            usually pass the scheduler's zone (see markets.worker_zones()).
+        throughput (dict, optional): The benchmarked throughput of each
+            candidate instance type (e.g. ns/day), used to compare them.
+            By default they are compared on their vCPUs.
+        provisioning_script (str, optional): If an image has been baked
+            from image_id with this script (see xbow-bake), launch from
+            that instead.
 
     Returns:
         SpotInstancePool
@@ -60,6 +84,8 @@ def create_spot_pool(name, count=1, price=1.0, image_id=None, region=None,
     if not os.path.exists(pem_file):
         raise RuntimeError('Error - cannot find key file {}'.format(pem_file))
 
+    image_id = choose_image(image_id, provisioning_script, region=region)
+
     if username is None:
         image = ec2_resource.Image(image_id)
         tagdict = {}
@@ -67,6 +93,15 @@ def create_spot_pool(name, count=1, price=1.0, image_id=None, region=None,
             tagdict[tag['Key']] = tag['Value']
         username = tagdict.get('username')
 
+    if availability_zone is not None:
+        zones = [availability_zone]
+    market = only_market(instance_type, zones)
+    if market is None:
+        market = choose_market(instance_type, zones=zones,
+                               throughput=throughput, max_price=price,
+                               region=region)
+    instance_type, availability_zone = market
+
     rsi = ec2_client.request_spot_instances
 
     if sys.version_info > (3, 0):
@@ -74,18 +109,21 @@ def create_spot_pool(name, count=1, price=1.0, image_id=None, region=None,
     elif sys.version_info[:2] <= (2, 7):
         use_the_data = base64.b64encode(user_data)
 
+    launch_specification = {
+                            'SecurityGroups': ec2_security_groups,
+                            'ImageId': image_id,
+                            'InstanceType': instance_type,
+                            'KeyName': key_name,
+                            'UserData': use_the_data
+                           }
+    if availability_zone is not None:
+        launch_specification['Placement'] = {'AvailabilityZone': availability_zone}
     response = rsi(ClientToken=str(uuid.uuid4()),
                    InstanceCount=count,
                    SpotPrice=price,
                    Type='persistent',
                    LaunchGroup=launch_group,
-                   LaunchSpecification={
-                                        'SecurityGroups': ec2_security_groups,
-                                        'ImageId': image_id,
-                                        'InstanceType': instance_type,
-                                        'KeyName': key_name,
-                                        'UserData': use_the_data
-                                       })
+                   LaunchSpecification=launch_specification)
         
     if wait:
         waiter = ec2_client.get_waiter('spot_instance_request_fulfilled')
@@ -281,7 +319,8 @@ class SpotInstancePool(object):
 
         az = response['SpotInstanceRequests'][0]['LaunchSpecification']['Placement']['AvailabilityZone']
         instance_type = response['SpotInstanceRequests'][0]['LaunchSpecification']['InstanceType']
-        self.meter = SpotMeter(instance_type, az, count=self.instance_count)
+        self.meter = SpotMeter(instance_type, az, count=self.instance_count,
+                               region=region)
         self.launch_group = name
         self.key_name = name
         self.kp = self.ec2_resource.KeyPair(self.key_name)
@@ -0,0 +1,157 @@
+'''
+provisioning.py: run a provisioning script on the nodes of an xbow cluster.
+
+Each node is sent the whole script at once, as a shell script, and runs it
+independently of the others, all at the same time, so a slow node holds up
+no one but itself. Output is streamed back line by line as it is produced,
+and the result for each node (and, if it failed, the command that failed)
+is recorded, so that a later run can be limited to the nodes that failed.
+'''
+from __future__ import print_function
+import os
+import sys
+import json
+import threading
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+import xbow
+
+STATE_FILE = os.path.join(xbow.XBOW_CONFIGDIR, 'provision_state.json')
+# printed before each command runs, so a failure can be traced to it
+MARKER = '>>> '
+OUTPUT_LINES = 20
+
+_print_lock = threading.Lock()
+
+def shell_script(filename):
+    '''
+    Turn a provisioning script into a shell script that stops at the first
+    command that fails.
+
+    Each line of the provisioning script is a shell command, run as root
+    ('sudo' is added to the start of each if needed). Lines that begin
+    with # are echoed, and blank lines are ignored.
+    '''
+    lines = ['set -e',
+             '# already root: sudo is not needed (and may not be installed)',
+             'if [ "$(id -u)" = 0 ]; then sudo() { "$@"; }; fi']
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line == '':
+                continue
+            if line[0] == '#':
+                lines.append('echo {}'.format(quote(line)))
+                continue
+            if line.split()[0] != 'sudo':
+                line = 'sudo ' + line
+            lines.append('echo {}'.format(quote(MARKER + line)))
+            lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+def print_line(label, line):
+    '''
+    A log callback that prints each line of output prefixed with the node
+    it came from.
+    '''
+    with _print_lock:
+        print('[{}] {}'.format(label, line))
+        sys.stdout.flush()
+
+def provision_node(ci, script, label=None, log=None):
+    '''
+    Run a shell script (see shell_script()) on one node.
+
+    Args:
+        ci (ConnectedInstance): the node
+        script (str): the shell script
+        label (str, optional): how the node is named in the log
+        log (function, optional): called with the label and each line of
+            output as it arrives (e.g. print_line)
+
+    Returns:
+        dict: 'status' ('ok' or 'failed'), 'exit_status', 'failed_command'
+            (or None) and 'output' (the last few lines)
+    '''
+    channel = ci.transport.open_session()
+    # copy the script to a file first, then run it, so that commands which
+    # read stdin cannot swallow the rest of the script
+    channel.exec_command('f=$(mktemp /tmp/xbow-provision.XXXXXX) && cat > "$f" && '
+                         'bash "$f" < /dev/null 2>&1; s=$?; rm -f "$f"; exit $s')
+    stream = channel.makefile('wb')
+    stream.write(script.encode('utf-8'))
+    stream.close()
+    channel.shutdown_write()
+    command = None
+    output = []
+    for raw in channel.makefile('rb'):
+        line = raw.decode('utf-8', 'replace').rstrip('\r\n')
+        if line.startswith(MARKER):
+            command = line[len(MARKER):]
+        output = (output + [line])[-OUTPUT_LINES:]
+        if log is not None:
+            log(label, line)
+    exit_status = channel.recv_exit_status()
+    if exit_status == 0:
+        return {'status': 'ok', 'exit_status': 0, 'failed_command': None,
+                'output': output}
+    return {'status': 'failed', 'exit_status': exit_status,
+            'failed_command': command, 'output': output}
+
+def provision_nodes(nodes, script, connect, log=None):
+    '''
+    Run a shell script on a number of nodes at once, each independently.
+
+    Args:
+        nodes (dict): the nodes, as (label, instance) tuples keyed by
+            instance id
+        script (str): the shell script (see shell_script())
+        connect (function): makes a ConnectedInstance from an instance;
+            this is done for each node in parallel too
+        log (function, optional): as for provision_node()
+
+    Returns:
+        dict: the result for each node (see provision_node()), keyed by
+            instance id. A node that cannot be connected to has failed.
+    '''
+    results = {}
+    def run(key, label, instance):
+        try:
+            ci = connect(instance)
+            results[key] = provision_node(ci, script, label=label, log=log)
+        except Exception as e:
+            results[key] = {'status': 'failed', 'exit_status': None,
+                            'failed_command': None, 'output': [str(e)]}
+        results[key]['label'] = label
+    threads = [threading.Thread(target=run, args=(key, label, instance))
+               for key, (label, instance) in sorted(nodes.items())]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def load_state(filename=STATE_FILE):
+    '''
+    The results of the last provisioning run: a dict with the 'hash' of the
+    script and the result for each node ('nodes', keyed by instance id).
+    '''
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'hash': None, 'nodes': {}}
+
+def save_state(state, filename=STATE_FILE):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.rename(filename + '.tmp', filename)
+
+def failed_nodes(state):
+    '''
+    The instance ids of the nodes that failed in the last run.
+    '''
+    return sorted([key for key, result in state['nodes'].items()
+                   if result['status'] != 'ok'])
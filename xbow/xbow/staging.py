@@ -0,0 +1,398 @@
+'''
+staging.py: move job directories to and from an xbow cluster.
+
+Rather than one SFTP transfer per file, a whole directory tree is streamed
+as a single compressed tar archive over one SSH channel, and unpacked on
+the fly at the other end, so directories of many small files stage quickly.
+
+When a job is submitted, a manifest of its inputs is recorded in the job
+directory. When it is fetched, the instance works out which files are new
+or have changed since then, so only real outputs come back. Large outputs
+are fetched so that an interrupted fetch picks up where it left off.
+'''
+from __future__ import print_function
+import os
+import sys
+import json
+import hashlib
+import fnmatch
+import tarfile
+import threading
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+INPUTS_FILE = '.xbow_inputs.json'
+PARTIAL_SUFFIX = '.xbow-part'
+# never staged: the record of the jobs submitted from a directory
+ALWAYS_EXCLUDE = ['.xbow_ids.yml', INPUTS_FILE, '*' + PARTIAL_SUFFIX]
+
+# Run with python3 on the instance (which does not have xbow installed),
+# with arguments "record DIR" or "changes DIR". Either way the files in DIR
+# are compared with the inputs manifest (if any), hashing only those whose
+# size or modification time differ. "record" saves the manifest of DIR as
+# the inputs manifest and prints it, "changes" prints the entries for new
+# and modified files, both as JSON.
+MANIFEST_SNIPPET = '''
+import hashlib
+import json
+import os
+import sys
+
+def file_hash(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+mode, root = sys.argv[1], sys.argv[2]
+inputs_file = os.path.join(root, '.xbow_inputs.json')
+try:
+    with open(inputs_file) as f:
+        inputs = json.load(f)
+except (IOError, ValueError):
+    inputs = {}
+manifest = {}
+changes = {}
+for dirpath, dirnames, filenames in os.walk(root):
+    for filename in filenames:
+        path = os.path.join(dirpath, filename)
+        rel = os.path.relpath(path, root)
+        if rel == '.xbow_inputs.json' or os.path.islink(path) or not os.path.isfile(path):
+            continue
+        st = os.stat(path)
+        old = inputs.get(rel)
+        if old is not None and old['size'] == st.st_size and old['mtime'] == st.st_mtime:
+            entry = old
+        else:
+            entry = {'size': st.st_size, 'mtime': st.st_mtime, 'hash': file_hash(path)}
+        manifest[rel] = entry
+        if old is None or old['hash'] != entry['hash']:
+            changes[rel] = entry
+if mode == 'record':
+    with open(inputs_file + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(inputs_file + '.tmp', inputs_file)
+    print(json.dumps(manifest))
+else:
+    print(json.dumps(changes))
+'''
+
+def _matches(path, patterns):
+    '''
+    Whether a relative path, or its basename, matches any of the patterns.
+    '''
+    name = os.path.basename(path)
+    for pattern in patterns:
+        if fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+def select(paths, include=None, exclude=None):
+    '''
+    Filter a list of relative paths.
+
+    Args:
+        paths (list): the paths
+        include (list, optional): if given, keep only paths that match one
+            of these glob patterns (each is matched against the whole path
+            and against its basename)
+        exclude (list, optional): drop paths that match any of these
+
+    Returns:
+        list: the paths kept, in their original order
+    '''
+    exclude = ALWAYS_EXCLUDE + list(exclude or [])
+    selected = []
+    for path in paths:
+        if include and not _matches(path, include):
+            continue
+        if _matches(path, exclude):
+            continue
+        selected.append(path)
+    return selected
+
+def file_hash(path):
+    '''
+    The md5 hash of a file.
+    '''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def local_files(root='.'):
+    '''
+    Get the files in a local directory tree.
+
+    Returns:
+        dict: the size of each file, keyed by its path relative to root
+    '''
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if os.path.isfile(path):
+                files[os.path.relpath(path, root)] = os.path.getsize(path)
+    return files
+
+def remote_files(ci, remote_dir):
+    '''
+    Get the files in a directory tree on an instance.
+
+    Args:
+        ci (ConnectedInstance): the instance
+        remote_dir (str): the directory
+
+    Returns:
+        dict: the size of each file, keyed by its path relative to remote_dir
+    '''
+    ci.exec_command("cd {} && find . -type f -printf '%s %P\\n'".format(quote(remote_dir)))
+    if ci.exit_status != 0:
+        raise RuntimeError('Error - cannot list {}: {}'.format(remote_dir, ci.output))
+    files = {}
+    for line in ci.output.splitlines():
+        if line.strip() != '':
+            size, path = line.split(' ', 1)
+            files[path] = int(size)
+    return files
+
+def print_progress(n_done, n_files, bytes_done, total_bytes):
+    '''
+    A progress callback that keeps a one-line report up to date on stdout.
+    '''
+    percent = 100.0
+    if total_bytes > 0:
+        percent = 100.0 * bytes_done / total_bytes
+    sys.stdout.write('\r    {:5.1f}% ({} of {} files, {:.1f} of {:.1f} MB)'.format(
+        percent, n_done, n_files, bytes_done / 1e6, total_bytes / 1e6))
+    if n_done == n_files:
+        sys.stdout.write('\n')
+    sys.stdout.flush()
+
+def _check_channel(channel, action):
+    status = channel.recv_exit_status()
+    if status != 0:
+        errors = channel.makefile_stderr('rb').read().decode('utf-8', 'replace')
+        raise RuntimeError('Error - {} failed with exit status {}: {}'.format(action, status, errors))
+
+def upload_tree(ci, remote_dir, root='.', include=None, exclude=None,
+                progress=None, files=None):
+    '''
+    Copy a local directory tree to an instance, as a single stream.
+
+    Args:
+        ci (ConnectedInstance): the instance
+        remote_dir (str): where to put the files; it is created if need be
+        root (str, optional): the local directory
+        include (list, optional): glob patterns of files to include
+        exclude (list, optional): glob patterns of files to leave out
+        progress (function, optional): called after each file with the
+            number of files sent, the number to send, the bytes sent and
+            the bytes to send (e.g. print_progress)
+        files (dict, optional): the files to consider, if not all of them,
+            with their sizes (as returned by local_files())
+
+    Returns:
+        list: the paths (relative to root) of the files sent
+    '''
+    if files is None:
+        files = local_files(root)
+    paths = select(sorted(files), include, exclude)
+    total_bytes = sum([files[p] for p in paths])
+    channel = ci.transport.open_session()
+    channel.exec_command('mkdir -p {0} && tar -xzf - -C {0}'.format(quote(remote_dir)))
+    stream = channel.makefile('wb')
+    bytes_done = 0
+    try:
+        with tarfile.open(fileobj=stream, mode='w|gz') as tar:
+            for i, path in enumerate(paths):
+                tar.add(os.path.join(root, path), arcname=path, recursive=False)
+                bytes_done += files[path]
+                if progress is not None:
+                    progress(i + 1, len(paths), bytes_done, total_bytes)
+        stream.close()
+    except (IOError, OSError):
+        # if the remote end stopped reading, its exit status says why
+        channel.shutdown_write()
+        _check_channel(channel, 'upload to {}'.format(remote_dir))
+        raise
+    channel.shutdown_write()
+    _check_channel(channel, 'upload to {}'.format(remote_dir))
+    return paths
+
+def _send_names(channel, paths):
+    stream = channel.makefile('wb')
+    stream.write(b''.join([p.encode('utf-8') + b'\0' for p in paths]))
+    stream.close()
+    channel.shutdown_write()
+
+def download_tree(ci, remote_dir, root='.', include=None, exclude=None,
+                  progress=None, files=None):
+    '''
+    Copy a directory tree on an instance to the local machine, as a single
+    stream.
+
+    Args:
+        ci (ConnectedInstance): the instance
+        remote_dir (str): the directory on the instance
+        root (str, optional): the local directory to put the files in
+        include (list, optional): glob patterns of files to include
+        exclude (list, optional): glob patterns of files to leave out
+        progress (function, optional): as for upload_tree()
+        files (dict, optional): the files to consider, if not all of them,
+            with their sizes (as returned by remote_files())
+
+    Returns:
+        list: the paths (relative to root) of the files received
+    '''
+    if files is None:
+        files = remote_files(ci, remote_dir)
+    paths = select(sorted(files), include, exclude)
+    if len(paths) == 0:
+        return []
+    total_bytes = sum([files[p] for p in paths])
+    channel = ci.transport.open_session()
+    channel.exec_command('tar -czf - -C {} --null --verbatim-files-from -T -'.format(quote(remote_dir)))
+    # the list of names is sent while the archive comes back, so neither
+    # end can stall waiting for the other
+    sender = threading.Thread(target=_send_names, args=(channel, paths))
+    sender.start()
+    received = []
+    bytes_done = 0
+    with tarfile.open(fileobj=channel.makefile('rb'), mode='r|gz') as tar:
+        if hasattr(tarfile, 'data_filter'):
+            tar.extraction_filter = tarfile.data_filter
+        for member in tar:
+            if (not member.isfile() or os.path.isabs(member.name)
+                    or '..' in member.name.split('/')):
+                raise RuntimeError('Error - unexpected entry {} in archive'.format(member.name))
+            tar.extract(member, root)
+            received.append(member.name)
+            bytes_done += member.size
+            if progress is not None:
+                progress(len(received), len(paths), bytes_done, total_bytes)
+    sender.join()
+    _check_channel(channel, 'download from {}'.format(remote_dir))
+    return received
+
+def _run_manifest_snippet(ci, mode, remote_dir):
+    ci.exec_command("python3 - {} {} <<'EOF'\n{}\nEOF".format(mode, quote(remote_dir),
+                                                            MANIFEST_SNIPPET))
+    if ci.exit_status != 0:
+        raise RuntimeError('Error - cannot read the manifest of {}: {}'.format(remote_dir, ci.output))
+    return json.loads(ci.output.strip().split('\n')[-1])
+
+def record_inputs(ci, remote_dir):
+    '''
+    Record the manifest of a job directory on an instance, once its inputs
+    have been staged there.
+
+    Returns:
+        dict: for each file (keyed by its path relative to remote_dir), a
+            dict with keys 'size', 'mtime' and 'hash'
+    '''
+    return _run_manifest_snippet(ci, 'record', remote_dir)
+
+def remote_changes(ci, remote_dir):
+    '''
+    Find the files in a job directory on an instance that are new, or have
+    been modified, since its inputs were recorded. If they never were,
+    that is all the files.
+
+    Returns:
+        dict: as for record_inputs(), but just for the new and modified files
+    '''
+    return _run_manifest_snippet(ci, 'changes', remote_dir)
+
+def _resume_download(sftp, remote_path, local_path, size, md5):
+    '''
+    Download a file, carrying on from where an earlier attempt stopped, if
+    there was one. The data goes into a partial file that is only renamed
+    once it is complete and its hash is right.
+    '''
+    part = local_path + PARTIAL_SUFFIX
+    for attempt in range(2):
+        offset = 0
+        if os.path.exists(part):
+            offset = os.path.getsize(part)
+            if offset > size:
+                os.remove(part)
+                offset = 0
+        with sftp.open(remote_path, 'rb') as rf:
+            rf.seek(offset)
+            rf.prefetch(size)
+            with open(part, 'ab') as lf:
+                for block in iter(lambda: rf.read(1 << 20), b''):
+                    lf.write(block)
+        if file_hash(part) == md5:
+            os.rename(part, local_path)
+            return
+        # what was there before was not the start of this file
+        os.remove(part)
+    raise RuntimeError('Error - download of {} is corrupt'.format(remote_path))
+
+def fetch_outputs(ci, remote_dir, changes, root='.', include=None,
+                  exclude=None, progress=None, resume_size=16 * 2**20):
+    '''
+    Fetch new and modified files from a job directory on an instance.
+
+    Files that are already here, with the same contents, are skipped. Small
+    files come back as a single stream; files of resume_size bytes or more
+    are fetched one by one, so an interrupted fetch can be resumed by
+    running it again.
+
+    Args:
+        ci (ConnectedInstance): the instance
+        remote_dir (str): the job directory on the instance
+        changes (dict): the files to fetch, as returned by remote_changes()
+        root (str, optional): the local directory to put them in
+        include (list, optional): glob patterns of files to include
+        exclude (list, optional): glob patterns of files to leave out
+        progress (function, optional): as for upload_tree()
+        resume_size (int, optional): the size of file to fetch resumably
+
+    Returns:
+        list: the paths (relative to root) of the files fetched
+    '''
+    paths = []
+    for path in select(sorted(changes), include, exclude):
+        local_path = os.path.join(root, path)
+        if (os.path.exists(local_path)
+                and os.path.getsize(local_path) == changes[path]['size']
+                and file_hash(local_path) == changes[path]['hash']):
+            continue
+        paths.append(path)
+    total_bytes = sum([changes[p]['size'] for p in paths])
+    small = dict([(p, changes[p]['size']) for p in paths
+                  if changes[p]['size'] < resume_size])
+    large = [p for p in paths if not p in small]
+    done = {'files': 0, 'bytes': 0}
+    def report(n_done, n_files, bytes_done, total):
+        if progress is not None:
+            progress(done['files'] + n_done, len(paths),
+                     done['bytes'] + bytes_done, total_bytes)
+    if len(small) > 0:
+        download_tree(ci, remote_dir, root=root, progress=report, files=small)
+        done['files'] += len(small)
+        done['bytes'] += sum(small.values())
+    if len(large) > 0:
+        sftp = ci.open_sftp()
+        try:
+            for path in large:
+                local_path = os.path.join(root, path)
+                if not os.path.isdir(os.path.dirname(os.path.abspath(local_path))):
+                    os.makedirs(os.path.dirname(os.path.abspath(local_path)))
+                _resume_download(sftp, '{}/{}'.format(remote_dir, path),
+                                 local_path, changes[path]['size'],
+                                 changes[path]['hash'])
+                report(1, 1, changes[path]['size'], total_bytes)
+                done['files'] += 1
+                done['bytes'] += changes[path]['size']
+        finally:
+            sftp.close()
+    return paths
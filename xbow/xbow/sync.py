@@ -0,0 +1,318 @@
+'''
+sync.py: keep a local directory and its copy on the cluster in step.
+
+Each side is described by a manifest: the size, modification time and
+hash of every file. A file's hash is only recomputed if its size or
+modification time has changed, so building the manifest of a large, mostly
+unchanged directory is quick.
+
+The manifests of both sides at the last sync (the "base") are kept in
+.xbow_sync.json in the local directory. Comparing each side with the base
+shows which side has changed since then, so changes (including deletions)
+made on either side can be copied to the other. A file changed differently
+on both sides is a conflict: it is left alone unless a side to prefer is
+given. Local files are only deleted (because they were deleted on the
+cluster) if that is asked for, and an empty remote directory is taken to be
+missing (e.g. the shared storage is not mounted), not emptied, so it never
+causes local deletions.
+
+Changed files are moved in both directions at once, as tar streams
+over a single SSH connection (see the staging module).
+'''
+from __future__ import print_function
+import os
+import json
+import threading
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from . import staging
+from .staging import file_hash
+
+SYNC_STATE_FILE = '.xbow_sync.json'
+REMOTE_CACHE_FILE = '.xbow_sync_manifest.json'
+EXCLUDE = [SYNC_STATE_FILE, REMOTE_CACHE_FILE]
+
+# Run with python3 on the instance (which does not have xbow installed),
+# with the directory as its argument; prints the manifest of the directory
+# as JSON. Hashes are cached in the directory between runs.
+REMOTE_MANIFEST_SNIPPET = '''
+import hashlib
+import json
+import os
+import sys
+
+def file_hash(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+root = sys.argv[1]
+if not os.path.isdir(root):
+    os.makedirs(root)
+cache_file = os.path.join(root, '.xbow_sync_manifest.json')
+try:
+    with open(cache_file) as f:
+        cache = json.load(f)
+except (IOError, ValueError):
+    cache = {}
+manifest = {}
+for dirpath, dirnames, filenames in os.walk(root):
+    for filename in filenames:
+        path = os.path.join(dirpath, filename)
+        if not os.path.isfile(path) or os.path.islink(path):
+            continue
+        rel = os.path.relpath(path, root)
+        st = os.stat(path)
+        entry = cache.get(rel)
+        if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+            entry = {'size': st.st_size, 'mtime': st.st_mtime, 'hash': file_hash(path)}
+        manifest[rel] = entry
+manifest.pop('.xbow_sync_manifest.json', None)
+with open(cache_file + '.tmp', 'w') as f:
+    json.dump(manifest, f)
+os.rename(cache_file + '.tmp', cache_file)
+print(json.dumps(manifest))
+'''
+
+def local_manifest(root='.', cache=None):
+    '''
+    Build the manifest of a local directory tree.
+
+    Args:
+        root (str, optional): the directory
+        cache (dict, optional): an earlier manifest; the hashes of files
+            whose size and modification time are unchanged are taken from it
+
+    Returns:
+        dict: for each file (keyed by its path relative to root), a dict
+            with keys 'size', 'mtime' and 'hash'
+    '''
+    if cache is None:
+        cache = {}
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if not os.path.isfile(path) or os.path.islink(path):
+                continue
+            rel = os.path.relpath(path, root)
+            if rel in EXCLUDE:
+                continue
+            st = os.stat(path)
+            entry = cache.get(rel)
+            if (entry is None or entry['size'] != st.st_size
+                    or entry['mtime'] != st.st_mtime):
+                entry = {'size': st.st_size, 'mtime': st.st_mtime,
+                         'hash': file_hash(path)}
+            manifest[rel] = entry
+    return manifest
+
+def remote_manifest(ci, remote_dir):
+    '''
+    Build the manifest of a directory tree on an instance, creating the
+    directory if it does not exist.
+
+    Args:
+        ci (ConnectedInstance): the instance
+        remote_dir (str): the directory
+
+    Returns:
+        dict: as for local_manifest()
+    '''
+    ci.exec_command("python3 - {} <<'EOF'\n{}\nEOF".format(quote(remote_dir),
+                                                         REMOTE_MANIFEST_SNIPPET))
+    if ci.exit_status != 0:
+        raise RuntimeError('Error - cannot build the manifest of {}: {}'.format(remote_dir, ci.output))
+    return json.loads(ci.output.strip().split('\n')[-1])
+
+def _same(a, b):
+    if a is None or b is None:
+        return a is None and b is None
+    return a['hash'] == b['hash']
+
+def _resolve(prefer, local, remote):
+    if prefer in ['local', 'remote']:
+        return prefer
+    if prefer == 'newer':
+        if remote is None or (local is not None and local['mtime'] >= remote['mtime']):
+            return 'local'
+        return 'remote'
+    return None
+
+def plan(local, remote, base, prefer=None, direction='both',
+         delete_local=True):
+    '''
+    Work out what needs to be done to bring two manifests into step.
+
+    Args:
+        local (dict): the manifest of the local directory
+        remote (dict): the manifest of the remote directory
+        base (dict): the manifest of both at the last sync
+        prefer (str, optional): how to settle conflicts: 'local',
+            'remote' or 'newer'. By default conflicts are left alone.
+        direction (str, optional): 'both', or 'upload' or 'download' to
+            only copy changes that way
+        delete_local (bool, optional): if False, local files deleted on the
+            remote side are kept (and listed in 'kept_local')
+
+    Returns:
+        dict: lists of paths to 'upload', 'download', 'delete_remote' and
+            'delete_local', the 'conflicts' left alone, the local files
+            'kept_local', any 'warnings', and the new 'base' manifest for
+            once the plan has been carried out.
+    '''
+    if not direction in ['both', 'upload', 'download']:
+        raise ValueError('Error - unknown direction {}'.format(direction))
+    actions = {'upload': [], 'download': [], 'delete_remote': [],
+               'delete_local': [], 'kept_local': [], 'conflicts': [],
+               'warnings': [], 'base': {}}
+    if len(remote) == 0 and len(base) > 0:
+        # more likely missing than emptied: start again, as if never synced
+        actions['warnings'].append('the remote directory is empty: nothing will be deleted locally')
+        base = {}
+    for path in sorted(set(local) | set(remote) | set(base)):
+        l = local.get(path)
+        r = remote.get(path)
+        b = base.get(path)
+        if _same(l, r):
+            if l is not None:
+                actions['base'][path] = l
+            continue
+        local_changed = not _same(l, b)
+        remote_changed = not _same(r, b)
+        if local_changed and remote_changed:
+            winner = _resolve(prefer, l, r)
+            if winner is None:
+                actions['conflicts'].append(path)
+        elif local_changed:
+            winner = 'local'
+        else:
+            winner = 'remote'
+        if winner is None or (winner == 'local' and direction == 'download') \
+                or (winner == 'remote' and direction == 'upload'):
+            if b is not None:
+                actions['base'][path] = b
+        elif winner == 'local':
+            if l is None:
+                actions['delete_remote'].append(path)
+            else:
+                actions['upload'].append(path)
+                actions['base'][path] = l
+        else:
+            if r is None and delete_local:
+                actions['delete_local'].append(path)
+            elif r is None:
+                actions['kept_local'].append(path)
+                actions['base'][path] = b
+            else:
+                actions['download'].append(path)
+                actions['base'][path] = r
+    return actions
+
+def _filter(manifest, include, exclude):
+    paths = staging.select(sorted(manifest), include,
+                           EXCLUDE + list(exclude or []))
+    return dict([(p, manifest[p]) for p in paths])
+
+def _load_state(root):
+    try:
+        with open(os.path.join(root, SYNC_STATE_FILE)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'cache': {}, 'bases': {}}
+
+def _save_state(root, state):
+    filename = os.path.join(root, SYNC_STATE_FILE)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(filename + '.tmp', filename)
+
+def _in_parallel(*calls):
+    '''
+    Run functions, each given as (func, args, kwargs), at the same time.
+    '''
+    errors = []
+    def run(func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=call) for call in calls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+def sync(ci, remote_dir, root='.', include=None, exclude=None, prefer=None,
+         direction='both', delete=False, dry_run=False, report=None):
+    '''
+    Bring a local directory and a directory on an instance into step.
+
+    Args:
+        ci (ConnectedInstance): the instance
+        remote_dir (str): the directory on the instance
+        root (str, optional): the local directory
+        include (list, optional): glob patterns of files to include
+        exclude (list, optional): glob patterns of files to leave out
+        prefer (str, optional): how to settle conflicts (see plan())
+        direction (str, optional): 'both', 'upload' or 'download'
+        delete (bool, optional): delete local files that were deleted on
+            the instance. By default they are kept.
+        dry_run (bool, optional): work out what to do, but do not do it
+        report (function, optional): called with the plan (see plan())
+            before anything is done
+
+    Returns:
+        dict: what was done (see plan())
+    '''
+    state = _load_state(root)
+    local = local_manifest(root, state['cache'])
+    remote = remote_manifest(ci, remote_dir)
+    base = state['bases'].get(remote_dir, {})
+    actions = plan(_filter(local, include, exclude),
+                   _filter(remote, include, exclude),
+                   _filter(base, include, exclude),
+                   prefer=prefer, direction=direction, delete_local=delete)
+    if report is not None:
+        report(actions)
+    if dry_run:
+        return actions
+
+    calls = []
+    if len(actions['upload']) > 0:
+        files = dict([(p, local[p]['size']) for p in actions['upload']])
+        calls.append((staging.upload_tree, (ci, remote_dir),
+                      {'root': root, 'files': files}))
+    if len(actions['download']) > 0:
+        files = dict([(p, remote[p]['size']) for p in actions['download']])
+        calls.append((staging.download_tree, (ci, remote_dir),
+                      {'root': root, 'files': files}))
+    _in_parallel(*calls)
+    if len(actions['delete_remote']) > 0:
+        names = ' '.join([quote(p) for p in actions['delete_remote']])
+        ci.exec_command('cd {} && rm -f -- {}'.format(quote(remote_dir), names))
+        if ci.exit_status != 0:
+            raise RuntimeError('Error - cannot delete files in {}: {}'.format(remote_dir, ci.output))
+    for path in actions['delete_local']:
+        os.remove(os.path.join(root, path))
+        local.pop(path, None)
+
+    # files outside the include/exclude patterns keep their old base
+    selected = _filter(base, include, exclude)
+    new_base = dict([(p, base[p]) for p in base if not p in selected])
+    new_base.update(actions['base'])
+    state['bases'][remote_dir] = new_base
+    for path in actions['download']:
+        st = os.stat(os.path.join(root, path))
+        local[path] = {'size': st.st_size, 'mtime': st.st_mtime,
+                       'hash': remote[path]['hash']}
+    state['cache'] = local
+    _save_state(root, state)
+    return actions
@@ -104,6 +104,8 @@ setup_args = {
                 'scripts/xflow-exec',
                 'scripts/xflow-execall',
                 'scripts/xflow-stat',
+                'scripts/xflow-bench',
+                'scripts/xflow-queue',
                ],
 
     'install_requires': [
@@ -0,0 +1,64 @@
+import unittest
+import pickle
+import shutil
+import tempfile
+import numpy as np
+
+from xbowflow.accumulators import TrajectoryAccumulator
+
+class TestTrajectoryAccumulator(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.frames = np.random.random((10, 4, 3)).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_append_and_read(self):
+        acc = TrajectoryAccumulator(self.path)
+        acc.append(self.frames[:3])
+        acc += self.frames[3:7]
+        acc.append(self.frames[7])
+        acc.append(self.frames[8:])
+        self.assertEqual(len(acc), 10)
+        self.assertEqual(len(acc.chunks), 4)
+        self.assertTrue(np.allclose(acc[:], self.frames))
+        self.assertTrue(np.allclose(acc[2:8], self.frames[2:8]))
+        self.assertTrue(np.allclose(acc[::-3], self.frames[::-3]))
+        self.assertTrue(np.allclose(acc[-1], self.frames[-1]))
+        self.assertTrue(np.allclose(np.array(list(acc)), self.frames))
+        with self.assertRaises(IndexError):
+            acc[10]
+        with self.assertRaises(ValueError):
+            acc.append(np.zeros((2, 5, 3)))
+
+    def test_pickle_and_reopen(self):
+        acc = TrajectoryAccumulator(self.path)
+        acc.append(self.frames[:5])
+        acc[0]
+        copy = pickle.loads(pickle.dumps(acc))
+        acc.append(self.frames[5:])
+        self.assertEqual(len(copy), 5)
+        self.assertTrue(np.allclose(copy[:], self.frames[:5]))
+        reopened = TrajectoryAccumulator(self.path)
+        self.assertEqual(len(reopened), 10)
+        self.assertTrue(np.allclose(reopened[:], self.frames))
+
+    def test_append_from_two_copies(self):
+        ones = np.ones((3, 4, 3), dtype=np.float32)
+        sevens = 7 * np.ones((2, 4, 3), dtype=np.float32)
+        a = TrajectoryAccumulator(self.path)
+        b = pickle.loads(pickle.dumps(a))
+        a.append(ones)
+        b.append(sevens)
+        self.assertTrue(np.allclose(a[:], ones))
+        self.assertEqual(len(b), 5)
+        self.assertTrue(np.allclose(b[:3], ones))
+        self.assertTrue(np.allclose(b[3:], sevens))
+        a.append(ones)
+        self.assertEqual(len(a), 8)
+        reopened = TrajectoryAccumulator(self.path)
+        self.assertEqual(len(reopened), 8)
+        self.assertTrue(np.allclose(reopened[3:5], sevens))
+        self.assertTrue(np.allclose(reopened[5:], ones))
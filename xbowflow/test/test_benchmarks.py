@@ -0,0 +1,33 @@
+import unittest
+
+from xbowflow.clients import XflowClient
+from xbowflow import benchmarks
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_transport(self):
+        client = XflowClient(local=True)
+        try:
+            record = benchmarks.transport(client, 'tmp', 1024, repeats=2)
+        finally:
+            client.close()
+        self.assertEqual(record['size'], 1024)
+        for phase in ['load', 'upload', 'run', 'save', 'total']:
+            self.assertTrue(record[phase]['min'] <= record[phase]['max'])
+
+    def test_compare(self):
+        baseline = [{'benchmark': 'metadata'},
+                    {'benchmark': 'map_width', 'width': 10,
+                     'total': {'median': 1.0}},
+                    {'benchmark': 'map_width', 'width': 100,
+                     'total': {'median': 2.0}}]
+        results = [{'benchmark': 'map_width', 'width': 10,
+                    'total': {'median': 1.1}},
+                   {'benchmark': 'map_width', 'width': 100,
+                    'total': {'median': 3.0}},
+                   {'benchmark': 'map_width', 'config': [5], 'error': 'oops'}]
+        regressions = benchmarks.compare(results, baseline, tolerance=0.2)
+        self.assertEqual(regressions, [(('map_width', 100), 2.0, 3.0)])
+
+if __name__ == '__main__':
+    unittest.main()
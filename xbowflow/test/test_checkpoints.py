@@ -0,0 +1,92 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+
+from dask.distributed import LocalCluster, Client
+from xbowflow import xflowlib, checkpoints
+
+class TestCheckpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.notice = os.path.join(self.tmpdir, 'instance-action')
+        os.environ['XFLOW_SPOT_METADATA_URL'] = 'file://' + self.notice
+        os.environ['XFLOW_CHECKPOINT_DIR'] = os.path.join(self.tmpdir, 'checkpoints')
+        self.poll_interval = checkpoints.POLL_INTERVAL
+        checkpoints.POLL_INTERVAL = 0.1
+
+    def tearDown(self):
+        checkpoints.POLL_INTERVAL = self.poll_interval
+        del os.environ['XFLOW_SPOT_METADATA_URL']
+        del os.environ['XFLOW_CHECKPOINT_DIR']
+        shutil.rmtree(self.tmpdir)
+
+    def send_notice(self):
+        with open(self.notice, 'w') as f:
+            f.write('{"action": "terminate", "time": "2026-10-19T12:00:00Z"}')
+
+    def test_no_notice(self):
+        self.assertIsNone(checkpoints.interruption_notice())
+        self.send_notice()
+        self.assertIsNotNone(checkpoints.interruption_notice())
+
+    def test_interrupt_and_resume(self):
+        xflowlib.set_filehandler('tmp')
+        md = xflowlib.SubprocessKernel('if [ -f state.cpt ]; then cat state.cpt > output; else echo 1 > state.cpt; sleep 30; fi')
+        md.set_outputs(['output'])
+        md.set_checkpoints(['state.cpt'])
+        timer = threading.Timer(1.0, self.send_notice)
+        timer.start()
+        with self.assertRaises(xflowlib.SpotInterruption):
+            md.run()
+        timer.join()
+        os.remove(self.notice)
+        output = md.run()
+        result = os.path.join(self.tmpdir, 'result')
+        output.save(result)
+        with open(result) as f:
+            self.assertEqual(f.read().strip(), '1')
+        self.assertEqual(os.listdir(os.environ['XFLOW_CHECKPOINT_DIR']), [])
+
+    def test_rerun_on_another_worker(self):
+        xflowlib.set_filehandler('memory')
+        # the first run raises the notice itself; the rerun clears it
+        md = xflowlib.SubprocessKernel('if [ -f state.cpt ]; then rm -f {notice}; cat state.cpt > output; else echo 1 > state.cpt; echo terminate > {notice}; sleep 30; fi')
+        md.set_constant('notice', self.notice)
+        md.set_outputs(['output'])
+        md.set_checkpoints(['state.cpt'], retries=1)
+        cluster = LocalCluster(n_workers=2, threads_per_worker=1,
+                               processes=False, dashboard_address=None)
+        client = Client(cluster)
+        try:
+            workers = set(client.scheduler_info()['workers'])
+            future = client.submit(md.run, pure=False)
+            with open(future.result(timeout=60).as_file()) as f:
+                self.assertEqual(f.read().strip(), '1')
+            # the interrupted worker has left the cluster
+            self.assertEqual(len(workers & set(client.scheduler_info()['workers'])), 1)
+            # a failing command is not rerun
+            fail = xflowlib.SubprocessKernel('exit 1')
+            fail.set_checkpoints(['state.cpt'])
+            with self.assertRaises(xflowlib.CalledProcessError):
+                client.submit(fail.run, pure=False).result(timeout=60)
+        finally:
+            client.close()
+            cluster.close()
+        self.assertEqual(os.listdir(os.environ['XFLOW_CHECKPOINT_DIR']), [])
+
+    def test_checkpoints_need_shared_storage(self):
+        checkpoint_dir = os.environ.pop('XFLOW_CHECKPOINT_DIR')
+        shared = os.environ.pop('SHARED', None)
+        try:
+            with self.assertRaises(IOError):
+                checkpoints.checkpoint_dir('session', 'key')
+        finally:
+            os.environ['XFLOW_CHECKPOINT_DIR'] = checkpoint_dir
+            if shared is not None:
+                os.environ['SHARED'] = shared
+
+if __name__ == '__main__':
+    unittest.main()
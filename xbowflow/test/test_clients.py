@@ -0,0 +1,132 @@
+import unittest
+import os
+import sys
+from dask.sizeof import sizeof
+
+from xbowflow import xflowlib
+from xbowflow.clients import XflowClient, AsyncXflowClient, min_worker_cores
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+                         'test.txt')
+
+class TestXflowClientMethods(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = XflowClient(local=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.client.close()
+
+    def test_locality_hints(self):
+        xflowlib.set_filehandler('tmp')
+        fh = xflowlib.load(TEST_FILE)
+        self.assertEqual(sizeof(fh), sys.getsizeof(fh))
+        hints = self.client.locality_hints([fh, 'x'])
+        self.assertTrue(hints['allow_other_workers'])
+        self.assertEqual(set(hints['workers']),
+                         set(self.client.client.scheduler_info()['workers']))
+        self.assertEqual(self.client.locality_hints(['x', 1]), {})
+        xflowlib.set_filehandler('memory')
+        fh = xflowlib.load(TEST_FILE)
+        self.assertEqual(sizeof(fh), sys.getsizeof(fh) + len(fh.compressed_data))
+        self.assertEqual(self.client.locality_hints([fh]), {})
+
+    @unittest.skipIf(os.getenv('SHARED') is None, 'requires $SHARED')
+    def test_no_locality_hints_for_shared_files(self):
+        xflowlib.set_filehandler('shared')
+        fh = xflowlib.load(TEST_FILE)
+        self.assertEqual(self.client.locality_hints([fh]), {})
+        xflowlib.purge()
+
+    def test_resources(self):
+        mdrun = xflowlib.SubprocessKernel('echo $OMP_NUM_THREADS > output')
+        mdrun.set_outputs(['output'])
+        mdrun.set_resources(cores=2, memory='1GB')
+        self.assertEqual(mdrun.resources, {'cores': 2, 'memory': 10**9})
+        options = self.client._task_options(mdrun, {})
+        self.assertEqual(options['resources'], mdrun.resources)
+        output = mdrun.run()
+        with open(output.as_file()) as f:
+            self.assertEqual(f.read().strip(), '2')
+        with self.assertRaises(ValueError):
+            mdrun.set_resources(gpus=-1)
+
+    def test_unresourced_kernels_take_a_worker(self):
+        self.assertIsNone(min_worker_cores({'a': {'resources': {}}}))
+        self.assertEqual(min_worker_cores({'a': {'resources': {'cores': 8}},
+                                        'b': {'resources': {'cores': 4}}}), 4)
+        gmx = xflowlib.SubprocessKernel('echo x > output')
+        gmx.set_outputs(['output'])
+        self.client._check_hosts()
+        self.assertNotIn('resources', self.client._task_options(gmx, {}))
+        worker_cores = self.client.worker_cores
+        self.client.worker_cores = 4
+        try:
+            self.assertEqual(self.client._task_options(gmx, {})['resources'],
+                             {'cores': 4})
+            gmx.set_resources(cores=2, memory='1GB')
+            self.assertEqual(self.client._task_options(gmx, {})['resources'],
+                             {'cores': 2, 'memory': 10**9})
+        finally:
+            self.client.worker_cores = worker_cores
+
+    def test_map_with_filehandles(self):
+        xflowlib.set_filehandler('tmp')
+        rev = xflowlib.SubprocessKernel('rev input > output')
+        rev.set_inputs(['input'])
+        rev.set_outputs(['output'])
+        fhs = [xflowlib.load(TEST_FILE) for i in range(3)]
+        scheduler_info = self.client.client.scheduler_info
+        calls = []
+        def counted():
+            calls.append(1)
+            return scheduler_info()
+        self.client.client.scheduler_info = counted
+        try:
+            outputs = self.client.map(rev, fhs)
+        finally:
+            del self.client.client.scheduler_info
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(outputs), 3)
+        for o in outputs:
+            self.assertTrue(o.result().size > 0)
+        xflowlib.purge()
+
+    def test_submit_packed(self):
+        xflowlib.set_filehandler('tmp')
+        split = xflowlib.SubprocessKernel('echo a > a; echo b > b')
+        split.set_outputs(['a', 'b'])
+        self.assertEqual(len(self.client.submit(split)), 2)
+        a, b = self.client.submit_packed(split).result()
+        with open(b.as_file()) as f:
+            self.assertEqual(f.read().strip(), 'b')
+        xflowlib.purge()
+
+def rev_text(text):
+    return text[::-1]
+
+class TestAsyncXflowClientMethods(unittest.IsolatedAsyncioTestCase):
+
+    async def test_submit_map_gather_close(self):
+        xflowlib.set_filehandler('memory')
+        rev = xflowlib.SubprocessKernel('rev input > output')
+        rev.set_inputs(['input'])
+        rev.set_outputs(['output'])
+        async with AsyncXflowClient(local=True) as client:
+            fh = await client.upload(xflowlib.load(TEST_FILE))
+            output = await client.submit(rev, fh)
+            with open(TEST_FILE) as f:
+                lines = [line[::-1] for line in f.read().splitlines()]
+            with open(output.as_file()) as f:
+                self.assertEqual(f.read().splitlines(), lines)
+            outputs = client.map(rev, [fh, fh, fh])
+            results = await client.gather(outputs)
+            self.assertEqual(len(results), 3)
+            for result in results:
+                self.assertEqual(result.size, output.size)
+            texts = await client.gather(client.map(rev_text, ['abc', 'xyz']))
+            self.assertEqual(texts, ['cba', 'zyx'])
+            dask_client = client.client
+        self.assertEqual(dask_client.status, 'closed')
@@ -0,0 +1,59 @@
+import unittest
+import time
+
+from xbowflow.clients import XflowClient
+from xbowflow.cycles import CycleRunner
+
+def simulate(x):
+    if x == 0:
+        time.sleep(1)
+    return x + 1
+
+def analyse(state, results):
+    state = state + list(results)
+    return state, [0, 1, 2, 3]
+
+def timed_simulate(x):
+    cycle, i = x
+    start = time.time()
+    if i == 0:
+        time.sleep(3)
+    return cycle, i, start, time.time()
+
+def timed_analyse(state, results):
+    state = state + list(results)
+    cycle = max([r[0] for r in results])
+    return state, [(cycle + 1, i) for i in range(4)]
+
+class TestCycleRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.client = XflowClient(local=True)
+
+    def tearDown(self):
+        self.client.client.close()
+
+    def test_all_results_are_collected(self):
+        runner = CycleRunner(self.client, simulate, analyse, quorum=3)
+        cycles = []
+        state = runner.run([], [0, 1, 2, 3], 3,
+                           callback=lambda c, s: cycles.append(c))
+        result = state.result()
+        self.assertEqual(cycles, [0, 1, 2])
+        self.assertEqual(sorted(result), [1, 1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 4])
+
+    def test_cycles_overlap(self):
+        self.client.client.cluster.scale(3)
+        self.client.client.wait_for_workers(3)
+        runner = CycleRunner(self.client, timed_simulate, timed_analyse,
+                             quorum=3)
+        state = runner.run([], [(0, i) for i in range(4)], 2)
+        runs = dict([((r[0], r[1]), r[2:]) for r in state.result()])
+        self.assertEqual(len(runs), 8)
+        # cycle 1 starts while the slowest replica of cycle 0 still runs
+        first_start = min([runs[(1, i)][0] for i in range(4)])
+        self.assertTrue(first_start < runs[(0, 0)][1])
+
+    def test_bad_quorum(self):
+        with self.assertRaises(ValueError):
+            CycleRunner(self.client, simulate, analyse, quorum=0)
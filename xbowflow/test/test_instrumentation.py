@@ -0,0 +1,110 @@
+import unittest
+import os
+import json
+import tempfile
+from dask.distributed import Client, LocalCluster
+
+from xbowflow import xflowlib, instrumentation
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+                         'test.txt')
+
+def count_lines(text):
+    with open(text) as f:
+        n = len(f.readlines())
+    return n
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_subprocess_kernel_timings(self):
+        xflowlib.set_filehandler('tmp')
+        rev = xflowlib.SubprocessKernel('rev input > output')
+        rev.set_inputs(['input'])
+        rev.set_outputs(['output', 'TIMINGS'])
+        fh = xflowlib.load(TEST_FILE)
+        output, timings = rev.run(fh)
+        self.assertEqual(timings['kernel'], 'rev')
+        self.assertEqual(timings['pid'], os.getpid())
+        self.assertEqual(timings['bytes_in'], os.path.getsize(TEST_FILE))
+        self.assertEqual(timings['bytes_out'], output.size)
+        self.assertEqual(set(timings['phases']), set(instrumentation.PHASES))
+        self.assertAlmostEqual(sum(timings['phases'].values()),
+                               timings['end'] - timings['start'])
+
+    def test_function_kernel_timings(self):
+        xflowlib.set_filehandler('tmp')
+        counter = xflowlib.FunctionKernel(count_lines)
+        counter.set_inputs(['text'])
+        counter.set_outputs(['n', 'TIMINGS'])
+        fh = xflowlib.load(TEST_FILE)
+        n, timings = counter.run(fh)
+        self.assertEqual(n, count_lines(TEST_FILE))
+        self.assertEqual(timings['kernel'], 'count_lines')
+        self.assertTrue(timings['peak_rss'] > 0)
+
+    def test_timings_only(self):
+        xflowlib.set_filehandler('tmp')
+        touch = xflowlib.FunctionKernel(lambda: None)
+        touch.set_outputs(['TIMINGS'])
+        timings = touch.run()
+        self.assertTrue(isinstance(timings, dict))
+        self.assertEqual(timings['kernel'], '<lambda>')
+
+    def test_peak_rss_is_per_command(self):
+        xflowlib.set_filehandler('tmp')
+        grow = xflowlib.SubprocessKernel('python -c "b = bytearray({n})" > output')
+        grow.set_inputs(['n'])
+        grow.set_outputs(['output', 'TIMINGS'])
+        big = grow.run(200 * 10**6)[1]['peak_rss']
+        small = grow.run(1)[1]['peak_rss']
+        self.assertTrue(big > 200 * 10**6)
+        # not the largest command the worker has run so far
+        self.assertTrue(small < 100 * 10**6)
+
+    def test_timings_record_cores_claimed(self):
+        xflowlib.set_filehandler('tmp')
+        counter = xflowlib.FunctionKernel(count_lines)
+        counter.set_inputs(['text'])
+        counter.set_outputs(['n', 'TIMINGS'])
+        fh = xflowlib.load(TEST_FILE)
+        self.assertEqual(counter.run(fh)[1]['cores'], 1)
+        cluster = LocalCluster(n_workers=1, threads_per_worker=2,
+                               resources={'cores': 2}, processes=False)
+        client = Client(cluster)
+        try:
+            # as XflowClient does for a kernel that declares no cores
+            future = client.submit(counter.run, fh, resources={'cores': 2})
+            n, timings = future.result()
+        finally:
+            client.close()
+            cluster.close()
+        self.assertEqual(timings['cores'], 2)
+
+    def test_summarise_and_trace(self):
+        records = [{'kernel': 'rev', 'host': 'h1', 'pid': 1, 'key': 'a',
+                    'start': 0.0, 'end': 3.0,
+                    'phases': {'stage_in': 1.0, 'execute': 1.5,
+                               'stage_out': 0.5},
+                    'bytes_in': 10, 'bytes_out': 20, 'peak_rss': 100},
+                   {'kernel': 'rev', 'host': 'h2', 'pid': 1, 'key': 'b',
+                    'start': 1.0, 'end': 2.0,
+                    'phases': {'stage_in': 0.5, 'execute': 0.5,
+                               'stage_out': 0.0},
+                    'bytes_in': 10, 'bytes_out': 20, 'peak_rss': 200}]
+        summary = instrumentation.summarise(records)
+        self.assertEqual(summary['rev']['count'], 2)
+        self.assertEqual(summary['rev']['mean'], 2.0)
+        self.assertEqual(summary['rev']['execute'], 2.0)
+        self.assertEqual(summary['rev']['bytes_out'], 40)
+        self.assertEqual(summary['rev']['peak_rss'], 200)
+        tracefile = tempfile.NamedTemporaryFile(suffix='.json', delete=False).name
+        instrumentation.write_trace(records, tracefile)
+        with open(tracefile) as f:
+            trace = json.load(f)
+        os.remove(tracefile)
+        events = trace['traceEvents']
+        self.assertEqual(len([e for e in events if e['ph'] == 'M']), 2)
+        self.assertEqual(len([e for e in events if e.get('cat') == 'phase']), 6)
+
+if __name__ == '__main__':
+    unittest.main()
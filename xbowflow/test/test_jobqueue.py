@@ -0,0 +1,163 @@
+import unittest
+import os
+import time
+import shutil
+import tempfile
+
+from xbowflow import jobqueue
+from xbowflow.jobqueue import JobQueue, Dispatcher
+from xbowflow.clients import XflowClient
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.queue = JobQueue(os.path.join(self.tmpdir, 'jobs.db'))
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_queue(self):
+        low = self.queue.submit('echo low', self.tmpdir)
+        high = self.queue.submit('echo high', self.tmpdir, priority=5)
+        other = self.queue.submit('echo other', self.tmpdir)
+        self.assertTrue(self.queue.cancel(other))
+        self.assertFalse(self.queue.cancel(other))
+        jobs = self.queue.claim(1)
+        self.assertEqual([j['id'] for j in jobs], [high])
+        self.assertFalse(self.queue.cancel(high))
+        # it has not started, but it has not been long enough to be sure
+        self.assertEqual(self.queue.check_running()['running'], [high])
+        later = time.time() + jobqueue.LEASE_EXPIRY + 1
+        self.assertEqual(self.queue.check_running(now=later)['requeued'], [high])
+        states = dict([(j['id'], j['state']) for j in self.queue.status()])
+        self.assertEqual(states, {low: 'queued', high: 'queued',
+                                  other: 'cancelled'})
+        self.assertEqual([j['id'] for j in self.queue.status(state='queued')],
+                         [low, high])
+        self.assertEqual(self.queue.status([low, other], state='queued')[0]['id'], low)
+        self.assertEqual([s for s, t in self.queue.history(high)],
+                         ['queued', 'running', 'queued'])
+        array = self.queue.submit_array('run {point}', self.tmpdir, ['a', 'b'])
+        jobs = self.queue.status(array)
+        self.assertEqual([j['command'] for j in jobs], ['run a', 'run b'])
+        self.assertEqual(jobs[1]['directory'], os.path.join(self.tmpdir, 'b'))
+        self.assertEqual(self.queue.idle_time(), 0.0)
+        # a second connection sees the same queue
+        queue2 = JobQueue(self.queue.filename)
+        self.assertEqual(len(queue2.status([low, high] + array)), 4)
+        queue2.close()
+
+    def test_leases(self):
+        ids = [self.queue.submit('job', self.tmpdir) for i in range(3)]
+        missing = self.queue.submit('job', os.path.join(self.tmpdir, 'missing'))
+        self.queue.claim(4)
+        result = jobqueue._run_job(self.tmpdir, 'echo done; exit 2', ids[0])
+        self.assertEqual(result['returncode'], 2)
+        jobqueue._write_lease(jobqueue.lease_file(self.tmpdir, ids[1]),
+                              {'state': 'running'})
+        old = jobqueue.lease_file(self.tmpdir, ids[2])
+        jobqueue._write_lease(old, {'state': 'running'})
+        os.utime(old, (time.time() - jobqueue.LEASE_EXPIRY - 1,) * 2)
+
+        # a job that is being watched over is left alone
+        checked = self.queue.check_running(exclude=[ids[0], ids[2], missing])
+        self.assertEqual(checked, {'ended': [], 'running': [ids[1]],
+                                   'requeued': [], 'unknown': []})
+        checked = self.queue.check_running()
+        self.assertEqual(checked, {'ended': [ids[0]], 'running': [ids[1]],
+                                   'requeued': [ids[2]], 'unknown': [missing]})
+        jobs = dict([(j['id'], j) for j in self.queue.status(output=True)])
+        self.assertEqual(jobs[ids[0]]['state'], 'failed')
+        self.assertEqual(jobs[ids[0]]['returncode'], 2)
+        self.assertEqual(jobs[ids[0]]['output'].strip(), 'done')
+        self.assertEqual(jobs[ids[1]]['state'], 'running')
+        self.assertEqual(jobs[ids[2]]['state'], 'queued')
+        self.assertEqual(jobs[missing]['state'], 'unknown')
+        self.assertFalse(os.path.exists(jobqueue.lease_file(self.tmpdir, ids[0])))
+        self.assertFalse(os.path.exists(old))
+
+        self.assertFalse(self.queue.requeue(ids[1]))
+        self.assertTrue(self.queue.requeue(missing))
+        self.assertEqual(self.queue.status([missing])[0]['state'], 'queued')
+
+    def test_dispatcher(self):
+        client = XflowClient(local=True)
+        try:
+            ids = [self.queue.submit('sleep 0.2; echo {} > out{}'.format(i, i),
+                                     self.tmpdir, priority=i)
+                   for i in range(3)]
+            failed = self.queue.submit('exit 3', self.tmpdir, priority=-1)
+            dispatcher = Dispatcher(self.queue, client, max_running=2,
+                                    interval=0.1)
+            self.assertEqual(dispatcher.step(), 2)
+            while dispatcher.step() > 0:
+                time.sleep(0.1)
+        finally:
+            client.client.close()
+        jobs = dict([(j['id'], j) for j in self.queue.status(output=True)])
+        for i in ids:
+            self.assertEqual(jobs[i]['state'], 'finished')
+            self.assertEqual(jobs[i]['returncode'], 0)
+        self.assertEqual(jobs[failed]['state'], 'failed')
+        self.assertEqual(jobs[failed]['returncode'], 3)
+        last = max([j['ended'] for j in jobs.values() if j['ended'] is not None])
+        self.assertAlmostEqual(self.queue.idle_time(now=last + 60), 60.0)
+        # highest priority first
+        self.assertTrue(jobs[ids[2]]['started'] <= jobs[ids[0]]['started'])
+        with open(os.path.join(self.tmpdir, 'out1')) as f:
+            self.assertEqual(f.read().strip(), '1')
+        # the leases are gone once the results are recorded
+        self.assertFalse(any([name.endswith('.lease')
+                              for name in os.listdir(self.tmpdir)]))
+
+    def test_old_database(self):
+        import sqlite3
+        filename = os.path.join(self.tmpdir, 'old.db')
+        db = sqlite3.connect(filename)
+        db.execute("CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, command TEXT NOT NULL, directory TEXT NOT NULL, priority INTEGER NOT NULL DEFAULT 0, state TEXT NOT NULL, submitted REAL NOT NULL, started REAL, ended REAL, returncode INTEGER, output TEXT)")
+        db.commit()
+        db.close()
+        queue = JobQueue(filename)
+        job_id = queue.submit('echo', self.tmpdir, cores=4)
+        self.assertEqual(queue.claim(1)[0]['cores'], 4)
+        queue.close()
+
+    def run_pair(self, cores):
+        # two jobs on one worker with two threads and two cores
+        from distributed import Client, LocalCluster
+        cluster = LocalCluster(n_workers=1, threads_per_worker=2,
+                               resources={'cores': 2}, processes=False,
+                               dashboard_address=None)
+        client = Client(cluster)
+        times = []
+        try:
+            ids = []
+            for name in ['a', 'b']:
+                directory = os.path.join(self.tmpdir, name + str(cores))
+                os.makedirs(directory)
+                ids.append(self.queue.submit('date +%s.%N > start; sleep 1; date +%s.%N > end',
+                                             directory, cores=cores))
+            dispatcher = Dispatcher(self.queue, client, interval=0.1)
+            while dispatcher.step() > 0:
+                time.sleep(0.1)
+            for job in self.queue.status(ids):
+                self.assertEqual(job['state'], 'finished')
+                with open(os.path.join(job['directory'], 'start')) as f:
+                    start = float(f.read())
+                with open(os.path.join(job['directory'], 'end')) as f:
+                    times.append((start, float(f.read())))
+        finally:
+            client.close()
+            cluster.close()
+        times.sort()
+        return times[1][0] < times[0][1]
+
+    def test_jobs_take_whole_workers(self):
+        self.assertFalse(self.run_pair(None))
+        # unless they say they need fewer cores
+        self.assertTrue(self.run_pair(1))
+
+if __name__ == '__main__':
+    unittest.main()
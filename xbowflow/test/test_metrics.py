@@ -0,0 +1,36 @@
+import unittest
+
+from xbowflow.clients import XflowClient
+from xbowflow.metrics import MetricsCollector
+
+def double(x):
+    return 2 * x
+
+class TestMetricsCollector(unittest.TestCase):
+
+    def setUp(self):
+        self.client = XflowClient(local=True)
+
+    def tearDown(self):
+        self.client.client.close()
+
+    def test_summary(self):
+        collector = MetricsCollector(self.client, history=3, price=0.5)
+        collector.sample()
+        futures = self.client.map(double, list(range(20)))
+        self.client.client.gather(futures)
+        for i in range(4):
+            collector.sample()
+        self.assertEqual(len(collector.history), 3)
+        summary = collector.summary()
+        self.assertEqual(summary['completed'], 20)
+        self.assertEqual(summary['queue_depth'], 0)
+        self.assertEqual(summary['n_hosts'], 1)
+        self.assertEqual(summary['cost_per_hour'], 0.5)
+        self.assertEqual(len(summary['workers']), summary['n_workers'])
+        text = collector.prometheus()
+        self.assertIn('xflow_tasks_completed_total 20', text)
+        self.assertIn('xflow_cost_per_hour 0.5', text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from xbowflow import xflowlib, filehandling
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+                         'test.txt')
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+@unittest.skipIf(mock_aws is None, 'requires boto3 and moto')
+class TestObjectStoreFilehandlingMethods(unittest.TestCase):
+
+    def setUp(self):
+        self.env = {'XFLOWBUCKETNAME': 'xflow-test-bucket',
+                    'XFLOW_CACHE_DIR': tempfile.mkdtemp(),
+                    'AWS_ACCESS_KEY_ID': 'testing',
+                    'AWS_SECRET_ACCESS_KEY': 'testing',
+                    'AWS_DEFAULT_REGION': 'us-east-1'}
+        self.saved_env = {k: os.environ.get(k) for k in self.env}
+        os.environ.update(self.env)
+        self.mock = mock_aws()
+        self.mock.start()
+        boto3.client('s3').create_bucket(Bucket='xflow-test-bucket')
+
+    def tearDown(self):
+        self.mock.stop()
+        shutil.rmtree(self.env['XFLOW_CACHE_DIR'])
+        for k, v in self.saved_env.items():
+            if v is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = v
+
+    def test_filehandle_methods_for_s3(self):
+        xflowlib.set_filehandler('s3')
+        self.assertEqual(xflowlib.filehandler_type, 's3')
+        self.assertEqual(xflowlib.filehandler, filehandling.ObjectStoreFileHandle)
+        fh = xflowlib.load(TEST_FILE)
+        self.assertIsInstance(fh, filehandling.FileHandle)
+        with open(TEST_FILE, 'rb') as f1:
+            d1 = f1.read()
+        # Empty the local cache so the data must come from the bucket
+        shutil.rmtree(self.env['XFLOW_CACHE_DIR'])
+        self.assertEqual(fh.read(2, 5), d1[2:7])
+        fh.save('tempfile.txt')
+        with open('tempfile.txt', 'rb') as f2:
+            d2 = f2.read()
+        self.assertEqual(d1, d2)
+        os.remove('tempfile.txt')
+        self.assertTrue(os.path.exists(fh.as_file()))
+        xflowlib.purge()
+        response = boto3.client('s3').list_objects_v2(Bucket='xflow-test-bucket')
+        self.assertEqual(response['KeyCount'], 0)
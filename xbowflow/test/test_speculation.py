@@ -0,0 +1,92 @@
+import unittest
+import os
+import time
+import shutil
+import tempfile
+from distributed import as_completed
+
+from xbowflow import xflowlib
+from xbowflow.clients import XflowClient, AsyncXflowClient
+
+class TestSpeculation(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = XflowClient(local=True)
+        cls.client.client.cluster.scale(3)
+        cls.client.client.wait_for_workers(3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.speculator.stop()
+        cls.client.client.close()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_straggler_is_duplicated(self):
+        # each run is fast, except the first run for input 5
+        xflowlib.set_filehandler('tmp')
+        for i in range(5):
+            open(os.path.join(self.tmpdir, str(i)), 'w').close()
+        md = xflowlib.SubprocessKernel('if [ -f {dir}/{i} ]; then sleep 0.2; else touch {dir}/{i}; sleep 60; fi; echo {i} > output')
+        md.set_inputs(['dir', 'i'])
+        md.set_outputs(['output'])
+        speculator = self.client.set_speculation(min_samples=3, interval=0.2)
+        start = time.time()
+        outputs = self.client.map(md, self.tmpdir, list(range(6)))
+        results = self.client.client.gather(outputs)
+        self.assertTrue(time.time() - start < 30)
+        for i, result in enumerate(results):
+            with open(result.as_file()) as f:
+                self.assertEqual(f.read().strip(), str(i))
+        self.assertEqual(speculator.launched, 1)
+        self.assertTrue(len(speculator.durations[md.name]) >= 3)
+
+    def test_runs_resolve_independently(self):
+        xflowlib.set_filehandler('tmp')
+        nap = xflowlib.SubprocessKernel('sleep {t}; echo {t} > output')
+        nap.set_inputs(['t'])
+        nap.set_outputs(['output'])
+        self.client.set_speculation(min_samples=100, interval=0.2)
+        start = time.time()
+        outputs = self.client.map(nap, [5, 0, 0])
+        first = next(as_completed(outputs))
+        # the quick runs do not wait for the slow one
+        self.assertTrue(time.time() - start < 4)
+        self.assertFalse(first is outputs[0])
+        self.assertFalse(outputs[0].done())
+        self.client.client.gather(outputs)
+
+    def test_threshold(self):
+        speculator = self.client.set_speculation(percentile=50, factor=2.0,
+                                                 min_samples=3)
+        speculator._record('mdrun', 1.0)
+        speculator._record('mdrun', 2.0)
+        self.assertIsNone(speculator.threshold('mdrun'))
+        speculator._record('mdrun', 3.0)
+        self.assertEqual(speculator.threshold('mdrun'), 4.0)
+        self.assertIsNone(speculator.threshold('other'))
+
+class TestAsyncSpeculation(unittest.IsolatedAsyncioTestCase):
+
+    async def test_map_with_speculation(self):
+        xflowlib.set_filehandler('memory')
+        echo = xflowlib.SubprocessKernel('echo {i} > output')
+        echo.set_inputs(['i'])
+        echo.set_outputs(['output'])
+        async with AsyncXflowClient(local=True) as client:
+            speculator = client.set_speculation(min_samples=3, interval=0.2)
+            results = await client.gather(client.map(echo, list(range(4))))
+            self.assertEqual(len(results), 4)
+            for i, result in enumerate(results):
+                with open(result.as_file()) as f:
+                    self.assertEqual(f.read().strip(), str(i))
+            self.assertFalse(speculator._watcher is client.client)
+        self.assertIsNone(speculator._watcher)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,19 +1,29 @@
 import unittest
 import os
+import threading
 
 from xbowflow import xflowlib, filehandling
 
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+                         'test.txt')
+
 class TestTempFilehandlingMethods(unittest.TestCase):
 
+    def tearDown(self):
+        # a failed test leaves its shared memory files, and their reference
+        # counts, behind for the next
+        xflowlib.set_filehandler('shm')
+        xflowlib.purge()
+
     def test_filehandle_methods_for_temp(self):
         xflowlib.set_filehandler('tmp')
         self.assertEqual(xflowlib.filehandler_type, 'tmp')
         self.assertEqual(xflowlib.filehandler, filehandling.TempFileHandle)
-        fh = xflowlib.load('data/test.txt')
+        fh = xflowlib.load(TEST_FILE)
         self.assertIsInstance(fh, filehandling.FileHandle)
         fh.save('tempfile.txt')
         self.assertTrue(os.path.exists('tempfile.txt'))
-        with open('data/test.txt', 'rb') as f1:
+        with open(TEST_FILE, 'rb') as f1:
             d1 = f1.read()
         with open('tempfile.txt', 'rb') as f2:
             d2 = f2.read()
@@ -25,15 +35,16 @@ class TestTempFilehandlingMethods(unittest.TestCase):
         #del(fh)
         #self.assertFalse(os.path.exists(tmpname))
 
+    @unittest.skipIf(os.getenv('SHARED') is None, 'requires $SHARED')
     def test_filehandle_methods_for_shared(self):
         xflowlib.set_filehandler('shared')
         self.assertEqual(xflowlib.filehandler_type, 'shared')
         self.assertEqual(xflowlib.filehandler, filehandling.SharedFileHandle)
-        fh = xflowlib.load('data/test.txt')
+        fh = xflowlib.load(TEST_FILE)
         self.assertIsInstance(fh, filehandling.FileHandle)
         fh.save('tempfile.txt')
         self.assertTrue(os.path.exists('tempfile.txt'))
-        with open('data/test.txt', 'rb') as f1:
+        with open(TEST_FILE, 'rb') as f1:
             d1 = f1.read()
         with open('tempfile.txt', 'rb') as f2:
             d2 = f2.read()
@@ -49,11 +60,11 @@ class TestTempFilehandlingMethods(unittest.TestCase):
         xflowlib.set_filehandler('memory')
         self.assertEqual(xflowlib.filehandler_type, 'memory')
         self.assertEqual(xflowlib.filehandler, filehandling.CompressedFileHandle)
-        fh = xflowlib.load('data/test.txt')
+        fh = xflowlib.load(TEST_FILE)
         self.assertIsInstance(fh, filehandling.FileHandle)
         fh.save('tempfile.txt')
         self.assertTrue(os.path.exists('tempfile.txt'))
-        with open('data/test.txt', 'rb') as f1:
+        with open(TEST_FILE, 'rb') as f1:
             d1 = f1.read()
         with open('tempfile.txt', 'rb') as f2:
             d2 = f2.read()
@@ -65,6 +76,87 @@ class TestTempFilehandlingMethods(unittest.TestCase):
         del(fh)
         #self.assertFalse(os.path.exists(tmpname))
 
+    def test_filehandle_methods_for_shm(self):
+        xflowlib.set_filehandler('shm')
+        self.assertEqual(xflowlib.filehandler_type, 'shm')
+        self.assertEqual(xflowlib.filehandler, filehandling.SharedMemoryFileHandle)
+        fh = xflowlib.load(TEST_FILE)
+        self.assertIsInstance(fh, filehandling.FileHandle)
+        fh.save('tempfile.txt')
+        self.assertTrue(os.path.exists('tempfile.txt'))
+        with open(TEST_FILE, 'rb') as f1:
+            d1 = f1.read()
+        with open('tempfile.txt', 'rb') as f2:
+            d2 = f2.read()
+        self.assertEqual(d1, d2)
+        os.remove('tempfile.txt')
+        self.assertFalse(os.path.exists('tempfile.txt'))
+        tmpname = fh.as_file()
+        self.assertTrue(os.path.exists(tmpname))
+        fh2 = xflowlib.load(TEST_FILE)
+        self.assertEqual(fh2.as_file(), tmpname)
+        self.assertEqual(fh.refcount(), 2)
+        fh.release()
+        self.assertTrue(os.path.exists(tmpname))
+        fh2.release()
+        self.assertFalse(os.path.exists(tmpname))
+        xflowlib.purge()
+
+    def test_shm_handles_created_while_released(self):
+        xflowlib.set_filehandler('shm')
+        errors = []
+        def churn():
+            for i in range(50):
+                fh = xflowlib.load(TEST_FILE)
+                if not os.path.exists(fh.as_file()):
+                    errors.append(fh.as_file())
+                fh.release()
+        threads = [threading.Thread(target=churn) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        xflowlib.purge()
+
+    def test_filehandle_methods_for_adaptive(self):
+        xflowlib.set_filehandler('adaptive', small=10, large=100,
+                                 same_host=True)
+        self.assertEqual(xflowlib.filehandler_type, 'adaptive')
+        self.assertIsInstance(xflowlib.filehandler, filehandling.AdaptiveFileHandler)
+        fh = xflowlib.load(TEST_FILE)
+        self.assertIsInstance(fh, filehandling.FileHandle)
+        fh.save('tempfile.txt')
+        with open(TEST_FILE, 'rb') as f1:
+            d1 = f1.read()
+        with open('tempfile.txt', 'rb') as f2:
+            d2 = f2.read()
+        self.assertEqual(d1, d2)
+        os.remove('tempfile.txt')
+        handler = xflowlib.filehandler
+        self.assertEqual(handler.choose(10), filehandling.CompressedFileHandle)
+        self.assertEqual(handler.choose(1000), filehandling.TempFileHandle)
+        xflowlib.purge()
+
+    @unittest.skipIf(os.getenv('SHARED') is None, 'requires $SHARED')
+    def test_adaptive_with_shared_storage(self):
+        handler = filehandling.AdaptiveFileHandler(small=10, large=100,
+                                                   shared=True,
+                                                   object_store=True)
+        self.assertEqual(handler.choose(50), filehandling.SharedFileHandle)
+        self.assertEqual(handler.choose(1000), filehandling.ObjectStoreFileHandle)
+
+    def test_adaptive_shared_needs_shared_dir(self):
+        shared = os.environ.pop('SHARED', None)
+        try:
+            with self.assertRaises(IOError):
+                filehandling.AdaptiveFileHandler(shared=True)
+            handler = filehandling.AdaptiveFileHandler()
+            self.assertFalse(handler.shared)
+        finally:
+            if shared is not None:
+                os.environ['SHARED'] = shared
+
     def test_filehandle_methods_for_bad_value(self):
         with self.assertRaises(ValueError):
             xflowlib.set_filehandler('should_fail')
@@ -0,0 +1,220 @@
+'''
+accumulators.py: append-only stores for data that grows as a workflow runs.
+
+In an iterative workflow such as CoCo-MD, the trajectory grows each cycle.
+Holding it as one in-memory object and re-writing it to a single file each
+cycle makes the I/O grow as the square of the number of cycles. A
+TrajectoryAccumulator instead writes each new set of frames to a new chunk
+file, and reads earlier frames back lazily, by memory-mapping the chunks,
+so the cost of each cycle is proportional to the new frames only:
+
+    acc = TrajectoryAccumulator('/path/to/store')
+    acc.append(new_frames)       # numpy array, or e.g. an MDTraj trajectory
+    len(acc)                     # total number of frames so far
+    acc[-10:]                    # only these frames are read from disk
+
+Accumulators are small to pickle (just the path and the chunk index), so
+they can be passed to kernels. Kernels see the frames that existed when the
+accumulator was passed to them. Any copy may append: each chunk gets a
+unique name, and the index on disk is merged under a lock, so after an
+append a copy sees the frames appended by all the others too. The store
+must be on a file system the kernels can see - by default it is created in
+$SHARED if that is set.
+'''
+from __future__ import print_function
+import os
+import fcntl
+import json
+import uuid
+import tempfile
+import numpy as np
+
+INDEXFILE = 'index.json'
+LOCKFILE = 'index.lock'
+
+class TrajectoryAccumulator(object):
+    '''
+    An append-only, chunked, on-disk store of trajectory frames.
+    '''
+    def __init__(self, path=None):
+        """
+        Create a new store, or open an existing one.
+
+        Arguments:
+            path (str, optional): the directory for the store. If not
+                given, a new directory is created in $SHARED, or in $TMPDIR
+                if $SHARED is not set.
+        """
+        if path is None:
+            root = os.getenv('SHARED')
+            if root is None:
+                root = tempfile.gettempdir()
+            path = os.path.join(root, 'xflow-acc-{}'.format(uuid.uuid4()))
+        self.path = os.path.abspath(path)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.chunks = []
+        self.n_atoms = None
+        self._read_index()
+        self._cache = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = {}
+        return state
+
+    def __str__(self):
+        return 'TrajectoryAccumulator at {} ({} frames)'.format(self.path,
+                                                                len(self))
+
+    def __len__(self):
+        return sum([c[1] for c in self.chunks])
+
+    def append(self, frames):
+        """
+        Add frames to the end of the store.
+
+        Only the new frames are written.
+
+        Arguments:
+            frames: an array of shape (n_frames, n_atoms, 3) or (n_atoms, 3),
+                or any object with such an array as its 'xyz' attribute
+                (e.g. an MDTraj Trajectory).
+
+        Returns:
+            TrajectoryAccumulator: this accumulator
+        """
+        if hasattr(frames, 'xyz'):
+            frames = frames.xyz
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            frames = frames.reshape((1,) + frames.shape)
+        if frames.ndim != 3 or frames.shape[2] != 3:
+            raise ValueError('Error - frames must have shape (n_frames, n_atoms, 3)')
+        if self.n_atoms is None:
+            self.n_atoms = frames.shape[1]
+        elif frames.shape[1] != self.n_atoms:
+            raise ValueError('Error - frames have {} atoms, the accumulator '
+                             'has {}'.format(frames.shape[1], self.n_atoms))
+        if len(frames) == 0:
+            return self
+        chunkname = 'chunk-{}.npy'.format(uuid.uuid4().hex)
+        chunkfile = os.path.join(self.path, chunkname)
+        tmp_path = tempfile.NamedTemporaryFile(dir=self.path, suffix='.npy',
+                                               delete=False).name
+        np.save(tmp_path, frames)
+        os.rename(tmp_path, chunkfile)
+        with open(os.path.join(self.path, LOCKFILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # another copy of this accumulator may have appended since
+                # this one last looked
+                self._read_index()
+                if self.n_atoms is None:
+                    self.n_atoms = frames.shape[1]
+                elif frames.shape[1] != self.n_atoms:
+                    os.remove(chunkfile)
+                    raise ValueError('Error - frames have {} atoms, the accumulator '
+                                     'has {}'.format(frames.shape[1], self.n_atoms))
+                self.chunks.append((chunkname, len(frames)))
+                self._write_index()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return self
+
+    def __iadd__(self, frames):
+        return self.append(frames)
+
+    def _read_index(self):
+        '''
+        Bring the chunk index up to date with the one on disk, if any.
+        '''
+        indexfile = os.path.join(self.path, INDEXFILE)
+        if os.path.exists(indexfile):
+            with open(indexfile) as f:
+                index = json.load(f)
+            self.chunks = [tuple(c) for c in index['chunks']]
+            self.n_atoms = index['n_atoms']
+
+    def _write_index(self):
+        '''
+        Write the chunk index, atomically.
+        '''
+        tmp_path = tempfile.NamedTemporaryFile(dir=self.path, suffix='.json',
+                                               delete=False).name
+        with open(tmp_path, 'w') as f:
+            json.dump({'chunks': self.chunks, 'n_atoms': self.n_atoms}, f)
+        os.rename(tmp_path, os.path.join(self.path, INDEXFILE))
+
+    def _chunk(self, i):
+        '''
+        Returns the i-th chunk, memory-mapped.
+        '''
+        chunkname = self.chunks[i][0]
+        if not chunkname in self._cache:
+            chunkfile = os.path.join(self.path, chunkname)
+            self._cache[chunkname] = np.load(chunkfile, mmap_mode='r')
+        return self._cache[chunkname]
+
+    def iterchunks(self):
+        """
+        Iterate over the chunks, as memory-mapped arrays.
+        """
+        for i in range(len(self.chunks)):
+            yield self._chunk(i)
+
+    def __iter__(self):
+        for chunk in self.iterchunks():
+            for frame in chunk:
+                yield frame
+
+    def __getitem__(self, index):
+        """
+        Returns a frame, or for a slice, an array of frames. Only the chunks
+        that hold the requested frames are read.
+        """
+        n_frames = len(self)
+        if isinstance(index, slice):
+            wanted = range(n_frames)[index]
+            if len(wanted) == 0:
+                return np.zeros((0, self.n_atoms or 0, 3), dtype=np.float32)
+            lo = min(wanted[0], wanted[-1])
+            hi = max(wanted[0], wanted[-1]) + 1
+            parts = []
+            start = 0
+            for i, c in enumerate(self.chunks):
+                stop = start + c[1]
+                if stop > lo and start < hi:
+                    parts.append(self._chunk(i)[max(lo - start, 0):min(hi, stop) - start])
+                start = stop
+            frames = np.concatenate(parts)
+            return frames[[w - lo for w in wanted]]
+        if index < 0:
+            index += n_frames
+        if index < 0 or index >= n_frames:
+            raise IndexError('Error - frame {} out of range'.format(index))
+        start = 0
+        for i, c in enumerate(self.chunks):
+            if index < start + c[1]:
+                return np.array(self._chunk(i)[index - start])
+            start += c[1]
+
+    def as_array(self):
+        """
+        Returns all the frames, as a single array.
+        """
+        return self[:]
+
+    def to_mdtraj(self, topology, start=None, stop=None):
+        """
+        Returns frames as an MDTraj Trajectory (requires MDTraj).
+
+        Arguments:
+            topology: an MDTraj Topology, or anything mdtraj.load_topology()
+                accepts (e.g. a filename).
+            start, stop (int, optional): the range of frames to return.
+        """
+        import mdtraj as mdt
+        if not isinstance(topology, mdt.Topology):
+            topology = mdt.load_topology(topology)
+        return mdt.Trajectory(self[start:stop], topology)
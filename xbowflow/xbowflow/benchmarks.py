@@ -0,0 +1,230 @@
+'''
+benchmarks.py: measure what xbowflow's file transports and task machinery
+cost on a given cluster.
+
+Each benchmark returns a list of records (dicts), one per configuration,
+suitable for dumping as JSON. Two sets of results can be compared to catch
+regressions:
+
+    client = XflowClient(local=True)
+    results = run_suite(client, ['tmp', 'memory'], [1024, 1024**2], [1, 100])
+    regressions = compare(results, baseline_results, tolerance=0.2)
+
+The xflow-bench script provides a command line interface.
+'''
+from __future__ import print_function
+import os
+import time
+import shutil
+import socket
+import tempfile
+import datetime
+import numpy as np
+from . import xflowlib
+from ._version import __version__
+from .pipelines import InterfaceKernel, Pipeline
+
+def _stats(times):
+    '''
+    Summarise a list of timings.
+    '''
+    return {'min': float(np.min(times)),
+            'median': float(np.median(times)),
+            'max': float(np.max(times))}
+
+def _noop(x):
+    return x
+
+def _fanout(n):
+    return list(range(n))
+
+def metadata(client):
+    '''
+    Returns a record describing the benchmark environment.
+    '''
+    workers = client.client.scheduler_info()['workers']
+    return {'benchmark': 'metadata',
+            'version': __version__,
+            'host': socket.gethostname(),
+            'n_workers': len(workers),
+            'n_threads': sum([w.get('nthreads', 1) for w in workers.values()]),
+            'date': datetime.datetime.now().isoformat()}
+
+def transport(client, fh_type, size, repeats=3):
+    '''
+    Time a load() -> upload() -> SubprocessKernel.run -> save() round trip.
+
+    args:
+        client (XflowClient): the client
+        fh_type (str): the file handler to use (see set_filehandler())
+        size (int): the file size, in bytes
+        repeats (int): number of times to repeat the measurement
+
+    returns:
+        dict: timings (in seconds) for each phase, and overall throughput
+            in bytes per second.
+    '''
+    xflowlib.set_filehandler(fh_type)
+    cat = xflowlib.SubprocessKernel('cat input > output')
+    cat.set_inputs(['input'])
+    cat.set_outputs(['output'])
+    workdir = tempfile.mkdtemp()
+    infile = os.path.join(workdir, 'input.dat')
+    outfile = os.path.join(workdir, 'output.dat')
+    with open(infile, 'wb') as f:
+        f.write(os.urandom(size))
+    phases = {'load': [], 'upload': [], 'run': [], 'save': [], 'total': []}
+    try:
+        for i in range(repeats):
+            t0 = time.time()
+            fh = xflowlib.load(infile)
+            t1 = time.time()
+            uploaded = client.upload(fh)
+            t2 = time.time()
+            output = client.submit(cat, uploaded).result()
+            t3 = time.time()
+            output.save(outfile)
+            t4 = time.time()
+            phases['load'].append(t1 - t0)
+            phases['upload'].append(t2 - t1)
+            phases['run'].append(t3 - t2)
+            phases['save'].append(t4 - t3)
+            phases['total'].append(t4 - t0)
+        if os.path.getsize(outfile) != size:
+            raise RuntimeError('Error - output file is the wrong size')
+    finally:
+        shutil.rmtree(workdir)
+        xflowlib.purge()
+    record = {'benchmark': 'transport', 'filehandler': fh_type, 'size': size}
+    for phase in phases:
+        record[phase] = _stats(phases[phase])
+    record['throughput'] = size / record['total']['median']
+    return record
+
+def map_width(client, width, repeats=3):
+    '''
+    Time client.map() of a trivial FunctionKernel over width inputs.
+    '''
+    noop = xflowlib.FunctionKernel(_noop)
+    noop.set_inputs(['x'])
+    noop.set_outputs(['x'])
+    times = []
+    for i in range(repeats):
+        t0 = time.time()
+        client.client.gather(client.map(noop, list(range(width))))
+        times.append(time.time() - t0)
+    record = {'benchmark': 'map_width', 'width': width,
+              'total': _stats(times)}
+    record['per_task'] = record['total']['median'] / width
+    return record
+
+def unpack_fanout(client, fanout, repeats=3):
+    '''
+    Time a kernel with fanout outputs, unpacked into fanout futures.
+    '''
+    fan = xflowlib.FunctionKernel(_fanout)
+    fan.set_inputs(['n'])
+    fan.set_outputs(['out{}'.format(i) for i in range(fanout)])
+    times = []
+    for i in range(repeats):
+        t0 = time.time()
+        result = client.submit(fan, fanout)
+        if fanout > 1:
+            client.client.gather(list(result))
+        else:
+            result.result()
+        times.append(time.time() - t0)
+    record = {'benchmark': 'unpack_fanout', 'fanout': fanout,
+              'total': _stats(times)}
+    record['per_output'] = record['total']['median'] / fanout
+    return record
+
+def interface_width(client, width, repeats=3):
+    '''
+    Time a scatter/gather pair of InterfaceKernels of the given width.
+    '''
+    scatter = InterfaceKernel(['rep ]= {reps}'])
+    gather = InterfaceKernel(['done [= {rep}'])
+    times = []
+    for i in range(repeats):
+        pipeline = Pipeline(client.client, [scatter, gather])
+        t0 = time.time()
+        result = pipeline.run({'reps': list(range(width))})
+        times.append(time.time() - t0)
+        if result['returncode'] != 0:
+            raise RuntimeError('Error - interface benchmark failed')
+    record = {'benchmark': 'interface_width', 'width': width,
+              'total': _stats(times)}
+    record['per_task'] = record['total']['median'] / width
+    return record
+
+def run_suite(client, fh_types, sizes, widths, repeats=3, log=None):
+    '''
+    Run all the benchmarks.
+
+    args:
+        client (XflowClient): the client
+        fh_types (list): the file handlers to test
+        sizes (list): the file sizes to test, in bytes
+        widths (list): the widths to use for the task-overhead benchmarks
+        repeats (int): number of repeats of each measurement
+        log (function, optional): called with each record as it is made
+
+    returns:
+        list: the records. Configurations that fail give a record with an
+            'error' key.
+    '''
+    jobs = []
+    for fh_type in fh_types:
+        for size in sizes:
+            jobs.append((transport, fh_type, size))
+    for width in widths:
+        jobs.append((map_width, width))
+        jobs.append((unpack_fanout, width))
+        jobs.append((interface_width, width))
+    records = [metadata(client)]
+    for job in jobs:
+        try:
+            record = job[0](client, *job[1:], repeats=repeats)
+        except Exception as e:
+            record = {'benchmark': job[0].__name__, 'config': list(job[1:]),
+                      'error': str(e)}
+        if log is not None:
+            log(record)
+        records.append(record)
+    return records
+
+def _key(record):
+    '''
+    The configuration a record describes.
+    '''
+    config = [record['benchmark']]
+    for k in ['filehandler', 'size', 'width', 'fanout']:
+        if k in record:
+            config.append(record[k])
+    return tuple(config)
+
+def compare(records, baseline, tolerance=0.2):
+    '''
+    Find benchmarks that have got slower.
+
+    args:
+        records (list): the new results
+        baseline (list): the results to compare against
+        tolerance (float): the fractional slow-down to tolerate
+
+    returns:
+        list: (configuration, baseline time, new time) for each regression,
+            comparing median total times.
+    '''
+    old = {}
+    for record in baseline:
+        if 'total' in record:
+            old[_key(record)] = record['total']['median']
+    regressions = []
+    for record in records:
+        key = _key(record)
+        if 'total' in record and key in old:
+            if record['total']['median'] > old[key] * (1.0 + tolerance):
+                regressions.append((key, old[key], record['total']['median']))
+    return regressions
@@ -0,0 +1,213 @@
+'''
+checkpoints.py: let long-running kernels survive spot instance interruptions.
+
+A SubprocessKernel can declare the checkpoint files its command writes:
+
+    mdrun = SubprocessKernel('gmx mdrun -s x.tpr -cpi state.cpt -c x.gro')
+    mdrun.set_checkpoints(['state.cpt'])
+
+While the command runs, the worker polls the EC2 instance metadata for a
+spot interruption notice. When one arrives, the command is sent SIGTERM
+(which makes e.g. GROMACS write a checkpoint and stop), the checkpoint
+files are copied to shared storage, and the dask worker shuts itself down
+(so the scheduler sends it no more tasks) and asks the scheduler to run the
+task again, on another worker, where the checkpoint files are restored
+into the working directory before the command starts. Only interruptions
+are rerun like this; a task that fails for any other reason fails as usual.
+Outside a dask worker, or once a task has been interrupted more times than
+the kernel allows, the kernel raises a SpotInterruption instead.
+
+Checkpoints are kept in $XFLOW_CHECKPOINT_DIR if that is set, else in
+$SHARED/<session>/checkpoints, one directory per dask task; as they must
+outlive the worker, it is an error if neither is set. Set
+XFLOW_SPOT_METADATA_URL to point the watcher somewhere other than the EC2
+metadata service, e.g. a file:// URL for testing.
+'''
+from __future__ import print_function
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+from dask.distributed import get_worker
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+METADATA_URL = 'http://169.254.169.254/latest/meta-data/spot/instance-action'
+POLL_INTERVAL = 5.0
+GRACE_PERIOD = 60.0
+# counts the interruptions of a task, in its checkpoint directory
+INTERRUPTIONS_FILE = '.interruptions'
+
+def metadata_url():
+    return os.getenv('XFLOW_SPOT_METADATA_URL', METADATA_URL)
+
+def interruption_notice(url=None):
+    '''
+    Returns the spot interruption notice for this instance, or None if
+    there is not one (or the metadata service cannot be reached).
+    '''
+    if url is None:
+        url = metadata_url()
+    try:
+        response = urlopen(url, timeout=1)
+        notice = response.read().decode('utf-8').strip()
+        response.close()
+    except Exception:
+        return None
+    if notice == '':
+        return None
+    return notice
+
+def checkpoint_dir(session_dir, key):
+    '''
+    The directory that holds the checkpoints for a task.
+    '''
+    root = os.getenv('XFLOW_CHECKPOINT_DIR')
+    if root is None:
+        shared = os.getenv('SHARED')
+        if shared is None:
+            raise IOError('Error - checkpoints need shared storage: set '
+                          '$XFLOW_CHECKPOINT_DIR or $SHARED')
+        root = os.path.join(shared, session_dir, 'checkpoints')
+    return os.path.join(root, str(key))
+
+def restore(ckpt_dir):
+    '''
+    Copy any saved checkpoint files into the current directory.
+
+    returns:
+        list: the names of the files restored
+    '''
+    if not os.path.isdir(ckpt_dir):
+        return []
+    restored = []
+    for filename in os.listdir(ckpt_dir):
+        if not filename.startswith('.'):
+            shutil.copy(os.path.join(ckpt_dir, filename), filename)
+            restored.append(filename)
+    return restored
+
+def flush(filenames, ckpt_dir):
+    '''
+    Copy checkpoint files from the current directory to the checkpoint
+    directory. Each file is replaced atomically, so an interrupted flush
+    leaves the previous checkpoint intact.
+    '''
+    if not os.path.exists(ckpt_dir):
+        os.makedirs(ckpt_dir)
+    for filename in filenames:
+        if os.path.exists(filename):
+            tmp_path = tempfile.NamedTemporaryFile(dir=ckpt_dir, prefix='.',
+                                                   delete=False).name
+            shutil.copy(filename, tmp_path)
+            os.rename(tmp_path, os.path.join(ckpt_dir, os.path.basename(filename)))
+
+def record_interruption(ckpt_dir):
+    '''
+    Count an interruption of the task whose checkpoints are in ckpt_dir.
+
+    returns:
+        int: the number of times it has been interrupted, including this one
+    '''
+    if not os.path.exists(ckpt_dir):
+        os.makedirs(ckpt_dir)
+    counter = os.path.join(ckpt_dir, INTERRUPTIONS_FILE)
+    count = 0
+    if os.path.exists(counter):
+        with open(counter) as f:
+            count = int(f.read().strip() or 0)
+    count += 1
+    with open(counter, 'w') as f:
+        f.write(str(count))
+    return count
+
+def leave_cluster():
+    '''
+    If this is running on a dask worker, shut the worker down gracefully:
+    the scheduler stops sending it tasks at once, and moves its data
+    elsewhere before it closes. It is not restarted.
+
+    returns:
+        bool: True if this is a dask worker, which is now leaving
+    '''
+    try:
+        worker = get_worker()
+    except ValueError:
+        return False
+    worker.loop.add_callback(worker.close_gracefully,
+                             reason='spot-interruption')
+    return True
+
+def discard(ckpt_dir):
+    '''
+    Remove the checkpoints for a task that has completed.
+    '''
+    shutil.rmtree(ckpt_dir, ignore_errors=True)
+
+class CheckpointWatcher(object):
+    '''
+    Watches for a spot interruption notice while a command runs, and keeps
+    its checkpoint files flushed to shared storage.
+    '''
+    def __init__(self, filenames, ckpt_dir, interval=None):
+        """
+        Arguments:
+            filenames (list): the checkpoint files
+            ckpt_dir (str): where to flush them to
+            interval (float, optional): also flush every interval seconds
+        """
+        self.filenames = filenames
+        self.ckpt_dir = ckpt_dir
+        self.interval = interval
+        self.interrupted = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._process = None
+
+    def start(self, process):
+        """
+        Start watching, on behalf of a running process (a subprocess.Popen
+        started in a new session).
+        """
+        self._process = process
+        self._thread = threading.Thread(target=self._watch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _watch(self):
+        last_flush = time.time()
+        url = metadata_url()
+        while not self._stop.wait(POLL_INTERVAL):
+            if interruption_notice(url) is not None:
+                self.interrupted = True
+                self._signal(signal.SIGTERM)
+                deadline = time.time() + GRACE_PERIOD
+                while self._process.poll() is None and time.time() < deadline:
+                    time.sleep(0.5)
+                if self._process.poll() is None:
+                    self._signal(signal.SIGKILL)
+                return
+            if self.interval is not None and time.time() - last_flush > self.interval:
+                flush(self.filenames, self.ckpt_dir)
+                last_flush = time.time()
+
+    def _signal(self, sig):
+        try:
+            os.killpg(self._process.pid, sig)
+        except OSError:
+            pass
+
+    def stop(self):
+        """
+        Stop watching. If the command was interrupted, flush its checkpoint
+        files now that it has stopped.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.interrupted:
+            flush(self.filenames, self.ckpt_dir)
@@ -2,13 +2,34 @@
 Clients.py: thin wrapper over dask client
 '''
 from __future__ import print_function
+import asyncio
+import functools
 import socket
 import hashlib
 import subprocess
 import glob
 import os
+import sys
 from dask.distributed import Client, LocalCluster
+from dask.sizeof import sizeof
+from . import xflowlib
 from .xflowlib import FunctionKernel, SubprocessKernel
+from .filehandling import (FileHandle, CompressedFileHandle, SharedFileHandle,
+                           ObjectStoreFileHandle)
+from .speculation import Speculator
+
+@sizeof.register(FileHandle)
+def sizeof_filehandle(fh):
+    '''
+    Report the memory a FileHandle takes up. Only a CompressedFileHandle
+    holds its data in memory; the others just hold a path, and the size of
+    the file they refer to is used for locality hints instead (see
+    XflowClient.locality_hints()), so it does not count towards the
+    worker's managed memory.
+    '''
+    if isinstance(fh, CompressedFileHandle):
+        return sys.getsizeof(fh) + len(fh.compressed_data)
+    return sys.getsizeof(fh)
 
 def dask_client(scheduler_file=None, local=False, port=8786):
     """
@@ -30,6 +51,73 @@ def dask_client(scheduler_file=None, local=False, port=8786):
             client = Client(cluster)
     return client
 
+async def async_dask_client(scheduler_file=None, local=False, port=8786):
+    """
+    returns an instance of an asynchronous dask.distributed client
+    """
+    if local:
+        cluster = await LocalCluster(asynchronous=True)
+        client = await Client(cluster, asynchronous=True)
+    elif scheduler_file:
+        client = await Client(scheduler_file=scheduler_file, asynchronous=True)
+    else:
+        ip_address = socket.gethostbyname(socket.gethostname())
+        dask_scheduler = '{}:{}'.format(ip_address, port)
+        try:
+            client = await Client(dask_scheduler, timeout=5, asynchronous=True)
+        except IOError:
+            print('Warning: using local dask client')
+            cluster = await LocalCluster(asynchronous=True)
+            client = await Client(cluster, asynchronous=True)
+    return client
+
+def node_info():
+    """
+    Returns information about the node this is run on that is relevant to
+    the choice of file handler.
+    """
+    shared = os.getenv('SHARED')
+    return {'host': socket.gethostname(),
+            'shared': shared is not None and os.path.isdir(shared),
+            'bucket': os.getenv('XFLOWBUCKETNAME')}
+
+def _host_map(hostnames):
+    '''
+    Invert a dict of worker hostnames, keyed by worker address.
+    '''
+    hosts = {}
+    for address, hostname in hostnames.items():
+        hosts.setdefault(hostname, []).append(address)
+    return hosts
+
+def min_worker_cores(workers):
+    '''
+    The cores advertised by the smallest worker (see
+    xflowlib.resource_requirements()), from the 'workers' entry of the dask
+    scheduler_info(), or None if no worker advertises them.
+    '''
+    cores = [w.get('resources', {}).get('cores') for w in workers.values()]
+    cores = [c for c in cores if c]
+    if len(cores) == 0:
+        return None
+    return min(cores)
+
+def _topology(here, there):
+    '''
+    Work out the cluster topology from the node_info() of the client
+    (here) and a dict of the node_info() of each worker (there).
+    '''
+    there = list(there.values())
+    if len(there) == 0:
+        raise RuntimeError('Error - the cluster has no workers')
+    same_host = all([t['host'] == here['host'] for t in there])
+    shared = here['shared'] and all([t['shared'] for t in there])
+    object_store = (here['bucket'] is not None and
+                    all([t['bucket'] == here['bucket'] for t in there]))
+    return {'same_host': same_host,
+            'shared': shared,
+            'object_store': object_store}
+
 class XflowClient(object):
     '''Thin wrapper around Dask client so functions that return multiple
        values (tuples) generate tuples of futures rather than single futures.
@@ -37,6 +125,9 @@ class XflowClient(object):
     def __init__(self, **kwargs):
         self.tmpdir = kwargs.pop('tmpdir', None)
         self.client = dask_client(**kwargs)
+        self.hosts = None
+        self.worker_cores = None
+        self.speculator = None
 
     def cluster(self):
         """
@@ -50,6 +141,33 @@ class XflowClient(object):
         """
         return self.client.close
 
+    def set_speculation(self, percentile=90, factor=1.5, min_samples=5,
+                        max_copies=1, interval=1.0):
+        """
+        Switch on speculative execution of kernels: if a run takes much
+        longer than usual (e.g. because it landed on a slow node), a
+        duplicate is launched on an idle worker, and whichever copy finishes
+        first supplies the result. See the speculation module.
+
+        args:
+            percentile (float): a run is a straggler if it takes longer than
+                this percentile of the durations of the kernel so far...
+            factor (float): ...times this factor
+            min_samples (int): do not speculate about a kernel until it has
+                run this many times
+            max_copies (int): the most duplicates to launch of any one run
+            interval (float): seconds between checks for stragglers
+
+        returns:
+            Speculator
+        """
+        if self.speculator is not None:
+            self.speculator.stop()
+        self.speculator = Speculator(self.client, percentile=percentile,
+                                     factor=factor, min_samples=min_samples,
+                                     max_copies=max_copies, interval=interval)
+        return self.speculator
+
     def upload(self, some_object):
         """
         Upload some data/object to the Xbow cluster.
@@ -84,6 +202,86 @@ class XflowClient(object):
             outputs.append(self.client.submit(lambda tup, j: tup[j], future, i))
         return tuple(outputs)
 
+    def _check_hosts(self):
+        '''
+        Update the record of which workers are on which host, used for
+        locality hints, if workers have joined or left the cluster.
+        '''
+        workers = self.client.scheduler_info()['workers']
+        addresses = set(workers)
+        if self.hosts is None or self.hosts[0] != addresses:
+            self.hosts = (addresses,
+                          _host_map(self.client.run(socket.gethostname)))
+            self.worker_cores = min_worker_cores(workers)
+
+    def _workers_on(self, host):
+        '''
+        Returns the addresses of the workers on the named host.
+        '''
+        if self.hosts is None:
+            return []
+        return self.hosts[1].get(host, [])
+
+    def locality_hints(self, args, refresh=True):
+        '''
+        Find where the file data passed to a task resides.
+
+        Futures are dealt with by the dask scheduler itself, but for
+        FileHandles passed directly, the task should preferably run on the
+        host that holds most of their data. Handles whose data is on shared
+        storage (the shared file system or the object store) are equally
+        close to every worker, so are ignored.
+
+        args:
+            args (list): the task arguments
+            refresh (bool, optional): check first for workers that have
+                joined or left the cluster
+
+        returns:
+            dict: keyword arguments for the dask submit() method
+        '''
+        sizes = {}
+        for arg in args:
+            if isinstance(arg, (list, tuple)):
+                handles = arg
+            else:
+                handles = [arg]
+            for fh in handles:
+                if not isinstance(fh, FileHandle) or fh.host is None:
+                    continue
+                if isinstance(fh, (SharedFileHandle, ObjectStoreFileHandle)):
+                    continue
+                sizes[fh.host] = sizes.get(fh.host, 0) + fh.size
+        if len(sizes) == 0:
+            return {}
+        if refresh:
+            self._check_hosts()
+        host = max(sizes, key=sizes.get)
+        workers = self._workers_on(host)
+        if len(workers) == 0:
+            return {}
+        return {'workers': workers, 'allow_other_workers': True}
+
+    def _task_options(self, kernel, hints):
+        '''
+        Returns the keyword arguments for dask submit() or map() for a
+        kernel: its resource requirements, plus any locality hints.
+
+        If the workers advertise their cores, a kernel that declares no
+        cores takes all of a worker's, as it may well be multithreaded, so
+        such kernels run one at a time on each worker.
+        '''
+        options = dict(hints)
+        resources = dict(kernel.resources)
+        if not 'cores' in resources:
+            if self.hosts is None:
+                self._check_hosts()
+            if self.worker_cores is not None:
+                resources['cores'] = self.worker_cores
+        if resources:
+            options['resources'] = resources
+        return options
+
     def submit(self, func, *args):
         """
         Wrapper round the dask submit() method, so that a tuple of
@@ -95,16 +293,39 @@ class XflowClient(object):
         returns:
             future or tuple of futures
         """
-        if isinstance(func, SubprocessKernel):
-            func.tmpdir = self.tmpdir
-            future = self.client.submit(func.run, *args, pure=False)
-            return self.unpack(func, future)
-        if isinstance(func, FunctionKernel):
-            func.tmpdir = self.tmpdir
-            future = self.client.submit(func.run, *args, pure=False)
-            return self.unpack(func, future)
+        if isinstance(func, (SubprocessKernel, FunctionKernel)):
+            return self.unpack(func, self.submit_packed(func, *args))
         else:
-            return self.client.submit(func, *args)
+            return self.client.submit(func, *args, **self.locality_hints(args))
+
+    def submit_packed(self, func, *args):
+        """
+        Like submit(), but always returns a single future: for a kernel
+        with several outputs, one for the tuple of them (e.g. to wait for
+        with dask's as_completed()). Plain functions are not assumed to be
+        pure, so each call runs them again.
+
+        args:
+            func (function/kernel): the function to be run
+            args (list): the function arguments
+        returns:
+            future
+        """
+        hints = self.locality_hints(args)
+        if isinstance(func, (SubprocessKernel, FunctionKernel)):
+            func.tmpdir = self.tmpdir
+            return self._submit_kernel(func, args,
+                                       self._task_options(func, hints))
+        return self.client.submit(func, *args, pure=False, **hints)
+
+    def _submit_kernel(self, kernel, args, options):
+        '''
+        Submit a kernel run, speculatively if that is switched on.
+        '''
+        if self.speculator is not None:
+            return self.speculator.submit(kernel.name, kernel.run, args,
+                                          options)
+        return self.client.submit(kernel.run, *args, pure=False, **options)
 
     def _lt2tl(self, l):
         '''converts a list of tuples to a tuple of lists'''
@@ -140,16 +361,28 @@ class XflowClient(object):
                 its.append(iterable)
             else:
                 its.append([iterable] * maxlen)
-        if isinstance(func, SubprocessKernel):
-            func.tmpdir = self.tmpdir
-            futures = self.client.map(func.run, *its, pure=False)
-            result = [self.unpack(func, future) for future in futures]
-        elif isinstance(func, FunctionKernel):
+        if isinstance(func, (SubprocessKernel, FunctionKernel)):
             func.tmpdir = self.tmpdir
-            futures = self.client.map(func.run, *its, pure=False)
-            result = [self.unpack(func, future) for future in futures]
+            run = func.run
+            options = self._task_options(func, {})
+        else:
+            run = func
+            options = {}
+        self._check_hosts()
+        hints = [self.locality_hints(args, refresh=False) for args in zip(*its)]
+        if self.speculator is not None and run is not func:
+            futures = self.speculator.map(func.name, run, list(zip(*its)),
+                                          [dict(options, **hint) for hint in hints])
+        elif any(hints):
+            futures = [self.client.submit(run, *args, pure=False,
+                                          **dict(options, **hint))
+                       for args, hint in zip(zip(*its), hints)]
+        else:
+            futures = self.client.map(run, *its, pure=False, **options)
+        if run is func:
+            result = futures
         else:
-            result =  self.client.map(func, *its, pure=False)
+            result = [self.unpack(func, future) for future in futures]
         if isinstance(result[0], tuple):
             result = self._lt2tl(result)
         return result
@@ -159,17 +392,36 @@ class XflowClient(object):
         Run a command on all workers in a cluster.
         '''
         full_cmd = 'cd {}; {}'.format(os.getcwd(), cmd)
-        def myfunc(cmd):
-            try:
-                r = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
-                returncode = 0
-            except subprocess.CalledProcessError as e:
-                r = e.output
-                returncode = e.returncode
-            return {'returncode': returncode, 'output': r}
-        result = self.client.run(myfunc, full_cmd)
+        result = self.client.run(_run_command, full_cmd)
         return result
 
+    def detect_topology(self):
+        '''
+        Find out how file data can travel between this client and the
+        workers.
+
+        returns:
+            dict: with keys 'same_host' (all workers are on this host),
+                'shared' (the client and all workers have $SHARED mounted)
+                and 'object_store' (the client and all workers use the same
+                bucket).
+        '''
+        return _topology(node_info(), self.client.run(node_info))
+
+    def set_adaptive_filehandler(self, **kwargs):
+        '''
+        Select the 'adaptive' file handler, configured for the topology of
+        this cluster. This should be called before any kernels are created.
+
+        args:
+            kwargs: other arguments for AdaptiveFileHandler, e.g. the
+                'small' and 'large' file size thresholds.
+        '''
+        topology = self.detect_topology()
+        topology.update(kwargs)
+        xflowlib.set_filehandler('adaptive', **topology)
+        return xflowlib.filehandler
+
     def install(self, package, sudo=False):
         '''
         Install a package on all workers in a cluster.
@@ -190,6 +442,161 @@ class XflowClient(object):
         if errors:
             raise RuntimeError(errortext)
 
+class AsyncXflowClient(XflowClient):
+    '''Version of XflowClient for use in an asyncio event loop.
+
+       The submit() and map() methods return immediately, as for
+       XflowClient; the futures they return can be awaited. Methods that
+       must talk to the cluster (upload(), gather(), execall(), etc.) are
+       coroutines. Use it like this:
+
+           async with AsyncXflowClient() as client:
+               output = client.submit(kernel, inputfile)
+               result = await output
+    '''
+    def __init__(self, **kwargs):
+        self.tmpdir = kwargs.pop('tmpdir', None)
+        self.kwargs = kwargs
+        self.local = kwargs.get('local', False)
+        self.client = None
+        self.hosts = None
+        self.worker_cores = None
+        self.speculator = None
+
+    async def start(self):
+        """
+        Connect to the cluster
+        """
+        if self.client is None:
+            self.client = await async_dask_client(**self.kwargs)
+        await self.refresh_hosts()
+        return self
+
+    async def refresh_hosts(self):
+        """
+        Update the record of which workers are on which host, used for
+        locality hints. Call this if workers join the cluster.
+        """
+        workers = self.client.scheduler_info()['workers']
+        self.hosts = (set(workers),
+                      _host_map(await self.client.run(socket.gethostname)))
+        self.worker_cores = min_worker_cores(workers)
+
+    def _check_hosts(self):
+        '''
+        The record of hosts can only be updated by a coroutine: see
+        refresh_hosts().
+        '''
+        pass
+
+    def __await__(self):
+        return self.start().__await__()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """
+        Close the underlying dask client (and local cluster, if any)
+        """
+        if self.speculator is not None:
+            self.speculator.stop()
+        cluster = self.client.cluster
+        await self.client.close()
+        if self.local and cluster is not None:
+            await cluster.close()
+
+    async def upload(self, some_object):
+        """
+        Upload some data/object to the Xbow cluster.
+
+        args:
+            some_object (any type): what to upload
+
+        returns:
+            dask.Future
+        """
+        return await self.client.scatter(some_object, broadcast=True)
+
+    async def gather(self, futures):
+        """
+        Wait for futures (or lists/tuples of futures) and return their results.
+        """
+        return await self.client.gather(futures)
+
+    async def run_local(self, func, *args):
+        """
+        Run a function on the client (e.g. analysis of results so far) in a
+        separate thread, so the event loop, and hence the cluster, is kept
+        busy in the meantime.
+
+        args:
+            func (function): the function to run
+            args (list): the function arguments
+
+        returns:
+            whatever func returns
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, functools.partial(func, *args))
+
+    async def detect_topology(self):
+        '''
+        Coroutine version of XflowClient.detect_topology()
+        '''
+        return _topology(node_info(), await self.client.run(node_info))
+
+    async def set_adaptive_filehandler(self, **kwargs):
+        '''
+        Coroutine version of XflowClient.set_adaptive_filehandler()
+        '''
+        topology = await self.detect_topology()
+        topology.update(kwargs)
+        xflowlib.set_filehandler('adaptive', **topology)
+        return xflowlib.filehandler
+
+    async def execall(self, cmd):
+        '''
+        Run a command on all workers in a cluster.
+        '''
+        full_cmd = 'cd {}; {}'.format(os.getcwd(), cmd)
+        return await self.client.run(_run_command, full_cmd)
+
+    async def install(self, package, sudo=False):
+        '''
+        Install a package on all workers in a cluster.
+        '''
+        if sudo:
+            cmd = 'sudo pip install {}'.format(package)
+        else:
+            cmd = 'pip install {}'.format(package)
+
+        result = await self.execall(cmd)
+        errors = False
+        errortext = ''
+        for key in result.keys():
+            if result[key]['returncode'] != 0:
+                errortext += 'Warning: install failed for worker {}\n'.format(key)
+                errortext += result[key]['output'].decode('utf-8')
+                errors = True
+        if errors:
+            raise RuntimeError(errortext)
+
+def _run_command(cmd):
+    '''
+    Run a shell command, returning its output and exit status.
+    '''
+    try:
+        r = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
+        returncode = 0
+    except subprocess.CalledProcessError as e:
+        r = e.output
+        returncode = e.returncode
+    return {'returncode': returncode, 'output': r}
+
 def md5checksum(filename):
     """
     Returns the md5 checksum of a file
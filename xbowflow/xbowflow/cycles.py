@@ -0,0 +1,116 @@
+'''
+cycles.py: pipelined execution of iterative workflows.
+
+Many workflows (e.g. CoCo-MD, or the RMSD_Loop example) have the same
+structure: run a set of replica simulations, analyse the results, use the
+analysis to generate the inputs for the next set of replicas, and repeat.
+Written as a simple loop on the client, each cycle waits for every replica
+to finish and be pulled back before the analysis starts, and the workers
+sit idle while the client does the analysis.
+
+A CycleRunner runs the same workflow with the analysis step as a cluster
+task. As soon as enough replicas of a cycle have finished, the analysis is
+submitted, and the next cycle's replicas are submitted straight after it,
+so they start as soon as the analysis finishes without a round trip to the
+client. Replicas that finish late are folded into a later analysis. The
+growing state (e.g. the trajectory so far) is passed from one analysis to
+the next as a future, so it stays on the cluster:
+
+    def analyse(state, results):
+        # state: whatever the last analysis returned (or the initial state)
+        # results: list of outputs from simulate, in completion order
+        ...
+        return new_state, next_inputs    # len(next_inputs) == n_replicas
+
+    runner = CycleRunner(client, simulate, analyse, quorum=8)
+    state = runner.run(initial_state, initial_inputs, n_cycles=40)
+    final_state = state.result()
+
+simulate and analyse can be kernels or plain functions.
+'''
+from __future__ import print_function
+from dask.distributed import as_completed
+
+def _pick(result, *indices):
+    '''
+    Extract an element from a (nested) result.
+    '''
+    for i in indices:
+        result = result[i]
+    return result
+
+class CycleRunner(object):
+    '''
+    Runs an iterative simulate/analyse workflow with the cycles pipelined.
+    '''
+    def __init__(self, client, simulate, analyse, quorum=None):
+        """
+        Arguments:
+            client (XflowClient): the client for the cluster
+            simulate (kernel or function): run on each replica input, to
+                give one replica result
+            analyse (kernel or function): called with the current state
+                and a list of replica results; returns a tuple of the new
+                state and a list of inputs for the next cycle.
+            quorum (int, optional): how many replicas of a cycle must have
+                finished before its analysis is submitted. Default is all
+                of them.
+        """
+        self.client = client
+        self.simulate = simulate
+        self.analyse = analyse
+        if quorum is not None and quorum < 1:
+            raise ValueError('Error - quorum must be at least 1')
+        self.quorum = quorum
+        self.cycle = 0
+
+    def run(self, state, inputs, n_cycles, callback=None):
+        """
+        Run the workflow.
+
+        Arguments:
+            state: the initial state (or a future for it)
+            inputs (list): inputs (or futures) for the first cycle
+            n_cycles (int): the number of cycles to run
+            callback (function, optional): called as callback(cycle, state)
+                each time the analysis for a cycle is submitted, where
+                state is a future for the result of that analysis.
+
+        Returns:
+            Future: the state returned by the last analysis. The last cycle
+                waits for all its replicas, so no results are lost.
+        """
+        n_replicas = len(inputs)
+        if n_replicas == 0:
+            raise ValueError('Error - no inputs')
+        quorum = self.quorum
+        if quorum is None or quorum > n_replicas:
+            quorum = n_replicas
+        dask_client = self.client.client
+        late = []
+        for cycle in range(n_cycles):
+            self.cycle = cycle
+            replicas = [self.client.submit_packed(self.simulate, i)
+                        for i in inputs]
+            if cycle == n_cycles - 1:
+                quorum = n_replicas
+            pending = late + replicas
+            finished = []
+            waiting = as_completed(pending)
+            for future in waiting:
+                finished.append(future)
+                if len([f for f in finished if f in replicas]) >= quorum:
+                    break
+            waiting.clear()
+            late = [f for f in pending if not f in finished]
+            if cycle == n_cycles - 1:
+                finished += late
+                late = []
+            analysis = self.client.submit_packed(self.analyse, state, finished)
+            state = dask_client.submit(_pick, analysis, 0, pure=False)
+            if callback is not None:
+                callback(cycle, state)
+            if cycle < n_cycles - 1:
+                inputs = [dask_client.submit(_pick, analysis, 1, i, pure=False)
+                          for i in range(n_replicas)]
+        return state
@@ -6,10 +6,18 @@ file system.
 from __future__ import print_function
 
 import os
+import fcntl
+import socket
 import tempfile
 import zlib
+import hashlib
+import uuid
+from contextlib import contextmanager
 from shutil import copyfile
 
+S3_CHUNKSIZE = 8 * 1024 * 1024
+S3_MAX_CONCURRENCY = 10
+
 '''
 This module defines classes to handle files in distributed environments
 where filesyatems may not be shared.
@@ -32,10 +40,17 @@ and also an as_file() method which returns a path that points at a (maybe tempor
 class FileHandle(object):
     '''
     Base class for file handlers
+
+    Attributes:
+        host (str or None): name of the host where the file data resides,
+            or None if the data travels with the handle itself
+        size (int): size of the file data, in bytes
     '''
     def __init__(self, path, session_dir=None):
         self.path = os.path.abspath(path)
         self.session_dir = session_dir
+        self.host = socket.gethostname()
+        self.size = os.path.getsize(self.path)
    
     def __str__(self):
         return "Filehandle for file {}".format(self.path)
@@ -145,6 +160,7 @@ class CompressedFileHandle(FileHandle):
     '''
     def __init__(self, path, session_dir=None):
         super(CompressedFileHandle, self).__init__(path)
+        self.host = None
         with open(self.path, 'rb') as f:
             self.compressed_data = zlib.compress(f.read())
 
@@ -169,3 +185,343 @@ class CompressedFileHandle(FileHandle):
         ext = os.path.splitext(self.path)[1]
         tmp_path = tempfile.NamedTemporaryFile(suffix=ext, delete=False).name
         return self.save(tmp_path)
+
+def shm_root():
+    """
+    Returns the directory used for POSIX shared memory payloads.
+
+    This is /dev/shm unless the environment variable $XFLOW_SHM_DIR says
+    otherwise.
+    """
+    shm_dir = os.getenv('XFLOW_SHM_DIR', '/dev/shm')
+    if not os.path.isdir(shm_dir):
+        raise IOError('Error - shared memory directory {} does not exist'.format(shm_dir))
+    return shm_dir
+
+@contextmanager
+def _shm_lock(shm_dir):
+    """
+    Hold an exclusive lock on a shared memory session directory, so that a
+    payload cannot be deleted while another handle is linking to it.
+    """
+    with open(os.path.join(shm_dir, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class SharedMemoryFileHandle(FileHandle):
+    '''
+    File handler that stores data in POSIX shared memory (/dev/shm).
+    Only works if all workers reside on the same host, but then as_file()
+    returns the shared memory path itself, so no copy is ever made.
+
+    Identical payloads are stored once. Each handle holds a hard link to
+    the payload, so the link count is the reference count, and the payload
+    is deleted when the last handle is released.
+    '''
+    def __init__(self, path, session_dir=None):
+        super(SharedMemoryFileHandle, self).__init__(path, session_dir)
+        shm_dir = os.path.join(shm_root(), session_dir)
+        if not os.path.exists(shm_dir):
+            try:
+                os.mkdir(shm_dir)
+            except OSError:
+                pass
+        ext = os.path.splitext(path)[1]
+        self.shm_path = os.path.join(shm_dir, md5sum(self.path) + ext)
+        self.ref_path = '{}.{}.ref'.format(self.shm_path, uuid.uuid4().hex)
+        with _shm_lock(shm_dir):
+            if not os.path.exists(self.shm_path):
+                tmp_path = tempfile.NamedTemporaryFile(dir=shm_dir,
+                                                       delete=False).name
+                copyfile(self.path, tmp_path)
+                os.rename(tmp_path, self.shm_path)
+            os.link(self.shm_path, self.ref_path)
+
+    def save(self, path):
+        """
+        Save a copy of the file
+
+        args:
+            path (str): path for the saved file
+
+        returns:
+            str: path of the saved file
+        """
+        copyfile(self.shm_path, path)
+        return path
+
+    def as_file(self):
+        """
+        Returns a path that points at the file
+        """
+        return self.shm_path
+
+    def refcount(self):
+        """
+        Returns the number of live handles that share this payload
+        """
+        try:
+            return os.stat(self.shm_path).st_nlink - 1
+        except OSError:
+            return 0
+
+    def release(self):
+        """
+        Drop this handle's reference to the payload, deleting the payload
+        if no other handle refers to it.
+        """
+        with _shm_lock(os.path.dirname(self.shm_path)):
+            try:
+                os.remove(self.ref_path)
+            except OSError:
+                return
+            if self.refcount() == 0:
+                try:
+                    os.remove(self.shm_path)
+                except OSError:
+                    pass
+
+def s3_client():
+    """
+    Returns a boto3 client for the object store.
+
+    If the environment variable $XFLOW_S3_ENDPOINT is set, it is used as the
+    endpoint URL, so a local S3-compatible stand-in (e.g. moto server or
+    MinIO) can be used in place of AWS S3.
+    """
+    try:
+        import boto3
+    except ImportError:
+        raise ImportError('Error - the "s3" filehandler requires boto3')
+    return boto3.client('s3', endpoint_url=os.getenv('XFLOW_S3_ENDPOINT'))
+
+def s3_transfer_config():
+    """
+    Returns the boto3 TransferConfig used for multipart parallel transfers.
+    """
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(multipart_threshold=S3_CHUNKSIZE,
+                          multipart_chunksize=S3_CHUNKSIZE,
+                          max_concurrency=S3_MAX_CONCURRENCY)
+
+def s3_bucket_name():
+    """
+    Returns the name of the bucket used by the object store file handler.
+    """
+    bucket = os.getenv('XFLOWBUCKETNAME')
+    if bucket is None:
+        raise IOError('Error - environment variable $XFLOWBUCKETNAME is not set')
+    return bucket
+
+def cache_root():
+    """
+    Returns the directory used for the local content-addressed cache.
+
+    This is $XFLOW_CACHE_DIR if set, else a directory in $TMPDIR.
+    """
+    cache_dir = os.getenv('XFLOW_CACHE_DIR')
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'xflow-cache')
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass
+    return cache_dir
+
+def md5sum(path, blocksize=S3_CHUNKSIZE):
+    """
+    Returns the md5 checksum of a file, reading it in blocks
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+class ObjectStoreFileHandle(FileHandle):
+    '''
+    File handler that stores data in an S3-compatible object store, in the
+    bucket named by $XFLOWBUCKETNAME.
+
+    Uploads and downloads are multipart and parallel. Objects are named by
+    their content, and each node keeps a local content-addressed cache, so
+    a node fetches any given payload at most once.
+    '''
+    def __init__(self, path, session_dir=None):
+        super(ObjectStoreFileHandle, self).__init__(path, session_dir)
+        self.bucket = s3_bucket_name()
+        ext = os.path.splitext(path)[1]
+        self.digest = md5sum(self.path)
+        self.key = '{}/{}{}'.format(session_dir, self.digest, ext)
+        from botocore.exceptions import ClientError
+        client = s3_client()
+        try:
+            client.head_object(Bucket=self.bucket, Key=self.key)
+        except ClientError:
+            client.upload_file(self.path, self.bucket, self.key,
+                               Config=s3_transfer_config())
+        cache_path = self._cache_path()
+        if not os.path.exists(cache_path):
+            tmp_path = tempfile.NamedTemporaryFile(dir=cache_root(),
+                                                   delete=False).name
+            copyfile(self.path, tmp_path)
+            os.rename(tmp_path, cache_path)
+
+    def _cache_path(self):
+        ext = os.path.splitext(self.key)[1]
+        return os.path.join(cache_root(), self.digest + ext)
+
+    def save(self, path):
+        """
+        Save a copy of the file
+
+        args:
+            path (str): path for the saved file
+
+        returns:
+            str: path of the saved file
+        """
+        copyfile(self.as_file(), path)
+        return path
+
+    def as_file(self):
+        """
+        Returns a path that points at the file (in the local cache)
+        """
+        cache_path = self._cache_path()
+        if not os.path.exists(cache_path):
+            tmp_path = tempfile.NamedTemporaryFile(dir=cache_root(),
+                                                   delete=False).name
+            s3_client().download_file(self.bucket, self.key, tmp_path,
+                                      Config=s3_transfer_config())
+            os.rename(tmp_path, cache_path)
+        return cache_path
+
+    def read(self, start=0, length=None):
+        """
+        Read a range of bytes from the file, without fetching all of it
+
+        args:
+            start (int): offset of the first byte to read
+            length (int, optional): number of bytes to read, default is
+                to the end of the file
+
+        returns:
+            bytes: the data
+        """
+        cache_path = self._cache_path()
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                f.seek(start)
+                if length is None:
+                    return f.read()
+                return f.read(length)
+        if length is None:
+            byte_range = 'bytes={}-'.format(start)
+        else:
+            if length == 0:
+                return b''
+            byte_range = 'bytes={}-{}'.format(start, start + length - 1)
+        response = s3_client().get_object(Bucket=self.bucket, Key=self.key,
+                                          Range=byte_range)
+        return response['Body'].read()
+
+def purge_object_store(session_dir):
+    """
+    Delete all objects stored in the object store for a session
+    """
+    client = s3_client()
+    bucket = s3_bucket_name()
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=session_dir + '/'):
+        keys = [{'Key': o['Key']} for o in page.get('Contents', [])]
+        if len(keys) > 0:
+            client.delete_objects(Bucket=bucket, Delete={'Objects': keys})
+
+class AdaptiveFileHandler(object):
+    '''
+    Chooses a file handler for each file according to its size and the
+    topology of the cluster.
+
+    Small files are inlined in memory. Medium-sized files go to shared
+    memory if all workers share a host, else to the shared file system.
+    Large files go to the local disk if all workers share a host, else
+    are streamed in chunks through the object store, if there is one.
+
+    Instances are called like a FileHandle class:
+
+        fh = handler('/path/to/file', session_dir=session_dir)
+    '''
+    def __init__(self, small=1024 * 1024, large=256 * 1024 * 1024,
+                 same_host=False, shared=None, object_store=None):
+        """
+        args:
+            small (int): files of up to this many bytes are kept in memory
+            large (int): files of more than this many bytes are large
+            same_host (bool): True if all workers are on this host
+            shared (bool, optional): True if $SHARED is mounted on all
+                workers. Default is whether $SHARED is set here.
+            object_store (bool, optional): True if all workers can use
+                the bucket named by $XFLOWBUCKETNAME. Default is whether
+                $XFLOWBUCKETNAME is set here.
+        """
+        if small > large:
+            raise ValueError('Error - the small file threshold must not '
+                             'exceed the large file threshold')
+        self.small = small
+        self.large = large
+        self.same_host = same_host
+        if shared is None:
+            shared = os.getenv('SHARED') is not None
+        elif shared and os.getenv('SHARED') is None:
+            raise IOError('Error - environment variable $SHARED is not set')
+        self.shared = shared
+        if object_store is None:
+            object_store = os.getenv('XFLOWBUCKETNAME') is not None
+        self.object_store = object_store
+        self.shm = os.path.isdir(os.getenv('XFLOW_SHM_DIR', '/dev/shm'))
+
+    def __str__(self):
+        return ('Adaptive filehandler (small={}, large={}, same_host={}, '
+                'shared={}, object_store={})'.format(self.small, self.large,
+                                                    self.same_host,
+                                                    self.shared,
+                                                    self.object_store))
+
+    def choose(self, size):
+        """
+        Returns the FileHandle class to use for a file of the given size
+
+        args:
+            size (int): the file size, in bytes
+
+        returns:
+            class: a subclass of FileHandle
+        """
+        if size <= self.small:
+            return CompressedFileHandle
+        if size <= self.large:
+            if self.same_host:
+                if self.shm:
+                    return SharedMemoryFileHandle
+                return TempFileHandle
+            if self.shared:
+                return SharedFileHandle
+            if self.object_store:
+                return ObjectStoreFileHandle
+            return CompressedFileHandle
+        if self.same_host:
+            return TempFileHandle
+        if self.object_store:
+            return ObjectStoreFileHandle
+        if self.shared:
+            return SharedFileHandle
+        return CompressedFileHandle
+
+    def __call__(self, path, session_dir=None):
+        fh_class = self.choose(os.path.getsize(path))
+        return fh_class(path, session_dir=session_dir)
@@ -0,0 +1,235 @@
+'''
+instrumentation.py: where the time goes in kernel runs.
+
+A kernel that includes the special output name TIMINGS in its outputs
+returns, in that position, a dict describing the run:
+
+    'kernel':    the kernel name
+    'host':      the host it ran on
+    'pid':       the worker process id
+    'key':       the dask task key, if run on a dask worker
+    'cores':     the cores the task claimed from the dask scheduler. This
+                 is what the kernel declared (see set_resources()) or, for
+                 a kernel that declared none, all of a worker's, as
+                 XflowClient asks for (see XflowClient._task_options()).
+                 Outside a dask worker, or on workers that do not
+                 advertise their cores, it is what the kernel declared,
+                 or 1.
+    'start':     start time (seconds since the epoch)
+    'end':       end time
+    'phases':    a dict of the time spent in 'stage_in' (saving input files
+                 into the working directory), 'execute' (running the command
+                 or function) and 'stage_out' (finding the output files and
+                 wrapping them in FileHandles, including any compression)
+    'bytes_in':  the size of the input files
+    'bytes_out': the size of the output files
+    'peak_rss':  peak resident memory, in bytes, as reported by getrusage().
+                 For a SubprocessKernel this is for the largest process of
+                 this run of its command (which is run through a small
+                 Python process that measures it, see xflowlib._run()), or
+                 None if it cannot be measured; for a FunctionKernel it is
+                 for the worker process itself.
+
+E.g.:
+
+    md = SubprocessKernel('pmemd.cuda -i x.in -c x.crd -o x.out')
+    md.set_outputs(['x.out', 'TIMINGS'])
+    outputs, timings = client.map(md, inputs)
+    records = client.client.gather(timings)
+    print(summarise(records))
+    write_trace(records, 'trace.json')    # view in chrome://tracing
+
+'''
+from __future__ import print_function
+import os
+import sys
+import time
+import json
+import socket
+try:
+    import resource
+except ImportError:
+    resource = None
+from distributed.worker import get_worker
+
+PHASES = ['stage_in', 'execute', 'stage_out']
+
+def rss_bytes(maxrss):
+    '''
+    Converts an ru_maxrss value from getrusage() to bytes.
+    '''
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+def peak_rss():
+    '''
+    Returns the peak resident memory, in bytes, of this process.
+    '''
+    if resource is None:
+        return None
+    return rss_bytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def _task_key():
+    '''
+    The key of the dask task being run, or None.
+    '''
+    try:
+        return get_worker().get_current_task()
+    except (ValueError, AttributeError):
+        return None
+
+def _task_cores(default=1):
+    '''
+    The cores the dask task being run claimed from the scheduler, or
+    default if it claimed none or is not being run by a dask worker.
+    '''
+    try:
+        worker = get_worker()
+        ts = worker.state.tasks[worker.get_current_task()]
+    except (ValueError, AttributeError, KeyError):
+        return default
+    return (ts.resource_restrictions or {}).get('cores', default)
+
+def nbytes(obj):
+    '''
+    The size of the file data in obj: a FileHandle or a list of them.
+    Anything else counts as zero.
+    '''
+    if isinstance(obj, (list, tuple)):
+        return sum([nbytes(o) for o in obj])
+    size = getattr(obj, 'size', None)
+    if isinstance(size, int):
+        return size
+    return 0
+
+class TaskTimer(object):
+    '''
+    Builds the TIMINGS record for a kernel run.
+    '''
+    def __init__(self, name, cores=1):
+        """
+        Start timing.
+
+        Arguments:
+            name (str): the kernel name
+            cores (int): the cores the kernel declared it needs, recorded
+                unless the task claimed others (see _task_cores())
+        """
+        self.mark = time.time()
+        self.timings = {'kernel': name,
+                        'host': socket.gethostname(),
+                        'pid': os.getpid(),
+                        'key': _task_key(),
+                        'cores': _task_cores(cores),
+                        'start': self.mark,
+                        'phases': {},
+                        'bytes_in': 0,
+                        'bytes_out': 0}
+
+    def phase(self, name):
+        """
+        Record the end of a phase; it started when the last one ended.
+        """
+        now = time.time()
+        self.timings['phases'][name] = now - self.mark
+        self.mark = now
+
+    def count_in(self, obj):
+        self.timings['bytes_in'] += nbytes(obj)
+
+    def count_out(self, obj):
+        self.timings['bytes_out'] += nbytes(obj)
+
+    def record(self, command=False, command_rss=None):
+        """
+        Returns the finished record.
+
+        Arguments:
+            command (bool): if True, the kernel ran a command, and the peak
+                RSS is command_rss (that of the command, or None if it could
+                not be measured) rather than that of this process
+            command_rss (int, optional): the peak RSS of the command
+        """
+        self.timings['end'] = self.mark
+        if command:
+            self.timings['peak_rss'] = command_rss
+        else:
+            self.timings['peak_rss'] = peak_rss()
+        return self.timings
+
+def summarise(records):
+    '''
+    Aggregate TIMINGS records by kernel.
+
+    args:
+        records (list): TIMINGS records
+
+    returns:
+        dict: for each kernel name, a dict with the number of runs
+            ('count'), total and mean time ('total', 'mean'), the total
+            for each phase, total bytes in and out, and the maximum peak RSS.
+    '''
+    summary = {}
+    for rec in records:
+        if rec is None:
+            continue
+        s = summary.setdefault(rec['kernel'], {'count': 0, 'total': 0.0,
+                                               'bytes_in': 0, 'bytes_out': 0,
+                                               'peak_rss': 0})
+        s['count'] += 1
+        s['total'] += rec['end'] - rec['start']
+        for phase in rec['phases']:
+            s[phase] = s.get(phase, 0.0) + rec['phases'][phase]
+        s['bytes_in'] += rec['bytes_in']
+        s['bytes_out'] += rec['bytes_out']
+        if rec['peak_rss'] is not None:
+            s['peak_rss'] = max(s['peak_rss'], rec['peak_rss'])
+    for name in summary:
+        summary[name]['mean'] = summary[name]['total'] / summary[name]['count']
+    return summary
+
+def trace_events(records):
+    '''
+    Convert TIMINGS records into Chrome trace format events.
+
+    Each host appears as a process and each worker process as a thread;
+    each kernel run is an event, with its phases nested inside it.
+    '''
+    events = []
+    hosts = {}
+    for rec in records:
+        if rec is None:
+            continue
+        if not rec['host'] in hosts:
+            hosts[rec['host']] = len(hosts)
+            events.append({'name': 'process_name', 'ph': 'M',
+                           'pid': hosts[rec['host']],
+                           'args': {'name': rec['host']}})
+        pid = hosts[rec['host']]
+        args = {'key': rec['key'],
+                'bytes_in': rec['bytes_in'],
+                'bytes_out': rec['bytes_out'],
+                'peak_rss': rec['peak_rss']}
+        events.append({'name': rec['kernel'], 'cat': 'kernel', 'ph': 'X',
+                       'ts': rec['start'] * 1e6,
+                       'dur': (rec['end'] - rec['start']) * 1e6,
+                       'pid': pid, 'tid': rec['pid'], 'args': args})
+        ts = rec['start']
+        for phase in PHASES:
+            if phase in rec['phases']:
+                events.append({'name': phase, 'cat': 'phase', 'ph': 'X',
+                               'ts': ts * 1e6,
+                               'dur': rec['phases'][phase] * 1e6,
+                               'pid': pid, 'tid': rec['pid']})
+                ts += rec['phases'][phase]
+    return events
+
+def write_trace(records, filename):
+    '''
+    Write TIMINGS records to a Chrome trace format file (view it with
+    chrome://tracing or https://ui.perfetto.dev).
+    '''
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': trace_events(records),
+                   'displayTimeUnit': 'ms'}, f)
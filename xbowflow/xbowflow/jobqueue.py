@@ -0,0 +1,502 @@
+'''
+jobqueue.py: a persistent queue of shell jobs for an xbow cluster.
+
+Jobs are kept in an SQLite database on the scheduler node. A Dispatcher
+takes queued jobs in order of priority (highest first, then oldest first)
+and runs them on the dask cluster, never more than a set number at once,
+recording each change of state:
+
+    queued -> running -> finished | failed
+    queued -> cancelled
+    running -> queued | unknown
+
+While a job runs it keeps a lease in its directory (which is on shared
+storage, so the dispatcher can see it too), renewed every LEASE_INTERVAL
+seconds, and when it ends its result is written there. Jobs left running
+by a dispatcher that has stopped are sorted out by the next one from their
+leases: the result of a job that ended is recorded, a job still running is
+left to finish, and only a job whose lease has expired is queued again. A
+job whose lease cannot be read is marked 'unknown' rather than risk running
+it twice; xflow-queue requeue puts it back in the queue.
+
+    queue = JobQueue()
+    job_id = queue.submit('gmx mdrun -deffnm bpti-md', '/home/ubuntu/shared/job1')
+    job_ids = queue.submit_array('gmx mdrun -deffnm {point}', '/home/ubuntu/shared/sweep',
+                                 ['t300', 't310', 't320'])
+    Dispatcher(queue, XflowClient(), max_running=4).run()
+
+The xflow-queue command is the usual way in: xflow-queue submit adds a job
+(starting a dispatcher in the background if none is running), and
+xflow-queue status reports on any number of jobs at once.
+'''
+from __future__ import print_function
+import os
+import json
+import time
+import sqlite3
+import threading
+import subprocess
+
+QUEUE_DIR = os.path.join(os.path.expanduser('~'), '.xflow')
+STATES = ['queued', 'running', 'finished', 'failed', 'cancelled', 'unknown']
+MAX_OUTPUT = 2**20
+LEASE_FILE = '.xflow-job-{}.lease'
+LEASE_INTERVAL = 30.0
+# generous, as the clocks of the nodes may differ
+LEASE_EXPIRY = 300.0
+
+def default_db():
+    '''
+    The database file: $XFLOW_QUEUE_DB if that is set, else jobs.db in
+    ~/.xflow.
+    '''
+    return os.getenv('XFLOW_QUEUE_DB', os.path.join(QUEUE_DIR, 'jobs.db'))
+
+def lease_file(directory, job_id):
+    '''
+    The lease a job keeps in its directory while it runs.
+    '''
+    return os.path.join(directory, LEASE_FILE.format(job_id))
+
+def _write_lease(filename, lease):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(lease, f)
+    os.rename(filename + '.tmp', filename)
+
+def _run_job(directory, command, job_id=None, interval=LEASE_INTERVAL):
+    '''
+    Run a job's command in its directory, returning its exit status and
+    output. Runs on a worker.
+
+    If a job id is given, the job's lease is renewed every interval seconds
+    while the command runs, and its result is written to it at the end.
+    '''
+    lease = None
+    stop = threading.Event()
+    if job_id is not None:
+        try:
+            lease = lease_file(directory, job_id)
+            _write_lease(lease, {'state': 'running'})
+        except (IOError, OSError):
+            lease = None
+    def renew():
+        while not stop.wait(interval):
+            try:
+                os.utime(lease, None)
+            except OSError:
+                pass
+    if lease is not None:
+        renewer = threading.Thread(target=renew)
+        renewer.daemon = True
+        renewer.start()
+    try:
+        output = subprocess.check_output(command, shell=True, cwd=directory,
+                                         stderr=subprocess.STDOUT)
+        returncode = 0
+    except subprocess.CalledProcessError as e:
+        output = e.output
+        returncode = e.returncode
+    except OSError as e:
+        output = str(e).encode('utf-8')
+        returncode = 127
+    finally:
+        stop.set()
+    if lease is not None:
+        try:
+            _write_lease(lease, {'state': 'ended', 'returncode': returncode,
+                                 'output': output[-MAX_OUTPUT:].decode('utf-8', 'replace')})
+        except (IOError, OSError):
+            pass
+    return {'returncode': returncode, 'output': output}
+
+def check_lease(job, now=None, expiry=LEASE_EXPIRY):
+    '''
+    Whether a job the queue has as running really is, from its lease. A job
+    that has no lease yet counts as renewed when it was started.
+
+    Args:
+        job (dict): the job, with its 'id', 'directory' and 'started' time
+        now (float, optional): the time now
+        expiry (float, optional): a lease not renewed for this many seconds
+            has expired
+
+    Returns:
+        tuple: 'ended', 'running', 'expired' or 'unknown' (if the lease
+            cannot be read), and the lease (if there is one)
+    '''
+    if now is None:
+        now = time.time()
+    if not os.path.isdir(job['directory']):
+        return 'unknown', None
+    filename = lease_file(job['directory'], job['id'])
+    try:
+        with open(filename) as f:
+            lease = json.load(f)
+        renewed = os.path.getmtime(filename)
+    except (IOError, OSError):
+        if os.path.exists(filename):
+            return 'unknown', None
+        lease = None
+        renewed = job['started']
+    except ValueError:
+        return 'unknown', None
+    if lease is not None and lease['state'] == 'ended':
+        return 'ended', lease
+    if renewed is not None and now - renewed < expiry:
+        return 'running', lease
+    return 'expired', lease
+
+class JobQueue(object):
+    '''
+    The jobs, and the record of their changes of state.
+    '''
+    def __init__(self, filename=None):
+        """
+        Arguments:
+            filename (str, optional): the database file (see default_db())
+        """
+        if filename is None:
+            filename = default_db()
+        dirname = os.path.dirname(os.path.abspath(filename))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=30,
+                                  check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                   command TEXT NOT NULL,
+                                   directory TEXT NOT NULL,
+                                   priority INTEGER NOT NULL DEFAULT 0,
+                                   state TEXT NOT NULL,
+                                   submitted REAL NOT NULL,
+                                   started REAL,
+                                   ended REAL,
+                                   returncode INTEGER,
+                                   output TEXT,
+                                   cores INTEGER)''')
+            columns = [row['name'] for row in self.db.execute('PRAGMA table_info(jobs)')]
+            if not 'cores' in columns:
+                # a database made before jobs could ask for cores
+                self.db.execute('ALTER TABLE jobs ADD COLUMN cores INTEGER')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS transitions (
+                                   job_id INTEGER NOT NULL,
+                                   state TEXT NOT NULL,
+                                   time REAL NOT NULL)''')
+            self.db.execute('''CREATE INDEX IF NOT EXISTS pending
+                               ON jobs (state, priority, id)''')
+
+    def close(self):
+        self.db.close()
+
+    def _set_state(self, job_id, state, expected=None, **fields):
+        '''
+        Change the state of a job (if it is in the expected state, if one is
+        given), returning whether it was changed.
+        '''
+        columns = ['state = ?']
+        values = [state]
+        for name in sorted(fields):
+            columns.append('{} = ?'.format(name))
+            values.append(fields[name])
+        query = 'UPDATE jobs SET {} WHERE id = ?'.format(', '.join(columns))
+        values.append(int(job_id))
+        if expected is not None:
+            query += ' AND state = ?'
+            values.append(expected)
+        if self.db.execute(query, values).rowcount == 0:
+            return False
+        self.db.execute('INSERT INTO transitions VALUES (?, ?, ?)',
+                        (job_id, state, time.time()))
+        return True
+
+    def submit(self, command, directory, priority=0, cores=None):
+        """
+        Add a job to the queue.
+
+        Arguments:
+            command (str): the shell command to run
+            directory (str): the directory to run it in
+            priority (int, optional): jobs with higher priority run first
+            cores (int, optional): the cores the job needs; by default it
+                takes all of a worker's
+
+        Returns:
+            int: the job id
+        """
+        with self.db:
+            job_id = self._insert(command, directory, priority, cores)
+        return job_id
+
+    def _insert(self, command, directory, priority, cores):
+        if cores is not None:
+            cores = int(cores)
+        cursor = self.db.execute('''INSERT INTO jobs (command, directory, priority, state, submitted, cores)
+                                    VALUES (?, ?, ?, 'queued', ?, ?)''',
+                                 (command, directory, int(priority), time.time(), cores))
+        job_id = cursor.lastrowid
+        self.db.execute('INSERT INTO transitions VALUES (?, ?, ?)',
+                        (job_id, 'queued', time.time()))
+        return job_id
+
+    def submit_array(self, command, directory, points, priority=0, cores=None):
+        """
+        Add a job array to the queue: one job for each point, each run in
+        its own subdirectory, all added at once.
+
+        Arguments:
+            command (str): the shell command to run; any "{point}" in it is
+                replaced by the name of the point
+            directory (str): the directory the points are subdirectories of
+            points (list): the names of the subdirectories
+            priority (int, optional): jobs with higher priority run first
+            cores (int, optional): the cores each job needs (see submit())
+
+        Returns:
+            list: the job ids, in the order of the points
+        """
+        with self.db:
+            job_ids = [self._insert(command.replace('{point}', point),
+                                    os.path.join(directory, point), priority,
+                                    cores)
+                       for point in points]
+        return job_ids
+
+    def status(self, job_ids=None, output=False, state=None):
+        """
+        Get the state of some or all jobs.
+
+        Arguments:
+            job_ids (list, optional): the jobs to report on (default all)
+            output (bool, optional): include the output of jobs that have
+                ended
+            state (str, optional): only report on jobs in this state
+
+        Returns:
+            list: a dict for each job, with its id, command, directory,
+                priority, cores, state, submitted, started and ended times and
+                returncode (and output, if asked for)
+        """
+        columns = 'id, command, directory, priority, cores, state, submitted, started, ended, returncode'
+        if output:
+            columns += ', output'
+        query = 'SELECT {} FROM jobs'.format(columns)
+        conditions = []
+        values = []
+        if job_ids is not None:
+            conditions.append('id IN ({})'.format(', '.join(['?'] * len(job_ids))))
+            values = [int(i) for i in job_ids]
+        if state is not None:
+            conditions.append('state = ?')
+            values.append(state)
+        if len(conditions) > 0:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY id'
+        return [dict(row) for row in self.db.execute(query, values)]
+
+    def history(self, job_id):
+        """
+        The changes of state of a job.
+
+        Returns:
+            list: (state, time) tuples, oldest first
+        """
+        rows = self.db.execute('SELECT state, time FROM transitions WHERE job_id = ? ORDER BY rowid',
+                               (int(job_id),))
+        return [(row['state'], row['time']) for row in rows]
+
+    def cancel(self, job_id):
+        """
+        Cancel a job that has not started yet.
+
+        Returns:
+            bool: whether the job was cancelled
+        """
+        with self.db:
+            return self._set_state(job_id, 'cancelled', expected='queued',
+                                   ended=time.time())
+
+    def claim(self, n):
+        """
+        Mark up to n of the next queued jobs as running, and return them.
+        """
+        with self.db:
+            rows = self.db.execute('''SELECT id, command, directory, priority, cores FROM jobs
+                                      WHERE state = 'queued'
+                                      ORDER BY priority DESC, id LIMIT ?''', (n,)).fetchall()
+            jobs = [dict(row) for row in rows
+                    if self._set_state(row['id'], 'running', expected='queued',
+                                       started=time.time())]
+        return jobs
+
+    def finish(self, job_id, returncode, output):
+        """
+        Record that a job has ended.
+        """
+        if isinstance(output, bytes):
+            output = output.decode('utf-8', 'replace')
+        if len(output) > MAX_OUTPUT:
+            output = output[-MAX_OUTPUT:]
+        state = 'finished'
+        if returncode != 0:
+            state = 'failed'
+        with self.db:
+            self._set_state(job_id, state, ended=time.time(),
+                            returncode=returncode, output=output)
+        self._remove_lease(job_id)
+
+    def _remove_lease(self, job_id):
+        row = self.db.execute('SELECT directory FROM jobs WHERE id = ?',
+                              (int(job_id),)).fetchone()
+        if row is not None:
+            try:
+                os.remove(lease_file(row['directory'], job_id))
+            except OSError:
+                pass
+
+    def requeue(self, job_id):
+        """
+        Put a job whose state is 'unknown' back in the queue.
+
+        Returns:
+            bool: whether the job was requeued
+        """
+        with self.db:
+            return self._set_state(job_id, 'queued', expected='unknown',
+                                   started=None)
+
+    def idle_time(self, now=None):
+        """
+        How long the queue has been idle: 0 if any job is queued or running,
+        else the seconds since the last job ended.
+
+        Returns:
+            float: the idle time, or None if no job has ever ended
+        """
+        if now is None:
+            now = time.time()
+        row = self.db.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'running')").fetchone()
+        if row[0] > 0:
+            return 0.0
+        row = self.db.execute('SELECT MAX(ended) FROM jobs').fetchone()
+        if row[0] is None:
+            return None
+        return max(now - row[0], 0.0)
+
+    def check_running(self, exclude=None, now=None, expiry=LEASE_EXPIRY):
+        """
+        Sort out jobs that are 'running' but not being watched over (left
+        by a dispatcher that has stopped), from their leases (see
+        check_lease()): record the result of those that have ended, queue
+        again those whose lease has expired, and mark those whose lease
+        cannot be read 'unknown'.
+
+        Arguments:
+            exclude (list, optional): the ids of the jobs being watched over
+            now (float, optional): the time now
+            expiry (float, optional): as for check_lease()
+
+        Returns:
+            dict: the ids of the jobs that had 'ended', were 'requeued', are
+                still 'running', and are 'unknown'
+        """
+        exclude = set(exclude or [])
+        checked = {'ended': [], 'requeued': [], 'running': [], 'unknown': []}
+        rows = self.db.execute("SELECT id, directory, started FROM jobs WHERE state = 'running'").fetchall()
+        for row in rows:
+            if row['id'] in exclude:
+                continue
+            state, lease = check_lease(dict(row), now=now, expiry=expiry)
+            if state == 'ended':
+                self.finish(row['id'], lease['returncode'], lease['output'])
+            elif state == 'expired':
+                with self.db:
+                    self._set_state(row['id'], 'queued', expected='running',
+                                    started=None)
+                self._remove_lease(row['id'])
+                state = 'requeued'
+            elif state == 'unknown':
+                with self.db:
+                    self._set_state(row['id'], 'unknown', expected='running')
+            checked[state].append(row['id'])
+        return checked
+
+class Dispatcher(object):
+    '''
+    Runs queued jobs on the dask cluster.
+    '''
+    def __init__(self, queue, client, max_running=8, interval=2.0):
+        """
+        Arguments:
+            queue (JobQueue): the queue
+            client (XflowClient or dask Client): the client for the cluster
+            max_running (int): the most jobs to run at once
+            interval (float): seconds between checks for new jobs
+        """
+        self.queue = queue
+        self.client = getattr(client, 'client', client)
+        self.max_running = max_running
+        self.interval = interval
+        self.running = {}
+
+    def _resources(self, job):
+        '''
+        The dask resources a job claims: the cores it asked for or, by
+        default, all of a worker's, so that jobs (which are often
+        multithreaded) do not share a worker's cores unless asked to. Workers
+        that do not advertise their cores are not constrained.
+        '''
+        from .clients import min_worker_cores
+        cores = min_worker_cores(self.client.scheduler_info()['workers'])
+        if cores is None:
+            return {}
+        if job['cores'] is not None:
+            cores = job['cores']
+        return {'resources': {'cores': cores}}
+
+    def step(self):
+        """
+        Record the jobs that have ended, and start queued jobs if there is
+        room. Jobs left running by an earlier dispatcher are checked on too
+        (see JobQueue.check_running()).
+
+        Returns:
+            int: the number of jobs running
+        """
+        for job_id, future in list(self.running.items()):
+            if future.done():
+                if future.status == 'finished':
+                    result = future.result()
+                    self.queue.finish(job_id, result['returncode'], result['output'])
+                else:
+                    self.queue.finish(job_id, -1, str(future.exception()))
+                del self.running[job_id]
+        left = self.queue.check_running(exclude=list(self.running))
+        for state, message in [('ended', 'Recorded the result of'),
+                               ('requeued', 'Requeued'),
+                               ('unknown', 'Cannot tell the state of')]:
+            if len(left[state]) > 0:
+                print('{} jobs left running by an earlier dispatcher: {}'.format(
+                    message, ' '.join([str(i) for i in left[state]])))
+        room = self.max_running - len(self.running) - len(left['running'])
+        if room > 0:
+            for job in self.queue.claim(room):
+                self.running[job['id']] = self.client.submit(
+                    _run_job, job['directory'], job['command'], job['id'],
+                    pure=False, priority=job['priority'],
+                    **self._resources(job))
+        return len(self.running) + len(left['running'])
+
+    def run(self):
+        """
+        Run until interrupted.
+        """
+        try:
+            while True:
+                self.step()
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
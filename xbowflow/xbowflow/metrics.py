@@ -0,0 +1,292 @@
+'''
+metrics.py: continuous monitoring of an xbow cluster.
+
+A MetricsCollector samples the dask scheduler at regular intervals and
+keeps a fixed-length history, from which it derives:
+
+    throughput:     tasks completed per second
+    queue_depth:    tasks waiting for a free thread
+    utilisation:    fraction of each worker's threads that are busy
+    transfer_bytes: bytes currently being moved between workers
+    cost_per_hour:  what the worker nodes cost, if their price is given
+
+so you can see whether a pool is over- or under-provisioned:
+
+    collector = MetricsCollector(client, interval=5, price=0.1)
+    collector.start()
+    ...
+    print(collector.summary())
+    print(collector.prometheus())
+    collector.stop()
+
+xflow-stat --watch gives a live terminal view, and xflow-stat --prometheus
+serves the metrics for Prometheus to scrape.
+'''
+from __future__ import print_function
+import time
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from distributed.diagnostics.plugin import SchedulerPlugin
+
+PLUGIN_NAME = 'xflow-task-counter'
+TASK_STATES = ['waiting', 'queued', 'no-worker', 'processing', 'memory',
+               'erred']
+
+class TaskCounter(SchedulerPlugin):
+    '''
+    A scheduler plugin that counts the tasks that have finished.
+    '''
+    name = PLUGIN_NAME
+
+    def __init__(self):
+        self.completed = 0
+        self.erred = 0
+
+    def transition(self, key, start, finish, *args, **kwargs):
+        if start == 'processing' and finish == 'memory':
+            self.completed += 1
+        elif finish == 'erred':
+            self.erred += 1
+
+def _scheduler_sample(dask_scheduler=None):
+    '''
+    Take a snapshot of the scheduler state. Runs on the scheduler.
+    '''
+    tasks = dict([(state, 0) for state in TASK_STATES])
+    for ts in dask_scheduler.tasks.values():
+        if ts.state in tasks:
+            tasks[ts.state] += 1
+    counter = dask_scheduler.plugins.get(PLUGIN_NAME)
+    workers = {}
+    for address, ws in dask_scheduler.workers.items():
+        metrics = ws.metrics
+        transfer = metrics.get('transfer', {})
+        net_io = metrics.get('host_net_io', {})
+        workers[address] = {'name': str(ws.name),
+                            'host': ws.host,
+                            'nthreads': ws.nthreads,
+                            'processing': len(ws.processing),
+                            'in_memory': len(ws.has_what),
+                            'cpu': metrics.get('cpu', 0.0),
+                            'memory': metrics.get('memory', 0),
+                            'incoming_bytes': transfer.get('incoming_bytes', 0),
+                            'outgoing_bytes': transfer.get('outgoing_bytes', 0),
+                            'read_bps': net_io.get('read_bps', 0.0),
+                            'write_bps': net_io.get('write_bps', 0.0)}
+    return {'time': time.time(),
+            'tasks': tasks,
+            'completed': getattr(counter, 'completed', 0),
+            'erred': getattr(counter, 'erred', 0),
+            'workers': workers}
+
+def _has_plugin(dask_scheduler=None):
+    return PLUGIN_NAME in dask_scheduler.plugins
+
+class MetricsCollector(object):
+    '''
+    Samples cluster metrics at intervals, keeping a ring buffer of history.
+    '''
+    def __init__(self, client, interval=5.0, history=720, price=None):
+        """
+        Arguments:
+            client (XflowClient or dask Client): the client for the cluster
+            interval (float): seconds between samples
+            history (int): the number of samples to keep
+            price (float, optional): the cost of one worker node per hour
+                (e.g. the spot price), for the cost metrics
+        """
+        self.client = getattr(client, 'client', client)
+        self.interval = interval
+        self.history = deque(maxlen=history)
+        self.price = price
+        self._stop = threading.Event()
+        self._thread = None
+        if not self.client.run_on_scheduler(_has_plugin):
+            self.client.register_plugin(TaskCounter())
+
+    def sample(self):
+        """
+        Take a sample now, add it to the history, and return it.
+        """
+        snapshot = self.client.run_on_scheduler(_scheduler_sample)
+        self.history.append(snapshot)
+        return snapshot
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                print('Warning: failed to sample cluster metrics: {}'.format(e))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """
+        Start sampling in a background thread.
+        """
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling.
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def throughput(self, window=None):
+        """
+        Tasks completed per second over the last window samples (default:
+        the whole history).
+        """
+        samples = list(self.history)
+        if window is not None:
+            samples = samples[-(window + 1):]
+        if len(samples) < 2:
+            return 0.0
+        dt = samples[-1]['time'] - samples[0]['time']
+        if dt <= 0:
+            return 0.0
+        return (samples[-1]['completed'] - samples[0]['completed']) / dt
+
+    def summary(self):
+        """
+        Derive metrics from the latest sample.
+
+        Returns:
+            dict: cluster-wide metrics, plus a 'workers' dict of per-worker
+                metrics. 'provisioning' is 'over' if threads are idle with
+                nothing queued, 'under' if more tasks are queued than there
+                are threads, else 'ok'.
+        """
+        if len(self.history) == 0:
+            self.sample()
+        latest = self.history[-1]
+        workers = {}
+        n_threads = 0
+        overflow = 0
+        busy = 0
+        transfer = 0
+        for address, w in latest['workers'].items():
+            running = min(w['processing'], w['nthreads'])
+            utilisation = 0.0
+            if w['nthreads'] > 0:
+                utilisation = float(running) / w['nthreads']
+            workers[address] = {'name': w['name'],
+                                'host': w['host'],
+                                'utilisation': utilisation,
+                                'cpu': w['cpu'],
+                                'memory': w['memory'],
+                                'executing': running,
+                                'in_memory': w['in_memory']}
+            n_threads += w['nthreads']
+            overflow += w['processing'] - running
+            busy += running
+            transfer += w['incoming_bytes'] + w['outgoing_bytes']
+        tasks = latest['tasks']
+        queue_depth = (tasks['waiting'] + tasks['queued'] + tasks['no-worker']
+                       + overflow)
+        utilisation = 0.0
+        if n_threads > 0:
+            utilisation = float(busy) / n_threads
+        if queue_depth > n_threads:
+            provisioning = 'under'
+        elif queue_depth == 0 and utilisation < 0.5:
+            provisioning = 'over'
+        else:
+            provisioning = 'ok'
+        n_hosts = len(set([w['host'] for w in latest['workers'].values()]))
+        throughput = self.throughput(window=1)
+        summary = {'time': latest['time'],
+                   'n_workers': len(workers),
+                   'n_hosts': n_hosts,
+                   'n_threads': n_threads,
+                   'completed': latest['completed'],
+                   'erred': latest['erred'],
+                   'throughput': throughput,
+                   'queue_depth': queue_depth,
+                   'utilisation': utilisation,
+                   'transfer_bytes': transfer,
+                   'provisioning': provisioning,
+                   'workers': workers}
+        if self.price is not None:
+            summary['cost_per_hour'] = self.price * n_hosts
+            if throughput > 0:
+                summary['cost_per_task'] = summary['cost_per_hour'] / (throughput * 3600)
+        return summary
+
+    def prometheus(self):
+        """
+        Returns the latest metrics in the Prometheus text exposition format.
+        """
+        s = self.summary()
+        lines = []
+        def metric(name, kind, text, values):
+            lines.append('# HELP xflow_{} {}'.format(name, text))
+            lines.append('# TYPE xflow_{} {}'.format(name, kind))
+            for labels, value in values:
+                lines.append('xflow_{}{} {}'.format(name, labels, value))
+
+        metric('tasks_completed_total', 'counter', 'Tasks completed.',
+               [('', s['completed'])])
+        metric('tasks_erred_total', 'counter', 'Tasks that failed.',
+               [('', s['erred'])])
+        metric('throughput', 'gauge', 'Tasks completed per second.',
+               [('', s['throughput'])])
+        metric('queue_depth', 'gauge', 'Tasks waiting for a free thread.',
+               [('', s['queue_depth'])])
+        metric('workers', 'gauge', 'Number of workers.',
+               [('', s['n_workers'])])
+        metric('threads', 'gauge', 'Number of worker threads.',
+               [('', s['n_threads'])])
+        metric('utilisation', 'gauge', 'Fraction of worker threads busy.',
+               [('', s['utilisation'])])
+        metric('transfer_bytes', 'gauge', 'Bytes in transit between workers.',
+               [('', s['transfer_bytes'])])
+        workers = sorted(s['workers'].items())
+        metric('worker_utilisation', 'gauge',
+               'Fraction of the threads of a worker that are busy.',
+               [('{{worker="{}",host="{}"}}'.format(a, w['host']), w['utilisation'])
+                for a, w in workers])
+        metric('worker_cpu_percent', 'gauge', 'CPU use of a worker.',
+               [('{{worker="{}",host="{}"}}'.format(a, w['host']), w['cpu'])
+                for a, w in workers])
+        metric('worker_memory_bytes', 'gauge', 'Memory use of a worker.',
+               [('{{worker="{}",host="{}"}}'.format(a, w['host']), w['memory'])
+                for a, w in workers])
+        if 'cost_per_hour' in s:
+            metric('cost_per_hour', 'gauge', 'Cost of the worker nodes per hour.',
+                   [('', s['cost_per_hour'])])
+        return '\n'.join(lines) + '\n'
+
+    def serve_prometheus(self, port=9786):
+        """
+        Serve the metrics over HTTP for Prometheus to scrape, sampling once
+        per request. Blocks until interrupted.
+        """
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                collector.sample()
+                body = collector.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('', port), Handler)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
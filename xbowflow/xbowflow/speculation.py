@@ -0,0 +1,332 @@
+'''
+speculation.py: speculative re-execution of straggler tasks.
+
+On a pool of spot instances some nodes are slower than others, and one slow
+replica in a client.map() can hold up a whole cycle of a workflow. With
+speculation switched on:
+
+    client = XflowClient()
+    client.set_speculation(percentile=90, factor=1.5)
+    outputs = client.map(mdrun, tprs)
+
+the client keeps a record of how long each kernel takes. When a run has
+been going for longer than the given percentile of the durations of that
+kernel (times factor), a duplicate is launched on an idle worker. Whichever
+copy finishes first supplies the result, and the other is cancelled.
+
+Each run submitted this way is its candidate tasks plus a light selector
+task that waits, without occupying a worker thread, for the first of them
+to finish; duplicates are passed to it through a dask Queue of its own.
+The future the client returns is the selector's, so it is ready as soon
+as one copy of its run has finished, whatever the other runs of the same
+map() are doing, and as_completed() and CycleRunner see each run as it
+ends.
+
+Note that dask cannot interrupt a task that is already running: the
+result of a cancelled copy is thrown away, but its worker thread stays busy
+until it completes.
+'''
+from __future__ import print_function
+import time
+import uuid
+import threading
+from collections import deque, OrderedDict
+import numpy as np
+from distributed import Client, Queue, get_client, secede, wait
+from distributed.diagnostics.plugin import SchedulerPlugin
+
+PLUGIN_NAME = 'xflow-task-durations'
+COPY_SEP = '-copy-'
+
+class TaskDurations(SchedulerPlugin):
+    '''
+    A scheduler plugin that records how long recent tasks took to compute.
+    '''
+    name = PLUGIN_NAME
+
+    def __init__(self, maxlen=10000):
+        self.maxlen = maxlen
+        self.durations = OrderedDict()
+
+    def transition(self, key, start, finish, *args, **kwargs):
+        if start == 'processing' and finish == 'memory':
+            for startstop in kwargs.get('startstops', []):
+                if startstop['action'] == 'compute':
+                    self.durations[key] = startstop['stop'] - startstop['start']
+            while len(self.durations) > self.maxlen:
+                self.durations.popitem(last=False)
+
+def _has_plugin(dask_scheduler=None):
+    return PLUGIN_NAME in dask_scheduler.plugins
+
+def _speculation_state(keys, dask_scheduler=None):
+    '''
+    Where the given tasks are running and for how long, how long those
+    that have finished took, and which workers have a free thread. Runs on
+    the scheduler.
+    '''
+    keys = set(keys)
+    plugin = dask_scheduler.plugins.get(PLUGIN_NAME)
+    executing = {}
+    idle = []
+    for address, ws in dask_scheduler.workers.items():
+        for ts, duration in ws.executing.items():
+            if ts.key in keys:
+                executing[ts.key] = (address, duration)
+        if len(ws.processing) - len(ws.long_running) < ws.nthreads:
+            idle.append(address)
+    finished = {}
+    if plugin is not None:
+        for key in keys:
+            if key in plugin.durations:
+                finished[key] = plugin.durations[key]
+    return {'executing': executing, 'finished': finished, 'idle': idle}
+
+def _copy_key(key, n):
+    '''
+    The key of the n-th duplicate of the task with the given key.
+    '''
+    return '{}{}{}'.format(key, COPY_SEP, n)
+
+def _first_result(name, poll=0.5):
+    '''
+    Wait for the first candidate of a run to finish, cancel the others, and
+    return its result (or raise its error, if they all fail). The
+    candidates (the run's task and its duplicates, see _copy_key()) arrive
+    as futures on the dask Queue called name. Runs on a worker, seceded,
+    one for each run.
+    '''
+    client = get_client()
+    candidates = Queue(name, client=client)
+    secede()
+    futures = [candidates.get()]
+    while True:
+        while candidates.qsize() > 0:
+            futures.append(candidates.get())
+        try:
+            wait(futures, timeout=poll, return_when='FIRST_COMPLETED')
+        except TimeoutError:
+            pass
+        finished = [f for f in futures if f.status == 'finished']
+        if len(finished) > 0:
+            client.cancel([f for f in futures if not f is finished[0]],
+                          force=True)
+            return finished[0].result()
+        if all([f.done() for f in futures]) and candidates.qsize() == 0:
+            return futures[0].result()
+
+class Speculator(object):
+    '''
+    Submits kernel runs so that stragglers can be duplicated, and watches
+    over them.
+    '''
+    def __init__(self, client, percentile=90, factor=1.5, min_samples=5,
+                 max_copies=1, interval=1.0, history=100):
+        """
+        Arguments:
+            client (dask Client): the client for the cluster. If it is
+                asynchronous, the speculator makes its own (synchronous)
+                connection to the scheduler to watch over the runs.
+            percentile (float): a run is a straggler if it takes longer than
+                this percentile of the durations of the kernel...
+            factor (float): ...times this factor
+            min_samples (int): do not speculate about a kernel until it has
+                run this many times
+            max_copies (int): the most duplicates to launch of any one run
+            interval (float): seconds between checks for stragglers
+            history (int): the number of durations of each kernel to keep
+        """
+        self.client = client
+        self.percentile = percentile
+        self.factor = factor
+        self.min_samples = min_samples
+        self.max_copies = max_copies
+        self.interval = interval
+        self.history = history
+        self.durations = {}
+        self.maps = {}
+        self.launched = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._own_client = client.asynchronous
+        self._watcher = None
+        if not self._own_client:
+            self._connect()
+
+    def _connect(self):
+        '''
+        Get the client that watches over the runs, and make sure the
+        scheduler records task durations.
+        '''
+        if self._watcher is None:
+            if self._own_client:
+                self._watcher = Client(self.client.scheduler.address)
+            else:
+                self._watcher = self.client
+            if not self._watcher.run_on_scheduler(_has_plugin):
+                self._watcher.register_plugin(TaskDurations())
+        return self._watcher
+
+    def map(self, name, run, args, options):
+        """
+        Submit a number of runs of a kernel.
+
+        Arguments:
+            name (str): the kernel name
+            run (function): the kernel's run() method
+            args (list): the arguments for each run
+            options (list): keyword arguments for dask submit(), for each run
+
+        Returns:
+            list: a Future for the result of each run, from whichever of its
+                copies finishes first
+        """
+        primaries = [self.client.submit(run, *a, pure=False, **o)
+                     for a, o in zip(args, options)]
+        map_id = uuid.uuid4().hex
+        queue_names = ['xflow-speculate-{}-{}'.format(map_id, i)
+                       for i in range(len(primaries))]
+        firsts = self.client.map(_first_result, queue_names, pure=False,
+                                 priority=10)
+        with self._lock:
+            self.maps[map_id] = {'name': name,
+                                 'run': run,
+                                 'args': args,
+                                 'options': options,
+                                 'firsts': firsts,
+                                 'candidates': [[p] for p in primaries],
+                                 'recorded': set(),
+                                 'queue_names': queue_names,
+                                 'queues': None}
+        self.start()
+        return firsts
+
+    def submit(self, name, run, args, options):
+        """
+        Submit a kernel run.
+
+        Arguments:
+            name (str): the kernel name
+            run (function): the kernel's run() method
+            args (list): its arguments
+            options (dict): keyword arguments for dask submit()
+
+        Returns:
+            Future: for the result of whichever copy finishes first
+        """
+        return self.map(name, run, [args], [options])[0]
+
+    def threshold(self, name):
+        """
+        How long a run of the named kernel can take before it counts as a
+        straggler, or None if the kernel has not run often enough to tell.
+        """
+        durations = self.durations.get(name)
+        if durations is None or len(durations) < self.min_samples:
+            return None
+        return np.percentile(durations, self.percentile) * self.factor
+
+    def _record(self, name, duration):
+        if not name in self.durations:
+            self.durations[name] = deque(maxlen=self.history)
+        self.durations[name].append(duration)
+
+    def _record_finished(self, record, state):
+        for i, candidates in enumerate(record['candidates']):
+            if i in record['recorded']:
+                continue
+            durations = [state['finished'][c.key] for c in candidates
+                         if c.key in state['finished']]
+            if len(durations) > 0:
+                self._record(record['name'], min(durations))
+                record['recorded'].add(i)
+
+    def _finish(self, map_id, record):
+        if record['queues'] is not None:
+            for queue in record['queues']:
+                queue.close()
+        with self._lock:
+            del self.maps[map_id]
+
+    def step(self):
+        """
+        Record the durations of runs that have finished, and launch
+        duplicates of any stragglers.
+        """
+        with self._lock:
+            records = list(self.maps.items())
+        if len(records) == 0:
+            return
+        watcher = self._connect()
+        for map_id, record in records:
+            if record['queues'] is None:
+                record['queues'] = [Queue(name, client=watcher)
+                                    for name in record['queue_names']]
+                for queue, candidates in zip(record['queues'],
+                                             record['candidates']):
+                    queue.put(candidates[0])
+        keys = [c.key for map_id, record in records
+                for candidates in record['candidates'] for c in candidates]
+        state = watcher.run_on_scheduler(_speculation_state, keys)
+        idle = list(state['idle'])
+        for map_id, record in records:
+            self._record_finished(record, state)
+            if all([f.done() for f in record['firsts']]):
+                self._finish(map_id, record)
+                continue
+            threshold = self.threshold(record['name'])
+            if threshold is None:
+                continue
+            for i, candidates in enumerate(record['candidates']):
+                if len(candidates) > self.max_copies or record['firsts'][i].done():
+                    continue
+                running = [state['executing'][c.key] for c in candidates
+                           if c.key in state['executing']]
+                if len(running) < len(candidates):
+                    continue
+                if min([duration for worker, duration in running]) < threshold:
+                    continue
+                busy = [worker for worker, duration in running]
+                free = [worker for worker in idle if not worker in busy]
+                if len(free) == 0:
+                    continue
+                options = dict(record['options'][i], workers=free,
+                               allow_other_workers=False)
+                key = _copy_key(candidates[0].key, len(candidates))
+                duplicate = watcher.submit(record['run'], *record['args'][i],
+                                           key=key, **options)
+                record['queues'][i].put(duplicate)
+                candidates.append(duplicate)
+                idle.remove(free[0])
+                self.launched += 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.step()
+            except Exception as e:
+                print('Warning: speculation check failed: {}'.format(e))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """
+        Start checking for stragglers in a background thread.
+        """
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop checking for stragglers.
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self._own_client and self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
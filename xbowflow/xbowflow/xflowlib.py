@@ -10,23 +10,32 @@ import shutil
 import copy
 import hashlib
 import glob
+import sys
 import uuid
 import numpy as np
 from path import Path
+from dask.utils import parse_bytes
+from dask.distributed import Reschedule
 from .filehandling import SharedFileHandle, CompressedFileHandle, TempFileHandle, FileHandle
+from .filehandling import SharedMemoryFileHandle, shm_root
+from .filehandling import ObjectStoreFileHandle, purge_object_store
+from .filehandling import AdaptiveFileHandler
+from .instrumentation import TaskTimer, _task_key, rss_bytes
+from . import checkpoints
 
 filehandler = None
 filehandler_type = None
 session_dir = str(uuid.uuid4())
 STDOUT = "STDOUT"
 DEBUGINFO = "DEBUGINFO"
+TIMINGS = "TIMINGS"
 
-def set_filehandler(fh_type):
+def set_filehandler(fh_type, **kwargs):
     """
     Set the type of file handler that will be used to pass file data between
     kernels.
 
-    Currently three options are available. 
+    Currently six options are available.
 
     The most basic ('tmp') uses the
     temporary file system on the host for sharing files. Obviously this only
@@ -41,27 +50,55 @@ def set_filehandler(fh_type):
     file data is stored in memory and passed to workers the same way as 
     all other data objects.
 
+    The fourth option is 'shm' which places file data in POSIX shared
+    memory (/dev/shm). Like 'tmp' this only works if all workers reside on
+    the same host (e.g. a LocalCluster with several worker processes), but
+    workers then read the data in place, with no copying or compression.
+
+    The fifth option is 's3' which stores file data in an S3-compatible
+    object store, in the bucket named by the environment variable
+    XFLOWBUCKETNAME. Transfers are multipart and parallel, and each node
+    keeps a local cache of the data it has fetched. Set XFLOW_S3_ENDPOINT
+    to use a local stand-in such as MinIO instead of AWS S3.
+
+    The sixth option is 'adaptive' which chooses one of the above for each
+    file, according to its size and the cluster topology; see
+    AdaptiveFileHandler for the keyword arguments that configure this.
+    XflowClient.set_adaptive_filehandler() detects the topology for you.
+
     args:
-        fh_type (str): one of 'tmp', 'shared', or 'memory'
+        fh_type (str): one of 'tmp', 'shared', 'memory', 'shm', 's3' or
+            'adaptive'
+        kwargs: passed to AdaptiveFileHandler if fh_type is 'adaptive'
     """
     global filehandler_type
     global filehandler
-    fh_types = ['tmp', 'shared', 'memory']
-    fh_list = [TempFileHandle, SharedFileHandle, CompressedFileHandle]
+    fh_types = ['tmp', 'shared', 'memory', 'shm', 's3', 'adaptive']
+    fh_list = [TempFileHandle, SharedFileHandle, CompressedFileHandle,
+               SharedMemoryFileHandle, ObjectStoreFileHandle,
+               AdaptiveFileHandler]
     if not fh_type in fh_types:
-        raise ValueError('Error - argument must be one of "tmp", "shared". '
-                         'or "memory"')
+        raise ValueError('Error - argument must be one of "tmp", "shared", '
+                         '"memory", "shm", "s3" or "adaptive"')
     filehandler_type = fh_type
-    filehandler = fh_list[fh_types.index(fh_type)]
+    if fh_type == 'adaptive':
+        filehandler = AdaptiveFileHandler(**kwargs)
+    else:
+        filehandler = fh_list[fh_types.index(fh_type)]
 
-def purge():
+def _purge(fh_type):
     '''
-    Remove all temporary files for the current session.
+    Remove the temporary files for the current session of one type.
     '''
-    if filehandler_type == 'tmp':
+    if fh_type == 'tmp':
         tmpdir = os.path.join(os.path.dirname(tempfile.mkdtemp()), session_dir)
-    elif filehandler_type == 'shared':
+    elif fh_type == 'shared':
         tmpdir = os.path.join(os.getenv('SHARED'), session_dir)
+    elif fh_type == 'shm':
+        tmpdir = os.path.join(shm_root(), session_dir)
+    elif fh_type == 's3':
+        purge_object_store(session_dir)
+        tmpdir = None
     else:
         tmpdir = None
     if tmpdir is not None:
@@ -70,6 +107,21 @@ def purge():
         except:
             pass
 
+def purge():
+    '''
+    Remove all temporary files for the current session.
+    '''
+    if filehandler_type == 'adaptive':
+        _purge('tmp')
+        if filehandler.shm:
+            _purge('shm')
+        if filehandler.shared:
+            _purge('shared')
+        if filehandler.object_store:
+            _purge('s3')
+    else:
+        _purge(filehandler_type)
+
 def load(filename):
     '''
     Returns a FileHandle for a path
@@ -78,6 +130,41 @@ def load(filename):
         set_filehandler('memory')
     return filehandler(filename, session_dir=session_dir)
 
+def resource_requirements(cores=None, memory=None, disk=None, gpus=None):
+    '''
+    Convert kernel resource requirements into dask worker resources.
+
+    Workers advertise matching resources when they are launched, e.g.:
+
+        dask-worker --resources "cores=4 memory=16e9 disk=100e9 gpus=1"
+
+    args:
+        cores (int, optional): CPU cores
+        memory (int or str, optional): memory, in bytes or e.g. '4GB'
+        disk (int or str, optional): local scratch disk, likewise
+        gpus (int, optional): GPUs
+
+    returns:
+        dict: suitable for the 'resources' argument to dask submit()
+    '''
+    resources = {}
+    if cores is not None:
+        resources['cores'] = cores
+    if memory is not None:
+        if isinstance(memory, str):
+            memory = parse_bytes(memory)
+        resources['memory'] = memory
+    if disk is not None:
+        if isinstance(disk, str):
+            disk = parse_bytes(disk)
+        resources['disk'] = disk
+    if gpus is not None:
+        resources['gpus'] = gpus
+    for key in resources:
+        if resources[key] < 0:
+            raise ValueError('Error - resource {} cannot be negative'.format(key))
+    return resources
+
 def _gen_filenames(pattern, n_files):
     '''
     Generate a list of filenames consistent with a pattern.
@@ -96,6 +183,68 @@ def _gen_filenames(pattern, n_files):
     filenames = [template.format(i) for i in range(n_files)]
     return filenames
             
+# Runs a shell command (argv[2]) and writes the peak RSS of its processes,
+# as getrusage() reports it, to a file descriptor (argv[1]). A process
+# started straight from the worker would count the worker's own peak RSS,
+# which it inherits until it execs.
+MEASURE_RSS = '''
+import os, resource, subprocess, sys
+returncode = subprocess.call(sys.argv[2], shell=True)
+os.write(int(sys.argv[1]), str(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss).encode())
+if returncode < 0:
+    os.kill(os.getpid(), -returncode)
+sys.exit(returncode)
+'''
+
+def _run(cmd, env=None, watcher=None, measure=False):
+    '''
+    Run a shell command, checking it succeeds. If a CheckpointWatcher is
+    given, it watches over the command while it runs. If measure is True,
+    the result (or the CalledProcessError raised) has the peak resident
+    memory of the command, in bytes, as its peak_rss attribute (None if it
+    cannot be measured here).
+    '''
+    args = cmd
+    fds = ()
+    if measure and os.name == 'posix':
+        read_fd, write_fd = os.pipe()
+        args = [sys.executable, '-c', MEASURE_RSS, str(write_fd), cmd]
+        fds = (write_fd,)
+    process = subprocess.Popen(args, shell=len(fds) == 0,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, env=env,
+                               start_new_session=watcher is not None,
+                               pass_fds=fds)
+    rss = None
+    if len(fds) > 0:
+        os.close(write_fd)
+    if watcher is not None:
+        watcher.start(process)
+    try:
+        try:
+            stdout, stderr = process.communicate()
+        finally:
+            if watcher is not None:
+                watcher.stop()
+        if len(fds) > 0:
+            # nothing, if the command was killed before it was measured
+            measured = os.read(read_fd, 64)
+            if len(measured) > 0:
+                rss = rss_bytes(int(measured))
+    finally:
+        if len(fds) > 0:
+            os.close(read_fd)
+    if watcher is not None and watcher.interrupted:
+        raise SpotInterruption(cmd)
+    if process.returncode != 0:
+        error = subprocess.CalledProcessError(process.returncode, cmd,
+                                              stdout, stderr)
+        error.peak_rss = rss
+        raise error
+    result = subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+    result.peak_rss = rss
+    return result
+
 class Filepack(object):
     """
     A collection of files
@@ -149,9 +298,18 @@ class SubprocessKernel(object):
             template (str): a template for the command to be executed
         """
         self.template = template
+        words = template.split()
+        if len(words) > 0:
+            self.name = os.path.basename(words[0])
+        else:
+            self.name = 'subprocess'
         self.inputs = []
         self.outputs = []
         self.constants = []
+        self.resources = {}
+        self.checkpoints = []
+        self.checkpoint_interval = None
+        self.retries = 0
         self.STDOUT = None
         if filehandler is None:
             set_filehandler('memory')
@@ -182,6 +340,44 @@ class SubprocessKernel(object):
                     ' not of type {}'.format(type(outputs)))
         self.outputs = outputs
 
+    def set_resources(self, cores=None, memory=None, disk=None, gpus=None):
+        """
+        Declare the resources each run of the kernel needs, so the dask
+        scheduler only runs it on a worker with those resources free.
+
+        If cores is set, OMP_NUM_THREADS is set to match when the command
+        is run.
+
+        Args:
+            cores (int, optional): CPU cores
+            memory (int or str, optional): memory, in bytes or e.g. '4GB'
+            disk (int or str, optional): local scratch disk, likewise
+            gpus (int, optional): GPUs
+        """
+        self.resources = resource_requirements(cores, memory, disk, gpus)
+
+    def set_checkpoints(self, checkpoints, interval=None, retries=3):
+        """
+        Declare the checkpoint files the command writes, so that if the
+        worker is a spot instance that gets interrupted, the task can be
+        rerun elsewhere, starting from its last checkpoint (see the
+        checkpoints module).
+
+        Args:
+            checkpoints (list): the checkpoint files, e.g. ['state.cpt']
+            interval (float, optional): also save the checkpoint files to
+                shared storage every interval seconds
+            retries (int, optional): how many times the task may be rerun
+                on another worker after an interruption. Failures of the
+                command itself are never rerun.
+        """
+        if not isinstance(checkpoints, list):
+            raise TypeError('Error - checkpoints must be of type list,'
+                    ' not of type {}'.format(type(checkpoints)))
+        self.checkpoints = checkpoints
+        self.checkpoint_interval = interval
+        self.retries = retries
+
     def set_constant(self, key, value):
         """
         Set a constant for the kernel
@@ -219,6 +415,8 @@ class SubprocessKernel(object):
                 self.outputs
         """
         outputs = []
+        timer = TaskTimer(self.name, self.resources.get('cores', 1))
+        timings_index = None
         td = tempfile.mkdtemp()
         with Path(td) as tmpdir:
             var_dict = {}
@@ -226,6 +424,7 @@ class SubprocessKernel(object):
                 if self.inputs[i] in self.variables:
                     var_dict[self.inputs[i]] = args[i]
                 else:
+                    timer.count_in(args[i])
                     if isinstance(args[i], list):
                         fnames = _gen_filenames(self.inputs[i], len(args[i]))
                         for j, f in enumerate(args[i]):
@@ -238,18 +437,41 @@ class SubprocessKernel(object):
             for d in self.constants:
                 try:
                     d['value'].save(d['name'])
+                    timer.count_in(d['value'])
                 except AttributeError:
                     var_dict[d['name']] = d['value']
             cmd = self.template.format(**var_dict)
+            watcher = None
+            if len(self.checkpoints) > 0:
+                key = _task_key()
+                if key is None:
+                    key = hashlib.md5(cmd.encode('utf-8')).hexdigest()
+                ckpt_dir = checkpoints.checkpoint_dir(self.session_dir, key)
+                checkpoints.restore(ckpt_dir)
+                watcher = checkpoints.CheckpointWatcher(self.checkpoints,
+                                                        ckpt_dir,
+                                                        self.checkpoint_interval)
+            timer.phase('stage_in')
+            env = None
+            if 'cores' in self.resources:
+                env = os.environ.copy()
+                env['OMP_NUM_THREADS'] = str(self.resources['cores'])
             try:
-                result = subprocess.run(cmd, shell=True,
-                                        stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE,
-                                        check=True)
+                result = _run(cmd, env, watcher, measure=TIMINGS in self.outputs)
+            except SpotInterruption:
+                if (checkpoints.record_interruption(watcher.ckpt_dir) <= self.retries
+                        and checkpoints.leave_cluster()):
+                    # this worker is going, so the task is rerun elsewhere
+                    raise Reschedule()
+                raise
             except subprocess.CalledProcessError as e:
                 result = CalledProcessError(e)
                 if not DEBUGINFO in self.outputs:
                     raise result
+            else:
+                if watcher is not None:
+                    checkpoints.discard(watcher.ckpt_dir)
+            timer.phase('execute')
 
             self.STDOUT = result.stdout.decode()
             for outfile in self.outputs:
@@ -264,12 +486,20 @@ class SubprocessKernel(object):
                         outputs.append(self.STDOUT)
                     elif outfile == DEBUGINFO:
                         outputs.append(result)
+                    elif outfile == TIMINGS:
+                        timings_index = len(outputs)
+                        outputs.append(None)
                     else:
                         outputs.append(None)
+                timer.count_out(outputs[-1])
         try:
             shutil.rmtree(td)
         except:
             pass
+        timer.phase('stage_out')
+        if timings_index is not None:
+            outputs[timings_index] = timer.record(command=True,
+                                                  command_rss=result.peak_rss)
         if len(outputs) == 1:
             outputs = outputs[0]
         else:
@@ -284,9 +514,11 @@ class FunctionKernel(object):
             filetype (FileHandle): the file-type handler
         """
         self.func = func
+        self.name = getattr(func, '__name__', 'function')
         self.inputs = []
         self.outputs = []
         self.constants = {}
+        self.resources = {}
         self.tmpdir = None
         if filehandler is None:
             set_filehandler('memory')
@@ -305,6 +537,19 @@ class FunctionKernel(object):
         """
         self.outputs = outputs
 
+    def set_resources(self, cores=None, memory=None, disk=None, gpus=None):
+        """
+        Declare the resources each run of the kernel needs, so the dask
+        scheduler only runs it on a worker with those resources free.
+
+        Args:
+            cores (int, optional): CPU cores
+            memory (int or str, optional): memory, in bytes or e.g. '4GB'
+            disk (int or str, optional): local scratch disk, likewise
+            gpus (int, optional): GPUs
+        """
+        self.resources = resource_requirements(cores, memory, disk, gpus)
+
     def set_constant(self, key, value):
         """
         Set a parameters for the kernel
@@ -330,6 +575,7 @@ class FunctionKernel(object):
         """
         #td = tempfile.TemporaryDirectory(dir=self.tmpdir)
         #with Path(td.name) as tmpdir:
+        timer = TaskTimer(self.name, self.resources.get('cores', 1))
         td = tempfile.mkdtemp(dir=self.tmpdir)
         with Path(td) as tmpdir:
             indict = {}
@@ -339,26 +585,35 @@ class FunctionKernel(object):
                         if k in self.inputs:
                             try:
                                 indict[k] = v[k].save(os.path.basename(v[k].path))
+                                timer.count_in(v[k])
                             except AttributeError:
                                 indict[k] = v[k]
                 else:
                     try:
                         indict[self.inputs[i]] = v.save(os.path.basename(v.path))
+                        timer.count_in(v)
                     except AttributeError:
                         indict[self.inputs[i]] = v
             for k in self.constants:
                 try:
                     indict[k] = self.constants[k].save(os.path.basename(self.constants[k].path))
+                    timer.count_in(self.constants[k])
                 except AttributeError:
                     indict[k] = self.constants[k]
+            timer.phase('stage_in')
             result = self.func(**indict)
-            if not isinstance(result, list):
+            timer.phase('execute')
+            if list(self.outputs) == [TIMINGS]:
+                # the function has no outputs of its own
+                result = []
+            elif not isinstance(result, list):
                 result = [result]
             outputs = []
             for i, v in enumerate(result):
                 if isinstance(v, str):
                     if os.path.exists(v):
                         outputs.append(self.filehandler(v, session_dir=self.session_dir))
+                        timer.count_out(outputs[-1])
                     else:
                         outputs.append(v)
                 else:
@@ -367,6 +622,9 @@ class FunctionKernel(object):
             shutil.rmtree(td)
         except:
             pass
+        timer.phase('stage_out')
+        if TIMINGS in self.outputs:
+            outputs.insert(self.outputs.index(TIMINGS), timer.record())
         if len(outputs) == 1:
             outputs = outputs[0]
         else:
@@ -391,6 +649,20 @@ class CalledProcessError(XflowError):
         self.stdout = e.stdout
         self.stderr = e.stderr
         self.output = self.stdout
+        self.peak_rss = getattr(e, 'peak_rss', None)
 
     def __str__(self):
         return 'Error: command "{}" failed with return code {}; STDOUT="{}"; STDERR="{}"'.format(self.cmd, self.returncode, self.stdout, self.stderr)
+
+class SpotInterruption(XflowError):
+    """
+    Exception raised if a kernel is stopped because the spot instance it
+    is running on is about to be reclaimed. Its checkpoint files have been
+    saved, so it can be rerun.
+    """
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+
+    def __str__(self):
+        return 'Error: command "{}" was interrupted by a spot instance interruption notice; its checkpoints have been saved'.format(self.cmd)